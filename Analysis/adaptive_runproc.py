@@ -0,0 +1,164 @@
+import os
+import sys
+import json
+import subprocess
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from incremental_runproc import load_config, expand_datasets, write_batch_config, \
+    merge_hists, merge_cutflows
+from utils.adaptive_chunks import MemoryModel, read_multiplicities, file_chunksize, \
+    coffea_chunksize, read_memory_log
+
+# Run pepper with chunk sizes adapted to the memory needed per event.
+# The counter branches (nPFCandidate, nJet, ...) of all files are read first
+# (--workers files at a time), every file gets the largest chunk size keeping
+# its chunks below --memory-budget (memory added per chunk, GB) according to
+# the memory model, files whose chunk sizes are within a factor of 2 are
+# processed together as one pepper run in <outdir>/groups/group_NNN with its
+# own --chunksize. The --parallel groups with the smallest chunks (heaviest
+# events) are submitted together; processors with the MemoryProbeMixin
+# (signal, wjets, ztomumu_FR) log the peak RSS of every chunk and the model
+# is refit after every round, so the remaining groups are planned with the
+# measured memory. The model is kept in --model for the next runs.
+# Arguments after "--" are given to pepper.runproc, e.g.:
+#   python adaptive_runproc.py stau_processor_signal.py ./configs/proc_2018/stau2018_signal.json \
+#       -o ./output_adaptive/signal/ --memory-budget 3 -- -i ./configs/setup_env_mamba.sh --condor 400
+
+# ratio between the chunk sizes of neighbouring groups
+GROUP_STEP = 2
+
+
+def plan(files, multiplicities, model, budget, min_chunksize, max_chunksize):
+    """Chunk size for every file"""
+    chunksizes = {}
+    for path in files:
+        n_events, counts = multiplicities[path]
+        memory = model.per_event(n_events, counts)
+        chunksizes[path] = file_chunksize(memory, budget, max_chunksize, min_chunksize)
+    return chunksizes
+
+
+def group_files(chunksizes):
+    """Files grouped by chunk size, smallest chunks first"""
+    groups = {}
+    for path, size in chunksizes.items():
+        groups.setdefault(int(np.floor(np.log(size) / np.log(GROUP_STEP))), []).append(path)
+    return [groups[key] for key in sorted(groups)]
+
+
+def refit(model, log_path, multiplicities):
+    features, observed = [], []
+    for record in read_memory_log(log_path):
+        if record["filename"] not in multiplicities:
+            continue
+        n_events, counts = multiplicities[record["filename"]]
+        features.append(model.features(n_events, counts, record["entrystart"], record["entrystop"]))
+        observed.append(record["peak_rss"] - record["rss_before"])
+    model.fit(features, observed)
+    return len(observed)
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    pepper_args = []
+    if "--" in argv:
+        pepper_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = ArgumentParser(description="Run pepper with per-file chunk sizes from a memory budget")
+    parser.add_argument("processor", help="Processor file, e.g. stau_processor_signal.py")
+    parser.add_argument("config", help="Pepper config")
+    parser.add_argument("-o", "--outdir", required=True, help="Output directory")
+    parser.add_argument("--datasets", nargs="*", default=None, help="Only process these datasets")
+    parser.add_argument("--memory-budget", type=float, default=2.,
+                        help="Memory added while processing one chunk (GB)")
+    parser.add_argument("--model", default=None,
+                        help="Memory model (json), default: <outdir>/memory_model.json")
+    parser.add_argument("--min-chunksize", type=int, default=1000)
+    parser.add_argument("--max-chunksize", type=int, default=500000)
+    parser.add_argument("--parallel", type=int, default=4,
+                        help="Number of groups submitted at the same time")
+    parser.add_argument("--workers", type=int, default=16,
+                        help="Number of files of which the multiplicities are read at the same time")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print the planned chunk sizes")
+    args = parser.parse_args(argv)
+
+    os.makedirs(args.outdir, exist_ok=True)
+    model_path = args.model or os.path.join(args.outdir, "memory_model.json")
+    log_path = os.path.abspath(os.path.join(args.outdir, "memory_log.jsonl"))
+    model = MemoryModel.load(model_path)
+    budget = args.memory_budget * 1024**3
+
+    config = load_config(args.config)
+    datasets = expand_datasets(config, args.datasets)
+    file_groups = {}
+    for group, ds in datasets.items():
+        for dsname, files in ds.items():
+            for path in files:
+                file_groups[path] = (group, dsname)
+    with ThreadPoolExecutor(max_workers=args.workers) as pool:
+        multiplicities = dict(zip(file_groups, pool.map(
+            lambda path: read_multiplicities(path, model.collections), file_groups)))
+    print(f"Read the multiplicities of {len(multiplicities)} files")
+    if len(multiplicities) == 0:
+        sys.exit(0)
+
+    remaining = set(multiplicities)
+    done = []
+    while len(remaining) > 0:
+        chunksizes = plan(remaining, multiplicities, model, budget,
+                          args.min_chunksize, args.max_chunksize)
+        groups = group_files(chunksizes)
+        if args.dry_run:
+            for files in groups:
+                n_events = [multiplicities[path][0] for path in files]
+                chunksize = coffea_chunksize([chunksizes[path] for path in files], n_events)
+                print(f"{len(files)} files, {sum(n_events)} events: chunksize {int(chunksize)}")
+            sys.exit(0)
+        running = []
+        for files in groups[:args.parallel]:
+            n_events = [multiplicities[path][0] for path in files]
+            chunksize = int(coffea_chunksize([chunksizes[path] for path in files], n_events))
+            name = f"group_{len(done) + len(running):03d}"
+            group_dir = os.path.join(args.outdir, "groups", name)
+            os.makedirs(group_dir, exist_ok=True)
+            selected = {group: {} for group in datasets}
+            for path in files:
+                group, dsname = file_groups[path]
+                selected[group].setdefault(dsname, {})[path] = datasets[group][dsname][path]
+            group_config = dict(config)
+            group_config["memory_log"] = log_path
+            write_batch_config(group_config, selected, os.path.join(group_dir, "config.json"))
+            command = [sys.executable, "-m", "pepper.runproc", args.processor,
+                       os.path.join(group_dir, "config.json"), "-o", group_dir,
+                       "--chunksize", str(chunksize),
+                       "--statedata", os.path.join(group_dir, "state.coffea")] + pepper_args
+            print(f"{name}: {len(files)} files, {sum(n_events)} events, chunksize {chunksize}")
+            print(" ".join(command))
+            running.append((name, group_dir, files, subprocess.Popen(command)))
+        failed = []
+        for name, group_dir, files, process in running:
+            if process.wait() != 0:
+                print(f"pepper failed for {name}")
+                failed.append(process.returncode)
+                continue
+            done.append(group_dir)
+            remaining -= set(files)
+        if len(failed) > 0:
+            sys.exit(failed[0])
+        n_records = refit(model, log_path, multiplicities)
+        model.save(model_path)
+        print(f"Memory model refit with {n_records} chunks: "
+              + ", ".join(f"{key} {value:.0f} B" for key, value in model.coefficients.items()))
+
+    merge_hists(done, args.outdir)
+    cutflows = []
+    for group_dir in done:
+        with open(os.path.join(group_dir, "cutflows.json")) as f:
+            cutflows.append(json.load(f))
+    with open(os.path.join(args.outdir, "cutflows.json"), "w") as f:
+        json.dump(merge_cutflows(cutflows), f, indent=4)
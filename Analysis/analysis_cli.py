@@ -0,0 +1,364 @@
+import os
+import sys
+import json
+import time
+import array
+import signal
+import socket
+import runpy
+import traceback
+from argparse import ArgumentParser, REMAINDER
+
+# Single entry point for the plotting and rate scripts.
+# The scripts are only imported when their subcommand runs, e.g.
+#   python analysis_cli.py plot ./configs/stau2018_fake_rate_plotter.json ${DIR}/hists/hists.json --outdir ...
+#   python analysis_cli.py rate ./configs/stau2018_fake_rate_plotter.json ${DIR}/hists/hists.json --outdir ...
+#   python analysis_cli.py macro plot_fake_rate_2D_run2 ...
+# With a running worker (python analysis_cli.py serve --detach) the commands are
+# sent over a Unix socket to the worker, which has ROOT, pepper, coffea, the
+# tdr style and the helper modules already loaded and forks a fresh process
+# for every command, so only the script itself is executed. stdin/stdout/stderr
+# of the calling terminal are passed to the worker, the output looks the same.
+# Without a worker (or with --local) the command runs in the calling process.
+
+ANALYSIS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+COMMANDS = {
+    "plot": "stau_plotter.py",
+    "rate": "stau_rate_calculate.py",
+    "abcd": "stau_abcd_MC.py",
+    "cutflow": "cutflow_sum.py",
+}
+
+# loaded once by the worker
+WARM_MODULES = [
+    "numpy", "awkward", "ROOT", "coffea", "coffea.hist", "pepper",
+    "utils.utils", "utils.plotter", "utils.hist_rebin", "utils.histogram2d",
+]
+
+DEFAULT_SOCKET = os.path.join(
+    os.environ.get("XDG_RUNTIME_DIR", "/tmp"), f"analysis_cli_{os.getuid()}.sock")
+
+MAX_FDS = 3
+
+
+def script_path(command, args):
+    """Path of the script and its arguments for a subcommand"""
+    if command == "macro":
+        if len(args) == 0:
+            raise ValueError("macro needs the name of the macro")
+        name = args[0] if args[0].endswith(".py") else args[0] + ".py"
+        return os.path.join(ANALYSIS_DIR, "macros", name), args[1:]
+    if command not in COMMANDS:
+        raise ValueError(f"Unknown command {command}, available: "
+                         f"{', '.join(list(COMMANDS) + ['macro'])}")
+    return os.path.join(ANALYSIS_DIR, COMMANDS[command]), args
+
+
+def run_script(path, args):
+    """Run a script as __main__ with the given arguments, returns the exit code"""
+    sys.argv = [path] + list(args)
+    sys.path[0] = os.path.dirname(path)
+    try:
+        runpy.run_path(path, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        if isinstance(e.code, int):
+            return e.code
+        print(e.code, file=sys.stderr)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+def _send(conn, message, fds=()):
+    data = (json.dumps(message) + "\n").encode()
+    if len(fds) > 0:
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))]
+        conn.sendmsg([data], ancillary)
+    else:
+        conn.sendall(data)
+
+
+def _receive(conn):
+    # one json line, file descriptors can only come with the first part
+    data = b""
+    fds = []
+    while not data.endswith(b"\n"):
+        chunk, ancillary, _, _ = conn.recvmsg(
+            65536, socket.CMSG_LEN(MAX_FDS * array.array("i").itemsize))
+        if not chunk:
+            break
+        data += chunk
+        for level, kind, payload in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds_array = array.array("i")
+                fds_array.frombytes(payload[:len(payload) - len(payload) % fds_array.itemsize])
+                fds += list(fds_array)
+    if not data:
+        return None, fds
+    return json.loads(data.decode()), fds
+
+
+class Worker:
+    """Long-lived process holding the warm imports, every request is run
+    in a forked child"""
+
+    def __init__(self, socket_path):
+        self.socket_path = socket_path
+        self.running = {}
+        self.started = None
+
+    def warm_up(self):
+        os.chdir(ANALYSIS_DIR)
+        if ANALYSIS_DIR not in sys.path:
+            sys.path.insert(0, ANALYSIS_DIR)
+        for name in WARM_MODULES:
+            start = time.time()
+            try:
+                __import__(name)
+            except ImportError as e:
+                print(f"Not preloaded {name}: {e}")
+                continue
+            print(f"Loaded {name} ({time.time() - start:.1f} s)")
+        if "ROOT" in sys.modules:
+            ROOT = sys.modules["ROOT"]
+            ROOT.gROOT.SetBatch(True)
+        self.started = time.time()
+
+    def stale_modules(self):
+        """Modules of this repository changed since they were loaded"""
+        stale = []
+        for name, module in list(sys.modules.items()):
+            path = getattr(module, "__file__", None)
+            if path is None or not os.path.abspath(path).startswith(ANALYSIS_DIR):
+                continue
+            try:
+                if os.path.getmtime(path) > self.started:
+                    stale.append(name)
+            except OSError:
+                continue
+        return stale
+
+    def run_child(self, request, fds):
+        code = 1
+        try:
+            for target, fd in enumerate(fds[:3]):
+                os.dup2(fd, target)
+            for fd in fds:
+                os.close(fd)
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            os.environ.clear()
+            os.environ.update(request["env"])
+            os.chdir(request["cwd"])
+            # changed local modules are imported again in the child only
+            for name in self.stale_modules():
+                print(f"analysis_cli: reloading changed module {name}, "
+                      "restart the worker to avoid this", file=sys.stderr)
+                del sys.modules[name]
+            path, args = script_path(request["command"], request["args"])
+            code = run_script(path, args)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def reap(self):
+        while len(self.running) > 0:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                break
+            if os.WIFEXITED(status):
+                code = os.WEXITSTATUS(status)
+            else:
+                code = 128 + os.WTERMSIG(status)
+            conn = self.running.pop(pid, None)
+            if conn is None:
+                continue
+            try:
+                _send(conn, {"exit": code})
+            except OSError:
+                pass
+            conn.close()
+
+    def handle(self, conn):
+        request, fds = _receive(conn)
+        if request is None or request["command"] in ("stop", "status"):
+            for fd in fds:
+                os.close(fd)
+        if request is None:
+            conn.close()
+            return True
+        if request["command"] == "stop":
+            _send(conn, {"exit": 0})
+            conn.close()
+            return False
+        if request["command"] == "status":
+            _send(conn, {"pid": os.getpid(), "running": len(self.running),
+                         "uptime": time.time() - self.started,
+                         "stale": self.stale_modules(), "exit": 0})
+            conn.close()
+            return True
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            self.server.close()
+            conn.close()
+            self.run_child(request, fds)
+        for fd in fds:
+            os.close(fd)
+        _send(conn, {"pid": pid})
+        self.running[pid] = conn
+        return True
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            if ping(self.socket_path):
+                raise RuntimeError(f"A worker is already running on {self.socket_path}")
+            os.remove(self.socket_path)
+        self.warm_up()
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.server.bind(self.socket_path)
+        finally:
+            os.umask(old_umask)
+        self.server.listen(16)
+        self.server.settimeout(0.2)
+        print(f"Worker {os.getpid()} listening on {self.socket_path}")
+        sys.stdout.flush()
+        try:
+            while True:
+                self.reap()
+                try:
+                    conn, _ = self.server.accept()
+                except socket.timeout:
+                    continue
+                conn.settimeout(None)
+                if not self.handle(conn):
+                    break
+        finally:
+            self.server.close()
+            if os.path.exists(self.socket_path):
+                os.remove(self.socket_path)
+            for pid in list(self.running):
+                os.kill(pid, signal.SIGTERM)
+            while len(self.running) > 0:
+                self.reap()
+                time.sleep(0.05)
+
+
+def ping(socket_path):
+    try:
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.connect(socket_path)
+    except OSError:
+        return False
+    conn.close()
+    return True
+
+
+def send_request(socket_path, command, args=()):
+    """Run a command on the worker, returns the exit code or None if no
+    worker is reachable"""
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        return None
+    request = {"command": command, "args": list(args), "cwd": os.getcwd(),
+               "env": dict(os.environ)}
+    sys.stdout.flush()
+    sys.stderr.flush()
+    _send(conn, request, [0, 1, 2])
+    reader = conn.makefile("r")
+    pid = None
+    try:
+        for line in reader:
+            message = json.loads(line)
+            if "pid" in message:
+                pid = message["pid"]
+            if command == "status":
+                print(json.dumps(message, indent=4))
+            if "exit" in message:
+                return message["exit"]
+    except KeyboardInterrupt:
+        if pid is not None:
+            os.kill(pid, signal.SIGINT)
+        return 130
+    finally:
+        conn.close()
+    print("analysis_cli: worker closed the connection", file=sys.stderr)
+    return 1
+
+
+def detach(log_path):
+    if os.fork() > 0:
+        os._exit(0)
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    log = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    null = os.open(os.devnull, os.O_RDONLY)
+    os.dup2(null, 0)
+    os.dup2(log, 1)
+    os.dup2(log, 2)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Run the analysis scripts, through a warm worker if one is running")
+    parser.add_argument("--socket", default=os.environ.get("ANALYSIS_CLI_SOCKET", DEFAULT_SOCKET),
+                        help="Unix socket of the worker")
+    parser.add_argument("--local", action="store_true",
+                        help="Run in this process even if a worker is running")
+    parser.add_argument("--detach", action="store_true",
+                        help="With serve: run the worker in the background")
+    parser.add_argument("--log", default=None,
+                        help="With serve --detach: log file of the worker")
+    parser.add_argument("command",
+                        help=f"{', '.join(COMMANDS)}, macro <name>, or serve, stop, status")
+    parser.add_argument("args", nargs=REMAINDER, help="Arguments of the script")
+    args = parser.parse_args()
+    if args.command in ("serve", "stop", "status") and len(args.args) > 0:
+        # options of the worker commands may also follow the command
+        argv = sys.argv[1:]
+        argv.remove(args.command)
+        args = parser.parse_args(argv + [args.command])
+
+    if args.command == "serve":
+        if args.detach:
+            detach(args.log or args.socket + ".log")
+        Worker(args.socket).serve()
+        sys.exit(0)
+
+    if args.command in ("stop", "status"):
+        code = send_request(args.socket, args.command)
+        if code is None:
+            print(f"No worker running on {args.socket}")
+            code = 1
+        sys.exit(code)
+
+    try:
+        path, script_args = script_path(args.command, args.args)
+    except ValueError as e:
+        parser.error(str(e))
+
+    code = None
+    if not args.local:
+        code = send_request(args.socket, args.command, args.args)
+    if code is None:
+        code = run_script(path, script_args)
+    sys.exit(code)
@@ -0,0 +1,312 @@
+import os
+import sys
+import json
+import time
+import socket
+import platform
+import queue as queue_module
+import resource
+import subprocess
+import importlib.util
+import multiprocessing
+from argparse import ArgumentParser
+
+# Benchmark suite for the analysis processors running on synthetic NanoAOD.
+# Generate the input files once:
+#   python benchmark_processors.py generate --outdir ./bench_data --profile signal --nfiles 2 --nevents 20000
+# Run the processors at several chunk sizes (every run is done in a fresh
+# process, so the peak memory is measured independently):
+#   python benchmark_processors.py run --data ./bench_data --benchmark signal wjets region_study \
+#       --signal-config ./configs/proc_2018/stau2018_signal.json \
+#       --wjets-config ./configs/proc_2018/stau2018_wjets.json \
+#       --chunksize 10000 50000 --output ./bench_results.jsonl
+# Compare with an older result file:
+#   python benchmark_processors.py compare ./bench_results.jsonl --baseline ./bench_results_old.jsonl
+
+# benchmark name: (processor module, dataset name used for the synthetic files)
+# the dataset name decides which dataset specific steps are run by the processors
+BENCHMARKS = {
+    "signal": ("stau_processor_signal", "SMS-TStauStau_MStau-300_ctau-100mm_mLSP-1"),
+    "wjets": ("stau_processor_wjets", "WJetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8"),
+    "region_study": ("region_study", "m(#tilde{#tau})=300 GeV c#tau_{0}=100 mm"),
+}
+
+ANALYSIS_DIR = os.path.dirname(os.path.realpath(__file__))
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ANALYSIS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (subprocess.CalledProcessError, OSError):
+        return None
+
+
+def host_info():
+    cpu = platform.processor()
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu = line.split(":", 1)[1].strip()
+                    break
+    except OSError:
+        pass
+    return {
+        "host": socket.gethostname(),
+        "cpu": cpu,
+        "n_cpu": os.cpu_count(),
+        "python": platform.python_version(),
+    }
+
+
+def load_module(name):
+    spec = importlib.util.spec_from_file_location(
+        name, os.path.join(ANALYSIS_DIR, name + ".py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_pepper_processor(module_name, dsname, config_path, files, chunksize):
+    import coffea.processor
+    from coffea.nanoevents import NanoAODSchema
+    module = load_module(module_name)
+    config = module.Processor.config_class(config_path)
+    # only the synthetic dataset is processed
+    config["exp_datasets"] = {}
+    config["mc_datasets"] = {dsname: files}
+    config["compute_systematics"] = False
+    processor = module.Processor(config, None)
+    return coffea.processor.run_uproot_job(
+        {dsname: files}, "Events", processor,
+        executor=coffea.processor.iterative_executor,
+        executor_args={"schema": NanoAODSchema},
+        chunksize=chunksize,
+    )
+
+
+def run_region_study(config_path, dsname, files, chunksize):
+    import coffea.processor
+    from omegaconf import OmegaConf
+    from coffea.nanoevents import NanoAODSchema
+    module = load_module("region_study")
+    cfg = OmegaConf.load(config_path)
+    cfg.input_disID = None
+    schema = NanoAODSchema
+    schema.mixins.update({"CaloJet": "PtEtaPhiMCollection"})
+    return coffea.processor.run_uproot_job(
+        {dsname: files}, "Events",
+        module.JetMatching(cfg=cfg, tag_ids_files=False),
+        executor=coffea.processor.iterative_executor,
+        executor_args={"schema": schema},
+        chunksize=chunksize,
+    )
+
+
+def _benchmark_worker(benchmark, config_path, files, chunksize, queue):
+    # executed in a separate process: ru_maxrss is the peak of this run only
+    module_name, dsname = BENCHMARKS[benchmark]
+    os.chdir(ANALYSIS_DIR)
+    sys.path.insert(0, ANALYSIS_DIR)
+    import uproot
+    n_events = 0
+    for path in files:
+        with uproot.open(path) as f:
+            n_events += f["Events"].num_entries
+    start = time.perf_counter()
+    try:
+        if benchmark == "region_study":
+            run_region_study(config_path, dsname, files, chunksize)
+        else:
+            run_pepper_processor(module_name, dsname, config_path, files, chunksize)
+        error = None
+    except Exception as exc:
+        error = f"{type(exc).__name__}: {exc}"
+    wall = time.perf_counter() - start
+    # ru_maxrss is given in kB on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    queue.put({
+        "n_events": n_events,
+        "wall_s": wall,
+        "events_per_s": n_events / wall if wall > 0 else None,
+        "peak_rss_mb": peak_rss,
+        "error": error,
+    })
+
+
+def _failed(error):
+    return {"n_events": None, "wall_s": None, "events_per_s": None,
+            "peak_rss_mb": None, "error": error}
+
+
+def run_benchmark(benchmark, config_path, files, chunksize, timeout=None, poll=5.0):
+    ctx = multiprocessing.get_context("spawn")
+    queue = ctx.Queue()
+    proc = ctx.Process(target=_benchmark_worker,
+                       args=(benchmark, config_path, files, chunksize, queue))
+    proc.start()
+    start = time.monotonic()
+    while True:
+        try:
+            result = queue.get(timeout=poll)
+            break
+        except queue_module.Empty:
+            pass
+        if not proc.is_alive():
+            # the worker died without a result (import error, bad input, OOM kill);
+            # a result posted just before exiting is still read
+            proc.join()
+            try:
+                result = queue.get(timeout=poll)
+                break
+            except queue_module.Empty:
+                return _failed(f"Worker exited with code {proc.exitcode} without a result")
+        if timeout is not None and time.monotonic() - start > timeout:
+            proc.terminate()
+            proc.join()
+            return _failed(f"Timeout after {timeout} s")
+    proc.join()
+    return result
+
+
+def do_generate(args):
+    from utils.synthetic_nanoaod import generate_dataset, PROFILES
+    overrides = {}
+    for item in args.set:
+        key, value = item.split("=")
+        if key not in PROFILES[args.profile]:
+            raise ValueError(f"Unknown multiplicity parameter {key}")
+        overrides[key] = float(value)
+    files = generate_dataset(os.path.join(args.outdir, args.profile), args.nfiles,
+                             args.nevents, profile=args.profile, seed=args.seed,
+                             **overrides)
+    print(f"Written {len(files)} files to {os.path.join(args.outdir, args.profile)}")
+
+
+def do_run(args):
+    configs = {
+        "signal": args.signal_config,
+        "wjets": args.wjets_config,
+        "region_study": args.region_study_config,
+    }
+    info = host_info()
+    commit = git_commit()
+    for benchmark in args.benchmark:
+        if configs[benchmark] is None:
+            raise ValueError(f"No config given for the benchmark {benchmark}")
+        profile = "signal" if benchmark in ("signal", "region_study") else args.background_profile
+        manifest_path = os.path.join(args.data, profile, "manifest.json")
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        for chunksize in args.chunksize:
+            for repeat in range(args.repeat):
+                print(f"Running {benchmark} with chunksize {chunksize} ({repeat+1}/{args.repeat})")
+                result = run_benchmark(benchmark, os.path.abspath(configs[benchmark]),
+                                       manifest["files"], chunksize, args.timeout)
+                record = {
+                    "benchmark": benchmark,
+                    "chunksize": chunksize,
+                    "repeat": repeat,
+                    "profile": profile,
+                    "multiplicities": manifest["multiplicities"],
+                    "git_commit": commit,
+                    "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                }
+                record.update(info)
+                record.update(result)
+                if result["error"]:
+                    print("    failed:", result["error"])
+                else:
+                    print(f"    {result['events_per_s']:.1f} events/s, "
+                          f"peak RSS {result['peak_rss_mb']:.0f} MB")
+                with open(args.output, "a") as f:
+                    f.write(json.dumps(record) + "\n")
+
+
+def read_results(path):
+    # best (fastest) repetition per (benchmark, chunksize)
+    results = {}
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if record["error"]:
+                continue
+            key = (record["benchmark"], record["chunksize"])
+            if key not in results or record["events_per_s"] > results[key]["events_per_s"]:
+                results[key] = record
+    return results
+
+
+def do_compare(args):
+    current = read_results(args.results)
+    baseline = read_results(args.baseline)
+    print(f"{'benchmark':<14}{'chunksize':>10}{'events/s':>12}{'ratio':>8}"
+          f"{'RSS [MB]':>10}{'ratio':>8}")
+    regression = False
+    for key in sorted(current):
+        rec = current[key]
+        line = f"{key[0]:<14}{key[1]:>10}{rec['events_per_s']:>12.1f}"
+        if key in baseline:
+            base = baseline[key]
+            speed = rec["events_per_s"] / base["events_per_s"]
+            mem = rec["peak_rss_mb"] / base["peak_rss_mb"]
+            flag = ""
+            if speed < 1 - args.tolerance or mem > 1 + args.tolerance:
+                flag = "  <-- regression"
+                regression = True
+            line += f"{speed:>8.2f}{rec['peak_rss_mb']:>10.0f}{mem:>8.2f}{flag}"
+        else:
+            line += f"{'-':>8}{rec['peak_rss_mb']:>10.0f}{'-':>8}"
+        print(line)
+    return 1 if regression else 0
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the analysis processors on synthetic NanoAOD")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    gen = subparsers.add_parser("generate", help="Write synthetic NanoAOD files")
+    gen.add_argument("--outdir", required=True, help="Output directory")
+    gen.add_argument("--profile", choices=["signal", "background"], default="signal")
+    gen.add_argument("--nfiles", type=int, default=2)
+    gen.add_argument("--nevents", type=int, default=20000, help="Events per file")
+    gen.add_argument("--seed", type=int, default=0)
+    gen.add_argument("--set", nargs="*", default=[], help="Overwrite mean multiplicities, "
+                     "e.g. --set PFCandidate=2000 Jet=10")
+
+    run = subparsers.add_parser("run", help="Run the benchmarks")
+    run.add_argument("--data", required=True, help="Directory given to generate --outdir")
+    run.add_argument("--benchmark", nargs="+", choices=list(BENCHMARKS),
+                     default=list(BENCHMARKS))
+    run.add_argument("--signal-config", help="Pepper config for stau_processor_signal")
+    run.add_argument("--wjets-config", help="Pepper config for stau_processor_wjets")
+    run.add_argument("--region-study-config", default=os.path.join(
+        ANALYSIS_DIR, "configs", "region_study.yaml"))
+    run.add_argument("--background-profile", default="background",
+                     help="Synthetic profile used for the wjets benchmark")
+    run.add_argument("--chunksize", type=int, nargs="+", default=[10000, 50000, 200000])
+    run.add_argument("--repeat", type=int, default=1)
+    run.add_argument("--output", default="bench_results.jsonl",
+                     help="Results are appended to this JSON-lines file")
+    run.add_argument("--timeout", type=float, default=None,
+                     help="Stop a run after this many seconds and record it as failed")
+
+    comp = subparsers.add_parser("compare", help="Compare two result files")
+    comp.add_argument("results")
+    comp.add_argument("--baseline", required=True)
+    comp.add_argument("--tolerance", type=float, default=0.1,
+                      help="Relative change reported as regression")
+
+    args = parser.parse_args()
+    if args.command == "generate":
+        do_generate(args)
+    elif args.command == "run":
+        do_run(args)
+    elif args.command == "compare":
+        sys.exit(do_compare(args))
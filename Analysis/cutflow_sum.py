@@ -3,17 +3,20 @@ import json
 from argparse import ArgumentParser
 import re
 
+from utils.cutflow_store import load_cutflow
+
 parser = ArgumentParser(
     description="Cut flow sum of signal hists")
 parser.add_argument(
-    "xsec", help="Crosssection file path")
+    "xsec", help="Cutflow file path (json or sqlite)")
+parser.add_argument(
+    "--era", required=True, help="Era of the cutflow in the store")
 
 
 args = parser.parse_args()
 
 try:
-    with open(args.xsec) as f:
-        crosssections = json.load(f)
+    crosssections = load_cutflow(args.xsec, args.era)
 except:
     raise ValueError('Error reading/open file with crosssections')
 
@@ -0,0 +1,288 @@
+import os
+import sys
+import json
+import glob
+import shutil
+import subprocess
+from argparse import ArgumentParser
+
+import hjson
+
+from utils.hist_store import write_store, STORE_NAME
+
+# Incremental running of pepper over datasets which are still growing
+# (late CRAB outputs, recovery tasks).
+# Every call processes only the files which did not contribute yet to the
+# output as a new batch in <outdir>/batches/batch_NNN and afterwards merges
+# all batches into <outdir>/hists/hists.json and <outdir>/cutflows.json, so the
+# plotting scripts can be used on <outdir> as on a usual pepper output.
+# With --hist-store the histograms are merged into <outdir>/hists/hists.h5
+# (see utils/hist_store.py) instead of one ROOT file per histogram.
+# Files that changed or disappeared (or were added to bad_file_paths) since
+# they were processed invalidate their batch: with --on-change reprocess (default)
+# the batch is dropped and its remaining files are processed again together
+# with the new ones, with --on-change flag they are only reported.
+# Arguments after "--" are given to pepper.runproc, e.g.:
+#   python incremental_runproc.py stau_processor_signal.py ./configs/proc_2018/stau2018_signal.json \
+#       -o ./output_incremental/signal/ -- -i ./configs/setup_env_mamba.sh --condor 400 --retries 20
+
+MANIFEST = "incremental_manifest.json"
+
+
+def load_config(path):
+    confdir = os.path.dirname(os.path.abspath(path))
+    with open(path) as f:
+        text = f.read()
+    text = text.replace("$CONFDIR", confdir)
+    config = hjson.loads(text)
+    for var, key in (("$STOREDIR", "store"), ("$DATADIR", "datadir")):
+        if key in config:
+            text = text.replace(var, config[key])
+    return hjson.loads(text)
+
+
+def bad_files(config):
+    if "bad_file_paths" not in config or not config["bad_file_paths"]:
+        return set()
+    with open(config["bad_file_paths"]) as f:
+        return set(json.load(f))
+
+
+def expand_datasets(config, selected=None):
+    # {"exp_datasets"/"mc_datasets": {dataset: {path: [size, mtime]}}}
+    bad = bad_files(config)
+    result = {}
+    for group in ("exp_datasets", "mc_datasets"):
+        result[group] = {}
+        for dsname, paths in config.get(group, {}).items():
+            if selected is not None and dsname not in selected:
+                continue
+            files = {}
+            for path in paths:
+                for filename in sorted(glob.glob(path)):
+                    if filename in bad:
+                        continue
+                    stat = os.stat(filename)
+                    files[filename] = [stat.st_size, stat.st_mtime_ns]
+            result[group][dsname] = files
+    return result
+
+
+def load_manifest(outdir):
+    path = os.path.join(outdir, MANIFEST)
+    if not os.path.exists(path):
+        return {"batches": {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(outdir, manifest):
+    path = os.path.join(outdir, MANIFEST)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def compare_files(current, manifest):
+    """Returns the files to process and the batches invalidated by changed
+    or removed files"""
+    to_process = {group: {} for group in current}
+    dirty = {}
+    processed = {}
+    for name, batch in manifest["batches"].items():
+        if batch["status"] != "done":
+            continue
+        for group, datasets in batch["datasets"].items():
+            for dsname, files in datasets.items():
+                for filename, stat in files.items():
+                    processed[(group, dsname, filename)] = (name, stat)
+    for group, datasets in current.items():
+        for dsname, files in datasets.items():
+            for filename, stat in files.items():
+                key = (group, dsname, filename)
+                if key not in processed:
+                    to_process[group].setdefault(dsname, {})[filename] = stat
+                elif processed[key][1] != stat:
+                    dirty.setdefault(processed[key][0], []).append(("changed", filename))
+    for (group, dsname, filename), (name, stat) in processed.items():
+        # datasets not selected in this call are not checked
+        if dsname in current[group] and filename not in current[group][dsname]:
+            dirty.setdefault(name, []).append(("removed", filename))
+    return to_process, dirty
+
+
+def merge_cutflows(cutflows):
+    def add(a, b):
+        for key, value in b.items():
+            if isinstance(value, dict):
+                add(a.setdefault(key, {}), value)
+            else:
+                a[key] = a.get(key, 0) + value
+    result = {}
+    for cutflow in cutflows:
+        add(result, cutflow)
+    return result
+
+
+def merge_hists(batch_dirs, outdir, hist_store=False):
+    index = None
+    sources = {}
+    for batch_dir in batch_dirs:
+        with open(os.path.join(batch_dir, "hists", "hists.json")) as f:
+            batch_index = json.load(f)
+        if index is None:
+            index = batch_index
+        for keys, histfile in zip(*batch_index["content"]):
+            key = tuple(keys)
+            if key not in sources:
+                sources[key] = (histfile, [])
+            sources[key][1].append(os.path.join(batch_dir, "hists", histfile))
+    hist_dir = os.path.join(outdir, "hists")
+    os.makedirs(hist_dir, exist_ok=True)
+    content = [[], []]
+    # histograms only in the stores of the batches (systematic axis) are
+    # merged into the store of the output
+    store_sources = {}
+    for key, (histfile, paths) in sources.items():
+        content[0].append(list(key))
+        content[1].append(histfile)
+        if hist_store or not all(os.path.exists(path) for path in paths):
+            store_sources[histfile] = paths
+    index["content"] = content
+    if len(store_sources) > 0:
+        write_store(os.path.join(hist_dir, STORE_NAME), index, store_sources)
+    for key, (histfile, paths) in sources.items():
+        if histfile in store_sources:
+            continue
+        target = os.path.join(hist_dir, histfile)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if len(paths) == 1:
+            shutil.copy(paths[0], target)
+        else:
+            subprocess.run(["hadd", "-f", "-k", target] + paths, check=True,
+                           stdout=subprocess.DEVNULL)
+    with open(os.path.join(hist_dir, "hists.json"), "w") as f:
+        json.dump(index, f, indent=4)
+
+
+def merge_outputs(outdir, manifest, hist_store=False):
+    batch_dirs = [os.path.join(outdir, "batches", name)
+                  for name, batch in sorted(manifest["batches"].items())
+                  if batch["status"] == "done"]
+    if len(batch_dirs) == 0:
+        print("No processed batches to merge")
+        return
+    print(f"Merging {len(batch_dirs)} batches into {outdir}")
+    # old merged files might belong to histograms that are not produced anymore
+    shutil.rmtree(os.path.join(outdir, "hists"), ignore_errors=True)
+    merge_hists(batch_dirs, outdir, hist_store)
+    cutflows = []
+    for batch_dir in batch_dirs:
+        with open(os.path.join(batch_dir, "cutflows.json")) as f:
+            cutflows.append(json.load(f))
+    with open(os.path.join(outdir, "cutflows.json"), "w") as f:
+        json.dump(merge_cutflows(cutflows), f, indent=4)
+
+
+def write_batch_config(config, datasets, path):
+    config = dict(config)
+    for group in ("exp_datasets", "mc_datasets"):
+        config[group] = {dsname: sorted(files) for dsname, files in datasets[group].items()}
+    with open(path, "w") as f:
+        json.dump(config, f, indent=4)
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    pepper_args = []
+    if "--" in argv:
+        pepper_args = argv[argv.index("--") + 1:]
+        argv = argv[:argv.index("--")]
+
+    parser = ArgumentParser(
+        description="Process only new files of the datasets and merge with earlier outputs")
+    parser.add_argument("processor", help="Processor file, e.g. stau_processor_signal.py")
+    parser.add_argument("config", help="Pepper config")
+    parser.add_argument("-o", "--outdir", required=True, help="Output directory")
+    parser.add_argument("--datasets", nargs="*", default=None,
+                        help="Only consider these datasets")
+    parser.add_argument("--on-change", choices=["reprocess", "flag"], default="reprocess",
+                        help="What to do with batches containing changed or removed files")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Only print which files would be processed")
+    parser.add_argument("--merge-only", action="store_true",
+                        help="Do not process, only merge the finished batches")
+    parser.add_argument("--hist-store", action="store_true",
+                        help=f"Merge the histograms into hists/{STORE_NAME}")
+    args = parser.parse_args(argv)
+
+    os.makedirs(os.path.join(args.outdir, "batches"), exist_ok=True)
+    manifest = load_manifest(args.outdir)
+
+    if args.merge_only:
+        merge_outputs(args.outdir, manifest, args.hist_store)
+        sys.exit(0)
+
+    config = load_config(args.config)
+    current = expand_datasets(config, args.datasets)
+    to_process, dirty = compare_files(current, manifest)
+
+    for name, reasons in sorted(dirty.items()):
+        for reason, filename in reasons:
+            print(f"{name}: {reason} {filename}")
+        if args.on_change == "flag":
+            manifest["batches"][name]["flagged"] = sorted(f for _, f in reasons)
+            continue
+        # the batch is dropped, its still existing files are processed again
+        batch = manifest["batches"][name]
+        for group, datasets in batch["datasets"].items():
+            for dsname, files in datasets.items():
+                for filename in files:
+                    if dsname in current[group] and filename in current[group][dsname]:
+                        to_process[group].setdefault(dsname, {})[filename] = \
+                            current[group][dsname][filename]
+        if not args.dry_run:
+            batch["status"] = "superseded"
+
+    n_files = sum(len(files) for datasets in to_process.values()
+                  for files in datasets.values())
+    for group, datasets in to_process.items():
+        for dsname, files in datasets.items():
+            print(f"{dsname}: {len(files)} files to process")
+    if args.dry_run:
+        sys.exit(0)
+    if n_files == 0:
+        print("Nothing new to process")
+        save_manifest(args.outdir, manifest)
+        if len(dirty) > 0:
+            merge_outputs(args.outdir, manifest, args.hist_store)
+        sys.exit(0)
+
+    # a failed batch with the same input files is resumed from its statedata
+    name = None
+    for batch_name, batch in manifest["batches"].items():
+        if batch["status"] == "failed" and batch["datasets"] == to_process:
+            name = batch_name
+    if name is None:
+        name = f"batch_{len(manifest['batches']):03d}"
+    batch_dir = os.path.join(args.outdir, "batches", name)
+    os.makedirs(batch_dir, exist_ok=True)
+    batch_config = os.path.join(batch_dir, "config.json")
+    write_batch_config(config, to_process, batch_config)
+    manifest["batches"][name] = {"status": "running", "datasets": to_process}
+    save_manifest(args.outdir, manifest)
+
+    command = [sys.executable, "-m", "pepper.runproc", args.processor, batch_config,
+               "-o", batch_dir, "--statedata", os.path.join(batch_dir, "state.coffea")]
+    command += pepper_args
+    print(" ".join(command))
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        manifest["batches"][name]["status"] = "failed"
+        save_manifest(args.outdir, manifest)
+        print(f"pepper failed for {name}, rerun to resume")
+        sys.exit(result.returncode)
+
+    manifest["batches"][name]["status"] = "done"
+    save_manifest(args.outdir, manifest)
+    merge_outputs(args.outdir, manifest, args.hist_store)
@@ -1,8 +1,19 @@
 import uproot
 import numpy as np
+import awkward as ak
+import matplotlib
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-import sys
 import os
+from functools import partial
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+# Eta-phi displays of the PF candidates, LostTracks and GenParts around every
+# GenVisTau with a matched jet. The cones of all requested events are
+# extracted at once and the displays are rendered in a process pool:
+#   python plot_pfcand_etaphi_show.py nanoaod.root 1000 --cones cones.parquet --workers 8
+#   python plot_pfcand_etaphi_show.py cones.parquet --from-cones --max-plots 100
 
 # Define colors and markers for different PF candidate types, GenParticles, LostTracks, and Jets
 pf_particle_colors = {
@@ -31,38 +42,49 @@ gen_particle_colors = {
 lost_track_color = ('gray', 'h') # Lost tracks color and marker
 jet_color = ('blue', '--')  # Jet color and linestyle
 
-def determine_tau_decay_mode(types_gen, tau_children_mask):
+BRANCHES = [
+    "GenPart_vertexX",
+    "GenPart_vertexY",
+    "GenPart_vertexZ",
+    "PFCandidate_eta",
+    "PFCandidate_phi",
+    "PFCandidate_pdgId",
+    "PFCandidate_pt",
+    "PFCandidate_mass",
+    "GenPart_eta",
+    "GenPart_phi",
+    "GenPart_pdgId",
+    "GenPart_statusFlags",
+    "GenPart_pt",
+    "GenPart_mass",
+    "GenVisTau_eta",
+    "GenVisTau_phi",
+    "GenVisTau_genPartIdxMother",
+    "LostTrack_eta",
+    "LostTrack_phi",
+    "Jet_eta",
+    "Jet_phi",
+]
 
-    n_charged_hadrons = sum(1 for i, is_child in enumerate(tau_children_mask) if is_child and abs(types_gen[i]) == 211)
-    n_photons = sum(1 for i, is_child in enumerate(tau_children_mask) if is_child and abs(types_gen[i]) == 22)
-    n_electrons = sum(1 for i, is_child in enumerate(tau_children_mask) if is_child and abs(types_gen[i]) == 11)
-    n_muons = sum(1 for i, is_child in enumerate(tau_children_mask) if is_child and abs(types_gen[i]) == 13)
-    n_neutral_hadrons = sum(1 for i, is_child in enumerate(tau_children_mask) if is_child and abs(types_gen[i]) in [111, 130, 310, 311])
-
-    if n_muons > 0:
-        return "Muon Decay"
-    elif n_electrons > 0:
-        return "Electron Decay"
-    elif n_charged_hadrons == 1 and n_photons == 0 and n_neutral_hadrons == 0:
-        return "1-Prong Hadronic"
-    elif n_charged_hadrons == 1 and n_neutral_hadrons > 0:
-        return "1-Prong + Neutral Hadrons"
-    elif n_charged_hadrons == 3 and n_neutral_hadrons == 0:
-        return "3-Prong Hadronic"
-    elif n_charged_hadrons == 3 and n_neutral_hadrons > 0:
-        return "3-Prong + Neutral Hadrons"
-    else:
-        return "Other"
+def determine_tau_decay_mode(types_gen, tau_children_mask):
+    # name of the decay mode from the pdg ids of the tau children
+    children = np.abs(np.asarray(types_gen)[np.asarray(tau_children_mask, dtype=bool)])
+    index = decay_mode_index(np.count_nonzero(children == 211),
+                             np.count_nonzero(children == 22),
+                             np.count_nonzero(children == 11),
+                             np.count_nonzero(children == 13),
+                             np.count_nonzero(np.isin(children, [111, 130, 310, 311])))
+    return DECAY_MODES[int(index)]
 
 
 def plot_eta_phi(eta_pf, phi_pf, types_pf, energies_pf,
                  eta_gen, phi_gen, types_gen, energies_gen,
                  eta_lost, phi_lost, tau_index, event,
                  jet_eta=None, jet_phi=None, tau_children_mask=None, tau_vertex_x=None,
-                 tau_vertex_y=None, tau_vertex_z=None, tau_eta=None, tau_phi=None):
+                 tau_vertex_y=None, tau_vertex_z=None, tau_eta=None, tau_phi=None,
+                 outdir="display"):
 
     print(f"Plotting event {event}, tau {tau_index}")
-    print(tau_eta,jet_eta)
     
     fig, (ax1, ax2) = plt.subplots(1, 2, figsize=(36, 18))
 
@@ -230,128 +252,149 @@ def plot_eta_phi(eta_pf, phi_pf, types_pf, energies_pf,
     ax2.set_ylim(eta_min, eta_max)
 
     plt.tight_layout()
-    if os.path.isdir("display") is False:
-        os.makedirs("display")
-    plt.savefig(f"display/event_{event}_tau_{tau_index}.png")
+    os.makedirs(outdir, exist_ok=True)
+    plt.savefig(f"{outdir}/event_{event}_tau_{tau_index}.png")
     plt.close()
 
+def delta_r(eta1, phi1, eta2, phi2):
+    dphi = (phi1 - phi2 + np.pi) % (2 * np.pi) - np.pi
+    return np.sqrt((eta1 - eta2)**2 + dphi**2)
+
+
+def decay_mode_index(n_charged_hadrons, n_photons, n_electrons, n_muons, n_neutral_hadrons):
+    # vectorized version of determine_tau_decay_mode, index in DECAY_MODES
+    return np.select(
+        [n_muons > 0,
+         n_electrons > 0,
+         (n_charged_hadrons == 1) & (n_photons == 0) & (n_neutral_hadrons == 0),
+         (n_charged_hadrons == 1) & (n_neutral_hadrons > 0),
+         (n_charged_hadrons == 3) & (n_neutral_hadrons == 0),
+         (n_charged_hadrons == 3) & (n_neutral_hadrons > 0)],
+        [0, 1, 2, 3, 4, 5], default=6)
+
+
+DECAY_MODES = ["Muon Decay", "Electron Decay", "1-Prong Hadronic", "1-Prong + Neutral Hadrons",
+               "3-Prong Hadronic", "3-Prong + Neutral Hadrons", "Other"]
+
+
+def in_cone(taus, objects, dr):
+    # (event, tau, object) structure of the objects within dr of each tau
+    pairs = ak.cartesian({"tau": taus, "obj": objects}, axis=1, nested=True)
+    mask = delta_r(pairs.tau.eta, pairs.tau.phi, pairs.obj.eta, pairs.obj.phi) < dr
+    return ak.flatten(pairs.obj[mask], axis=1)
+
+
+def energy(obj):
+    return np.sqrt((obj.pt * np.cosh(obj.eta))**2 + obj.mass**2)
+
+
+def extract_cones(file_path, num_events, dr_cone=0.5, dr_jet=0.3):
+    """All GenVisTau cones of the first num_events events with a matched jet,
+    one record per tau with the PF candidates, GenParts and LostTracks
+    within dr_cone"""
+    tree = uproot.open(file_path)["Events"]
+    data = tree.arrays(BRANCHES, entry_stop=num_events)
+
+    pf = ak.zip({
+        "eta": data["PFCandidate_eta"], "phi": data["PFCandidate_phi"],
+        "pdgId": data["PFCandidate_pdgId"], "pt": data["PFCandidate_pt"],
+        "mass": data["PFCandidate_mass"]})
+    gen = ak.zip({
+        "eta": data["GenPart_eta"], "phi": data["GenPart_phi"],
+        "pdgId": data["GenPart_pdgId"], "pt": data["GenPart_pt"],
+        "mass": data["GenPart_mass"], "statusFlags": data["GenPart_statusFlags"]})
+    lost = ak.zip({"eta": data["LostTrack_eta"], "phi": data["LostTrack_phi"]})
+    jets = ak.zip({"eta": data["Jet_eta"], "phi": data["Jet_phi"]})
+    taus = ak.zip({
+        "eta": data["GenVisTau_eta"], "phi": data["GenVisTau_phi"],
+        "mother": data["GenVisTau_genPartIdxMother"]})
+
+    # the tau vertex is taken from the mother GenPart of the GenVisTau
+    mother = ak.where(taus.mother >= 0, taus.mother, 0)
+    vertex_x = ak.flatten(data["GenPart_vertexX"][mother])
+    vertex_y = ak.flatten(data["GenPart_vertexY"][mother])
+    vertex_z = ak.flatten(data["GenPart_vertexZ"][mother])
+    has_mother = ak.to_numpy(ak.flatten(taus.mother >= 0))
+
+    pf_cone = in_cone(taus, pf, dr_cone)
+    gen_cone = in_cone(taus, gen, dr_cone)
+    lost_cone = in_cone(taus, lost, dr_cone)
+    jet = ak.firsts(in_cone(taus, jets, dr_jet), axis=1)
+
+    # isTauDecayProduct
+    is_child = (gen_cone.statusFlags & (1 << 4)) != 0
+    pdg = abs(gen_cone.pdgId)
+    count = lambda mask: ak.to_numpy(ak.sum(is_child & mask, axis=-1))
+    decay_mode = decay_mode_index(
+        count(pdg == 211), count(pdg == 22), count(pdg == 11), count(pdg == 13),
+        count((pdg == 111) | (pdg == 130) | (pdg == 310) | (pdg == 311)))
+
+    event = ak.flatten(ak.broadcast_arrays(np.arange(len(taus)), taus.eta)[0])
+    cones = ak.zip({
+        "event": event,
+        "tau_index": ak.flatten(ak.local_index(taus.eta, axis=1)),
+        "tau_eta": ak.flatten(taus.eta),
+        "tau_phi": ak.flatten(taus.phi),
+        "vertex_x": vertex_x,
+        "vertex_y": vertex_y,
+        "vertex_z": vertex_z,
+        "jet_eta": ak.fill_none(jet.eta, np.nan),
+        "jet_phi": ak.fill_none(jet.phi, np.nan),
+        "decay_mode": decay_mode,
+        "pf": ak.zip({"eta": pf_cone.eta, "phi": pf_cone.phi, "pdgId": pf_cone.pdgId,
+                      "energy": energy(pf_cone)}),
+        "gen": ak.zip({"eta": gen_cone.eta, "phi": gen_cone.phi, "pdgId": gen_cone.pdgId,
+                       "energy": energy(gen_cone), "is_tau_child": is_child}),
+        "lost": lost_cone,
+    }, depth_limit=1)
+    # only taus with a matched jet are displayed
+    return cones[has_mother & ~ak.to_numpy(ak.is_none(jet))]
+
+
+def render_cone(cone, outdir="display"):
+    pf = cone["pf"]
+    gen = cone["gen"]
+    lost = cone["lost"]
+    column = lambda objs, field: np.array([obj[field] for obj in objs])
+    plot_eta_phi(column(pf, "eta"), column(pf, "phi"), column(pf, "pdgId"), column(pf, "energy"),
+                 column(gen, "eta"), column(gen, "phi"), column(gen, "pdgId"), column(gen, "energy"),
+                 column(lost, "eta"), column(lost, "phi"), cone["tau_index"], cone["event"],
+                 cone["jet_eta"], cone["jet_phi"], column(gen, "is_tau_child"),
+                 cone["vertex_x"], cone["vertex_y"], cone["vertex_z"],
+                 cone["tau_eta"], cone["tau_phi"], outdir=outdir)
+
+
 def main():
-    # Get the file path and number of events to analyze from command line arguments
-    if len(sys.argv) != 3:
-        print("Usage: python script.py <path_to_root_file> <number_of_events>")
-        sys.exit(1)
-
-    file_path = sys.argv[1]
-    num_events = int(sys.argv[2])
-
-    # Open the ROOT file
-    file = uproot.open(file_path)
-    tree = file["Events"]
-
-    # Define the branches to extract
-    branches = [
-        "GenPart_vertexX",
-        "GenPart_vertexY",
-        "GenPart_vertexZ",
-        "PFCandidate_eta",
-        "PFCandidate_phi",
-        "PFCandidate_pdgId",
-        "PFCandidate_pt",
-        "PFCandidate_mass",  # Add this line
-        "GenPart_eta",
-        "GenPart_phi",
-        "GenPart_pdgId",
-        "GenPart_status",
-        "GenPart_statusFlags",
-        "GenPart_pt",
-        "GenPart_mass",  # Add this line
-        "GenVisTau_eta",
-        "GenVisTau_phi",
-        "LostTrack_eta",
-        "LostTrack_phi",
-        "Jet_eta",
-        "Jet_phi",
-    ]
-
-    # Read the branches
-    data = tree.arrays(branches, library="np")
-
-    # Extract the variables
-    eta_pf = data["PFCandidate_eta"]
-    phi_pf = data["PFCandidate_phi"]
-    pdg_id_pf = data["PFCandidate_pdgId"]
-    pt_pf = data["PFCandidate_pt"]
-    mass_pf = data["PFCandidate_mass"]  # Add this line
-
-    eta_gen = data["GenPart_eta"]
-    phi_gen = data["GenPart_phi"]
-    pdg_id_gen = data["GenPart_pdgId"]
-    status_gen = data["GenPart_status"]
-    status_flags_gen = data["GenPart_statusFlags"]
-    pt_gen = data["GenPart_pt"]
-    mass_gen = data["GenPart_mass"]  # Add this line
-    
-    eta_vis_tau = data["GenVisTau_eta"]
-    phi_vis_tau = data["GenVisTau_phi"]
-    
-    eta_lost = data["LostTrack_eta"]
-    phi_lost = data["LostTrack_phi"]
-    eta_jet = data["Jet_eta"]
-    phi_jet = data["Jet_phi"]
-
-    # Iterate over events and GenVisTaus and plot the PF candidates and GenParticles close to each
-    for event_index in range(min(num_events, len(eta_vis_tau))):
-        for tau_index in range(len(eta_vis_tau[event_index])):
-            tau_eta = eta_vis_tau[event_index][tau_index]
-            tau_phi = phi_vis_tau[event_index][tau_index]
-            # Find GenPart corresponding to tau or stau (only last copy)
-            for gen_index in range(len(eta_gen[event_index])):
-                if abs(pdg_id_gen[event_index][gen_index]) == 15 and status_gen[event_index][gen_index] == 2 and (status_flags_gen[event_index][gen_index] & (1 << 12)):  # Check if GenVisTau is a tau or stau
-
-                    # Define delta R condition for matching
-                    delta_r_pf = np.sqrt((eta_pf[event_index] - tau_eta)**2 + (phi_pf[event_index] - tau_phi)**2)
-                    delta_r_gen = np.sqrt((eta_gen[event_index] - tau_eta)**2 + (phi_gen[event_index] - tau_phi)**2)
-                    delta_r_lost = np.sqrt((eta_lost[event_index] - tau_eta)**2 + (phi_lost[event_index] - tau_phi)**2)
-
-                    # Mask for PF candidates, GenParticles, and LostTracks close to GenVisTau
-                    mask_pf = delta_r_pf < 0.5
-                    mask_gen = delta_r_gen < 0.5
-                    mask_lost = delta_r_lost < 0.5
-
-                    eta_pf_tau = eta_pf[event_index][mask_pf]
-                    phi_pf_tau = phi_pf[event_index][mask_pf]
-                    types_pf_tau = pdg_id_pf[event_index][mask_pf]
-                    pt_pf_tau = pt_pf[event_index][mask_pf]
-                    eta_gen_tau = eta_gen[event_index][mask_gen]
-                    phi_gen_tau = phi_gen[event_index][mask_gen]
-                    types_gen_tau = pdg_id_gen[event_index][mask_gen]
-                    pt_gen_tau = pt_gen[event_index][mask_gen]
-                    eta_lost_tau = eta_lost[event_index][mask_lost]
-                    phi_lost_tau = phi_lost[event_index][mask_lost]
-                    mass_pf_tau = mass_pf[event_index][mask_pf]
-                    mass_gen_tau = mass_gen[event_index][mask_gen]
-
-                    # Determine which GenParticles are children of tau
-                    tau_children_mask = [(status_flags_gen[event_index][mask_gen][i] & (1 << 4)) != 0 for i in range(len(eta_gen_tau))]
-
-                    # Find reconstructed jet that matches GenVisTau
-                    jet_match_idx = None
-                    for jet_index in range(len(eta_jet[event_index])):
-                        delta_r_jet = np.sqrt((eta_jet[event_index][jet_index] - tau_eta)**2 + (phi_jet[event_index][jet_index] - tau_phi)**2)
-                        if delta_r_jet < 0.3:
-                            jet_match_idx = jet_index
-                            break
-
-                    jet_eta = eta_jet[event_index][jet_match_idx] if jet_match_idx is not None else None
-                    jet_phi = phi_jet[event_index][jet_match_idx] if jet_match_idx is not None else None
-
-                    # calculate energyies of pf candidates and gen particles
-                    energies_pf = np.sqrt((pt_pf_tau*np.cosh(eta_pf_tau))**2 + mass_pf_tau**2)
-                    energies_gen = np.sqrt((pt_gen_tau*np.cosh(eta_gen_tau))**2 + mass_gen_tau**2)
-
-                    if jet_eta is not None and jet_phi is not None:
-                        # Plot eta-phi distribution for PF candidates, LostTracks, GenParticles, and Jet close to the current GenVisTau or stau
-                        plot_eta_phi(eta_pf_tau, phi_pf_tau, types_pf_tau, energies_pf, eta_gen_tau, phi_gen_tau, types_gen_tau, energies_gen, eta_lost_tau, phi_lost_tau, tau_index, event_index, jet_eta, jet_phi, tau_children_mask, data["GenPart_vertexX"][event_index][gen_index], data["GenPart_vertexY"][event_index][gen_index], data["GenPart_vertexZ"][event_index][gen_index], tau_eta, tau_phi)
+    parser = ArgumentParser(
+        description="Eta-phi displays of the PF candidates and GenParts around GenVisTaus")
+    parser.add_argument("file_path", help="NanoAOD file, or a cone file with --from-cones")
+    parser.add_argument("num_events", type=int, nargs="?", default=None,
+                        help="Number of events to analyze")
+    parser.add_argument("--cones", default=None, help="Write the selected cones to this parquet file")
+    parser.add_argument("--from-cones", action="store_true",
+                        help="file_path is a cone file written with --cones")
+    parser.add_argument("--no-plots", action="store_true", help="Only extract the cones")
+    parser.add_argument("--max-plots", type=int, default=None)
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--outdir", default="display")
+    args = parser.parse_args()
+
+    if args.from_cones:
+        cones = ak.from_parquet(args.file_path)
+    else:
+        cones = extract_cones(args.file_path, args.num_events)
+    print(f"Number of tau cones: {len(cones)}")
+    for index, name in enumerate(DECAY_MODES):
+        print(f"    {name}: {np.sum(ak.to_numpy(cones.decay_mode) == index)}")
+    if args.cones is not None:
+        ak.to_parquet(cones, args.cones)
+    if args.no_plots:
+        return
+
+    if args.max_plots is not None:
+        cones = cones[:args.max_plots]
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        list(pool.map(partial(render_cone, outdir=args.outdir), ak.to_list(cones), chunksize=4))
 
 if __name__ == "__main__":
     main()
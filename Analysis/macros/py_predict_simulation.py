@@ -1,223 +1,123 @@
-import awkward as ak
+import json
 import numpy as np
-import numba as nb
-import scipy
-import glob, os
-import plotext as plt
-# import matplotlib.pyplot as plt
-
-
-n_events = 1000000
-scale_exp = 1.6
-# scale_exp = 4.0
-
-# simulate events with n-jets each having the score 0-1
-def truncated_exp_OP(a,b,scale_exp,how_many):
-    rands = np.random.exponential(scale=scale_exp, size=how_many)
-    rands = rands[(rands>a) & (rands<b)]
-    return rands
-
-
-def binomial(p, n, k):
-    # p -> scalar
-    # n -> list of n
-    # k -> dcalar (number of jets)
-    n = n.astype(int)
-    C = scipy.special.factorial(n) 
-    C = C / scipy.special.factorial(k)
-    C = C / scipy.special.factorial(n-k)
-    prob = np.power(p, k) * np.power(1-p, n-k)
-    return C * prob 
-    
-
-def gen_experiment():
-
-    print("generating replica ...")
-
-
-    n_jets = truncated_exp_OP(2,20, scale_exp, n_events).astype(int) # starts from 2 jets to 10
-    # n_jets = np.full((n_events), 3)
-    print("mean n-jets:", np.mean(n_jets))
-    
-    # generate score for each event
-    score_p = []
-    for jets in n_jets:
-        # score_p.append( np.random.uniform(0.0,1.0,jets) )
-        rands = np.random.triangular(0.0, min((20-jets)/40, 1.0), 1.0, jets)
-        # rands = np.random.triangular(0.0, 16.8/40, 1.0, jets)
-        score_p.append( rands )
-    score_p = ak.Array(score_p)
-
-    
-    
-    # jets = jets[jets.disTauTag_score1 > 0.17]
-    # n_jets = ak.num(jets, axis=1)
-    
-    # jets = jets[n_jets == 2]
-    # n_jets = ak.num(jets, axis=1)
-    
-
-    print("number of jets:", ak.sum(n_jets))
-    print("mean n-jets:", np.mean(n_jets))
-    
-    # jets that pass the score
-    # score_thrs = 0.01 # to be compatitive with our fake_rate
-    # score_thrs = 1.0 - score_thrs
-    score_thrs = 0.9972
-    print("score threshold:", score_thrs)
-    pass_ = (score_p >= (score_thrs))
-    jets_pass = score_p[pass_]
-    jets_nopass = score_p[~pass_]
-    
-    n_jets_pass = ak.num(jets_pass, axis=1)
-    n_pass = ak.sum(n_jets_pass)
-    n_jets_nopass = ak.num(jets_nopass, axis=1)
-    n_notpass = ak.sum(n_jets_nopass)
-    assert(n_pass != 0)
-    
-    f = n_pass / ak.sum(n_jets)
-    print("Number of passing jets:", n_pass)
-    print("Number of not passing jets:", n_notpass)
-    print("Fake rate:", f)
-    
-    # rate_hist = FakeRate(jets, 0.9972)
-
-    # count number of passes:
-    events_bin0 = (n_jets_pass == 0)
-    events_bin1 = (n_jets_pass == 1)
-    events_bin2 = (n_jets_pass == 2)
-    events_bin3 = (n_jets_pass == 3)
-    events_overlow = (n_jets_pass > 3)
-
-    jets_events_bin0 = score_p[ events_bin0 ]
-    jets_events_bin1 = score_p[ events_bin1 ]
-    jets_events_bin2 = score_p[ events_bin2 ]
-    jets_events_bin3 = score_p[ events_bin3 ]
-    jets_events_overlow = score_p[ events_overlow ]
-
-
-    print("events_bin0:", ak.sum(events_bin0))
-    print("events_bin1:", ak.sum(events_bin1))
-    print("events_bin2:", ak.sum(events_bin2))
-    print("events_bin3:", ak.sum(events_bin3))
-    print("events_overlow:", ak.sum(events_overlow))
-    
-
-    # prediction from bin 0 to 1
-    per_event_sfs_0to1 = ak.num(jets_events_bin0) * f
-    predict_0to1 = ak.sum( per_event_sfs_0to1 )
-    print("predict 0->1:", predict_0to1)
-
-    # prediction from bin 0 to 2
-    fake_rates_0 = ak.full_like(jets_events_bin0, f)
-    combinations = ak.combinations(fake_rates_0, 2, axis=1) # to have all possible combinations of 2 jets
-    combinations_unzipped = ak.unzip(combinations)
-    products = combinations_unzipped[0] * combinations_unzipped[1]
-    per_event_sfs_0to2 = ak.sum(products, axis=1)
-    predict_0to2 = ak.sum(per_event_sfs_0to2, axis=0)
-    print("predict 0->2:", predict_0to2)
-    
-    # prediction from bin 0 to 2 in a binomial way
-    # fake_rates_0 = ak.full_like(jets_events_bin0, f)
-    # fake_rates_0_njets = ak.num(fake_rates_0, axis = -1)
-    # per_event_sfs_0to2_binom = binomial(f, ak.to_numpy(fake_rates_0_njets), 2)
-    # predict_0to2_binom = ak.sum(per_event_sfs_0to2_binom, axis=0)
-    # print("predict 0->2:", predict_0to2_binom, "(calculated in a binomial way)")
-    
-    # # prediction from bin 0 to 3
-    # fake_rates_0 = ak.full_like(jets_events_bin0, f)
-    # combinations = ak.combinations(fake_rates_0, 3, axis=1) # to have all possible combinations of 3 jets
-    # combinations_unzipped = ak.unzip(combinations)
-    # products = combinations_unzipped[0] * combinations_unzipped[1] * combinations_unzipped[2]
-    # per_event_sfs_0to3 = ak.sum(products, axis=1)
-    # predict_0to3 = ak.sum(per_event_sfs_0to3, axis=0)
-    # print("predict 0->3:", predict_0to3)
-    
-    # prediction from bin 1 to 2
-    jets_events_bin1_notag = jets_events_bin1[ (jets_events_bin1 < score_thrs) ] # events with 1 tag
-    per_event_sfs_1to2 = ak.num(jets_events_bin1_notag, axis=-1) * f
-    predict_1to2 = ak.sum( per_event_sfs_1to2 )
-    print("predict 1->2:", predict_1to2, "corrected:", predict_1to2/2.0)
-    
-    '''
-    # prediction from bin 1 to 2 calculated as a ratio of weights
-    jets_score_bin1 = ak.full_like(jets_events_bin1, f)
-    denominator = ak.sum(jets_score_bin1, axis=-1)
-    combinations = ak.combinations(jets_score_bin1, 2, axis=1)
-    combinations_unzipped = ak.unzip(combinations)
-    products = combinations_unzipped[0] * combinations_unzipped[1]
-    numerator = ak.sum(products, axis=1)
-    corrected_predict_1to2 = numerator / denominator
-    predict_corrected_predict_1to2 = ak.sum( corrected_predict_1to2 )
-    print("corrected predict 1->2 ratio:", predict_corrected_predict_1to2)
-    
-    # prediction from bin 1 to 2 with extra factor two
-    jets_events_bin1_notag = jets_events_bin1[ (jets_events_bin1 < (1.0 - score_thrs)) ] # events with 1 tag
-    per_event_sfs_1to2 = ak.num(jets_events_bin1_notag, axis=-1) * f
-    predict_corrected_predict_1to2_v2 = ak.sum( per_event_sfs_1to2 / 2.0)
-    print("predict 1->2:", predict_corrected_predict_1to2_v2)
-    
-    per_event_sfs_1to2 = ak.num(jets_events_bin1, axis=-1) * f
-    predict_corrected_predict_1to2_v3 = ak.sum( per_event_sfs_1to2 / 2.0)
-    print("predict 1->2:", predict_corrected_predict_1to2_v3)
-    '''
-    
-    # prediction from bin 1 to 3
-    # jets_events_bin1_notag = jets_events_bin1[ (jets_events_bin1 < (1.0 - score_thrs)) ] # events with 1 tag
-    # fake_rates_1 = ak.full_like(jets_events_bin1_notag, f)
-    # combinations = ak.combinations(fake_rates_1, 2, axis=1) # to have all possible combinations of 3 jets
-    # combinations_unzipped = ak.unzip(combinations)
-    # products = combinations_unzipped[0] * combinations_unzipped[1]
-    # per_event_sfs_1to3 = ak.sum(products, axis=1)
-    # predict_1to3 = ak.sum( per_event_sfs_1to3 )
-    # print("predict 1->3:", predict_1to3)
-    
-    # # prediction from bin 2 to 3
-    # jets_events_bin2_notag = jets_events_bin2[ (jets_events_bin2 < (1.0 - score_thrs)) ] # events with 1 tag
-    # per_event_sfs_2to3 = ak.num(jets_events_bin2_notag, axis=-1) * f
-    # predict_2to3 = ak.sum( per_event_sfs_2to3 )
-    # print("predict 2->3:", predict_2to3)
-    
-    print("Prediction for two jet events only:")
-    alternative_from0to1 = ak.sum(events_bin0) * 2 * f / (1-f)
-    alternative_from1to2 = ak.sum(events_bin1) * f / (2 * (1-f))
-    alternative_from0to2 = ak.sum(events_bin0) * f**2 / ((1-f)**2)
-    print("alternative 0->1:", alternative_from0to1)
-    print("alternative 1->2:", alternative_from1to2)
-    print("alternative 0->2:", alternative_from0to2)
-    
-    # print("Prediction for three jet events only:")
-    # alternative_from0to1 = ak.sum(events_bin0) * 3 * f / (1-f)
-    # alternative_from1to2 = ak.sum(events_bin1) * f / (1-f)
-    # alternative_from0to2 = ak.sum(events_bin0) * 3 * f**2 / ((1-f)**2)
-    # print("alternative 0->1:", alternative_from0to1)
-    # print("alternative 1->2:", alternative_from1to2)
-    # print("alternative 0->2:", alternative_from0to2)
-
-    # return predict_0to2, predict_1to2, ak.sum(events_bin2), \
-    #        predict_0to3, predict_2to3, ak.sum(events_bin3)
-
-    return ak.sum(events_bin2), \
-           predict_0to2, \
-           predict_1to2/2.0
-
-true, from0to2, from1to2 = [], [], []
-for exp_replica in range(100):
-    print("------------------->", exp_replica)
-    pred = gen_experiment()
-    true.append(pred[0])
-    from0to2.append(pred[1])
-    from1to2.append(pred[2])
-
-m_true = np.mean(true)
-m_from0to2 = np.mean(from0to2)
-m_from1to2 = np.mean(from1to2)
-
-
-plt.hist(true, bins=30, label = f"true bin 2 ({m_true})")
-plt.hist(from0to2, bins=50, label = f"predict 0->2 ({m_from0to2})")
-plt.hist(from1to2, bins=50, label = f"predict 1->2 ({m_from1to2})")
-
-plt.legend(loc="upper right")
-plt.show()
-plt.savefig('predict_cor.png')
\ No newline at end of file
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+
+# Toy closure test of the fake-rate prediction.
+# Every replica has n_events events with 2-19 jets (truncated exponential
+# in the jet multiplicity) and a triangular score distribution per jet.
+# The fake rate is measured in the replica and the yields of the 1 and 2 tag
+# bins are predicted with the formulas of predict_yield in
+# stau_processor_signal.py, generalised to n jets with the odds r = f/(1-f):
+#   0->1: sum_i r_i    0->2: sum_i<j r_i r_j    1->2: (sum_i<j r_i r_j) / (sum_i r_i)
+# which are identical to predict_yield for two jet events.
+# All jets of a replica are generated as one flat array (+ offsets) and the
+# replicas are distributed over a process pool, e.g.:
+#   python py_predict_simulation.py --replicas 1000 --threshold 0.99 0.9972 --scale-exp 1.6 4.0 --workers 8
+
+
+def gen_jets(rng, n_events, scale_exp, n_min=2, n_max=20):
+    # number of jets from an exponential truncated to (n_min, n_max)
+    # sampled with the inverse CDF, so every replica has exactly n_events
+    u = rng.random(n_events)
+    lo, hi = np.exp(-n_min / scale_exp), np.exp(-n_max / scale_exp)
+    n_jets = (-scale_exp * np.log(lo - u * (lo - hi))).astype(np.int64)
+    n_jets = np.clip(n_jets, n_min, n_max - 1)
+    mode = np.minimum((20 - n_jets) / 40, 1.0)
+    score = rng.triangular(0.0, np.repeat(mode, n_jets), 1.0)
+    return n_jets, score
+
+
+def predict(n_jets, score, thresholds):
+    """Observed yields and predictions for every score threshold"""
+    event = np.repeat(np.arange(len(n_jets)), n_jets)
+    results = []
+    for thr in thresholds:
+        passed = score >= thr
+        n_pass = np.bincount(event, weights=passed, minlength=len(n_jets))
+        f = passed.sum() / len(score)
+        # odds per jet, constant here but kept per jet as in predict_yield
+        r = np.full(len(score), f / (1 - f))
+        e1 = np.bincount(event, weights=r, minlength=len(n_jets))
+        e2 = (e1**2 - np.bincount(event, weights=r**2, minlength=len(n_jets))) / 2
+        bin0 = n_pass == 0
+        bin1 = n_pass == 1
+        results.append({
+            "threshold": thr,
+            "fake_rate": f,
+            "bin0": int(bin0.sum()),
+            "bin1": int(bin1.sum()),
+            "bin2": int((n_pass == 2).sum()),
+            "predict_0to1": float(e1[bin0].sum()),
+            "predict_0to2": float(e2[bin0].sum()),
+            "predict_1to2": float((e2[bin1] / e1[bin1]).sum()),
+        })
+    return results
+
+
+def run_replicas(seed, n_replicas, n_events, scale_exp, thresholds):
+    results = []
+    for seq in np.random.SeedSequence(seed).spawn(n_replicas):
+        rng = np.random.default_rng(seq)
+        n_jets, score = gen_jets(rng, n_events, scale_exp)
+        results.append(predict(n_jets, score, thresholds))
+    return results
+
+
+def summary(replicas, thresholds):
+    for i, thr in enumerate(thresholds):
+        res = {key: np.array([rep[i][key] for rep in replicas])
+               for key in replicas[0][i] if key != "threshold"}
+        print(f"  threshold {thr}: fake rate {res['fake_rate'].mean():.5f}")
+        for target, pred in (("bin1", "predict_0to1"), ("bin2", "predict_0to2"),
+                             ("bin2", "predict_1to2")):
+            true, p = res[target], res[pred]
+            print(f"    {pred:<13} {p.mean():12.2f} +- {p.std():9.2f}   "
+                  f"true {target} {true.mean():12.2f} +- {true.std():9.2f}   "
+                  f"closure {p.mean() / true.mean() if true.mean() > 0 else np.nan:.4f}")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Toy closure test of the fake-rate prediction")
+    parser.add_argument("--replicas", type=int, default=100)
+    parser.add_argument("--events", type=int, default=1000000, help="Events per replica")
+    parser.add_argument("--scale-exp", type=float, nargs="+", default=[1.6])
+    parser.add_argument("--threshold", type=float, nargs="+", default=[0.9972])
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--per-task", type=int, default=10, help="Replicas per pool task")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=None, help="JSON file with all replicas")
+    parser.add_argument("--plot", action="store_true", help="Show terminal histograms (plotext)")
+    args = parser.parse_args()
+
+    output = {}
+    with ProcessPoolExecutor(max_workers=args.workers) as pool:
+        for i_scale, scale_exp in enumerate(args.scale_exp):
+            # the seed of a task only depends on its position, results do not
+            # depend on the number of workers
+            tasks = []
+            for start in range(0, args.replicas, args.per_task):
+                n = min(args.per_task, args.replicas - start)
+                seed = [args.seed, i_scale, start]
+                tasks.append(pool.submit(run_replicas, seed, n, args.events,
+                                         scale_exp, args.threshold))
+            replicas = [rep for task in tasks for rep in task.result()]
+            print(f"scale_exp {scale_exp} ({len(replicas)} replicas):")
+            summary(replicas, args.threshold)
+            output[str(scale_exp)] = replicas
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(output, f)
+
+    if args.plot:
+        import plotext as plt
+        replicas = output[str(args.scale_exp[0])]
+        true = [rep[0]["bin2"] for rep in replicas]
+        from0to2 = [rep[0]["predict_0to2"] for rep in replicas]
+        from1to2 = [rep[0]["predict_1to2"] for rep in replicas]
+        plt.hist(true, bins=30, label=f"true bin 2 ({np.mean(true)})")
+        plt.hist(from0to2, bins=50, label=f"predict 0->2 ({np.mean(from0to2)})")
+        plt.hist(from1to2, bins=50, label=f"predict 1->2 ({np.mean(from1to2)})")
+        plt.show()
+        plt.savefig('predict_cor.png')
@@ -6,7 +6,7 @@ import matplotlib.pyplot
 import os
 import aghast
 
-#import uproot
+import uproot
 #uproot.open.defaults["xrootd_handler"] = uproot.source.xrootd.MultithreadedXRootDSource
 
 import glob
@@ -22,6 +22,7 @@ import numpy as np
 import utils.utils as utils
 import utils.geometry_utils as geometry_utils_jit
 import utils.geometry_utils
+from utils.gen_ancestry import add_gen_ancestry, gen_daughters
 
 from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
 
@@ -40,13 +41,6 @@ def conv_to_root(coffea_hist, name):
 def stand_arr(array):
     return ak.fill_none( ak.flatten(array), -1)
 
-def transverse_length(gen_particle):
-    perent = gen_particle.parent
-    return np.sqrt( (perent.vertexX-gen_particle.vertexX)**2 +
-                    (perent.vertexY-gen_particle.vertexY)**2
-                    )
-    
-
 class JetdR2D(object):
 
     @staticmethod
@@ -348,12 +342,14 @@ class EfficiencyStudy(object):
 
         objects["match_genJet_to_genTau", "jet_E"] = objects["match_genJet_to_genTau"].energy
         objects["match_genJet_to_genTau", "tau_E"] = objects["match_genTau_to_genJet"].energy[(objects["match_genTau_to_genJet"].energy != None)]
-        objects["match_genJet_to_genTau", "tau_disp"] = objects["match_genTau_to_genJet"].parent.vertexRho[(objects["match_genTau_to_genJet"].energy != None)]
+        objects["match_genJet_to_genTau", "tau_disp"] = objects["match_genTau_to_genJet"].vertexRho[(objects["match_genTau_to_genJet"].energy != None)]
         objects["match_genJet_to_genTau", "ratio_E"]  = objects["match_genJet_to_genTau", "jet_E"] / objects["match_genJet_to_genTau", "tau_E"]
         
         # Select tau (that mathed to the jet children) that not None 
-        tau = objects["match_genTau_to_genJet"].parent
-        tau_children = tau[(~ak.is_none(tau.pdgId,-1))].children
+        tau_vis = objects["match_genTau_to_genJet"]
+        tau_vis = tau_vis[(~ak.is_none(tau_vis, -1))]
+        # daughters of the decaying tau (tauIdx of the GenVisTau, see add_gen_ancestry)
+        tau_children = gen_daughters(events.GenPart, ak.fill_none(tau_vis.tauIdx, -1))
         # Select only visible tau children (drop neutrino)
         tau_children = tau_children[(abs(tau_children.pdgId)!=16)]
 
@@ -371,7 +367,7 @@ class EfficiencyStudy(object):
         tau_children_E = ak.sum(tau_children.energy, axis=2)
 
         tau_vis_E = objects["match_genTau_to_genJet"][(~ak.is_none(tau.energy,-1))].energy
-        tau_vis_disp = objects["match_genTau_to_genJet"][(~ak.is_none(tau.energy,-1))].parent.vertexRho
+        tau_vis_disp = objects["match_genTau_to_genJet"][(~ak.is_none(tau.energy,-1))].vertexRho
 
         # print(tau_tau_children_in_cone_E.to_list())
         # print(tau_tau_children_E.to_list())
@@ -392,19 +388,19 @@ class EfficiencyStudy(object):
         out["gen_tau_pt"].fill(
             dataset = events.metadata["dataset"],
             gen_tau_pt = stand_arr( objects["genTau"].pt ),
-            Lxy = stand_arr( objects["genTau"].parent.vertexRho ),
+            Lxy = stand_arr( objects["genTau"].vertexRho ),
             )
 
         out["gen_jet_pt"].fill(
             dataset = events.metadata["dataset"],
             gen_tau_pt = stand_arr( objects["match_genTau_to_genJet"].pt ),
-            Lxy = stand_arr( objects["match_genTau_to_genJet"].parent.vertexRho ),
+            Lxy = stand_arr( objects["match_genTau_to_genJet"].vertexRho ),
             )
    
         out["gen_jet_pt_reco"].fill(
             dataset = events.metadata["dataset"],
             gen_tau_pt = stand_arr( objects["match_genTau_to_recoJet"].pt ),
-            Lxy = stand_arr( objects["match_genTau_to_recoJet"].parent.vertexRho ),
+            Lxy = stand_arr( objects["match_genTau_to_recoJet"].vertexRho ),
             )
 
         # out["gen_energy_ratio"].fill(
@@ -431,21 +427,21 @@ class EfficiencyStudy(object):
         #     dataset = events.metadata["dataset"],
         #     pt_ratio = stand_arr( objects["match_recoJet_to_genJet"].pt / objects["match_genJet_to_recoJet_and_genTau"].pt  ),
         #     pt_gen = stand_arr( objects["match_genJet_to_recoJet_and_genTau"].pt ),
-        #     Lxy = stand_arr( objects["match_genTau_to_genJet_and_recoJet"].parent.vertexRho ),
+        #     Lxy = stand_arr( objects["match_genTau_to_genJet_and_recoJet"].vertexRho ),
         #     )
 
         # out["pt_ratio_visTau"].fill(
         #     dataset = events.metadata["dataset"],
         #     pt_ratio = stand_arr( objects["match_recoJet"].pt /objects["match_genTau_to_recoJet"].pt  ),
         #     pt_gen = stand_arr( objects["match_genTau_to_recoJet"].pt ),
-        #     Lxy = stand_arr( objects["match_genTau_to_recoJet"].parent.vertexRho ),
+        #     Lxy = stand_arr( objects["match_genTau_to_recoJet"].vertexRho ),
         #     )
 
         # out["pt_resolution_visTau"].fill(
         #     dataset = events.metadata["dataset"],
         #     pt_resolution = stand_arr( (objects["match_recoJet"].pt - objects["match_genTau_to_recoJet"].pt) /objects["match_genTau_to_recoJet"].pt  ),
         #     pt_gen = stand_arr( objects["match_genTau_to_recoJet"].pt ),
-        #     Lxy = stand_arr( objects["match_genTau_to_recoJet"].parent.vertexRho ),
+        #     Lxy = stand_arr( objects["match_genTau_to_recoJet"].vertexRho ),
         # )
         
         '''
@@ -469,24 +465,38 @@ class JetMatching(coffea.processor.ProcessorABC):
     def accumulator(self):
         return self._accumulator
 
-    def get_jets_score(self, _metadata): 
+    def get_jets_score(self, events):
         '''
         parse distautag score from separate files
         '''
-       
-        # file_path = self.tag_ids_files[_metadata['dataset']][_metadata['filename']]
-        # print(file_path)
-        # print(_metadata['entrystart'])
-        # print(_metadata['entrystop'])
-        # exit()
+        # the score files are friends of the NanoAOD files: same events in
+        # the same order, only the jet table is stored
+        metadata = events.metadata
+        file_path = self.tag_ids_files[metadata['dataset']][metadata['filename']]
+        with uproot.open(file_path) as score_file:
+            tree = score_file["Events"]
+            branches = ["run", "luminosityBlock", "event", "nJet"]
+            score_branches = [b for b in tree.keys() if b.startswith("Jet_disTauTag")]
+            scores = tree.arrays(branches + score_branches,
+                                 entry_start = metadata['entrystart'],
+                                 entry_stop = metadata['entrystop'])
+
+        for branch in ["run", "luminosityBlock", "event"]:
+            if len(scores) != len(events) or not ak.all(scores[branch] == events[branch]):
+                raise RuntimeError(f"Score file does not match the events in {branch}: "
+                                   f"{file_path} [{metadata['entrystart']}, {metadata['entrystop']})")
+        if not ak.all(scores["nJet"] == ak.num(events.Jet)):
+            raise RuntimeError(f"Score file does not match the number of jets: {file_path}")
+
+        # same jagged structure, the arrays are used as they are
+        for branch in score_branches:
+            events["Jet", branch[len("Jet_"):]] = scores[branch]
 
-        pass
-        
     def process(self, events):
         out = self.accumulator.identity()
 
         if self.tag_ids_files:
-            self.get_jets_score(events.metadata)
+            self.get_jets_score(events)
 
         objects = {}
         # events = events[:20]
@@ -495,6 +505,7 @@ class JetMatching(coffea.processor.ProcessorABC):
         events[self.collections.GenVisTaus.name, "vertexY"] = events.GenPart.vertexY[events[self.collections.GenVisTaus.name].genPartIdxMother]
         events[self.collections.GenVisTaus.name, "vertexZ"] = events.GenPart.vertexZ[events[self.collections.GenVisTaus.name].genPartIdxMother]
         events[self.collections.GenVisTaus.name, "vertexRho"] = events.GenPart.vertexRho[events[self.collections.GenVisTaus.name].genPartIdxMother]
+        add_gen_ancestry(events, self.collections.GenVisTaus.name)
         # First way of finding pairs
         # objects["genTau"] = events.GenVisTau[
         #     abs(events.GenVisTau.parent.parent.parent.pdgId) == 1000015
@@ -504,12 +515,12 @@ class JetMatching(coffea.processor.ProcessorABC):
         # Second way of calculating pairs
         objects["genTau"] = events[self.collections.GenVisTaus.name][eval(self.collections.GenVisTaus.cut.format(name = "events.%s" %(self.collections.GenVisTaus.name)))]
         objects["genSUSYTaus"] = events.GenPart[ (abs(events.GenPart.pdgId) == 1000015) & (events.GenPart.hasFlags(["isLastCopy"])) ]
-        objects["genSUSYTaus"] = objects["genSUSYTaus"][( abs(objects["genSUSYTaus"].children[:,:,0].vertexZ) < self.collections.STau.vertexZ )]
+        objects["genSUSYTaus"] = objects["genSUSYTaus"][( abs(objects["genSUSYTaus"].decayVertexZ) < self.collections.STau.vertexZ )]
         
-        objects["genTau","disp"] = objects["genTau"].parent.vertexRho
-        objects["genSUSYTaus","disp"] = objects["genSUSYTaus"].children[:,:,0].vertexRho
-        tr_length = transverse_length( objects["genTau"].parent )
-        objects["genTau"] = ak.with_field(objects["genTau"], tr_length, "transverse_length")
+        # vertex of the GenVisTau is the one of its tau (see above)
+        objects["genTau","disp"] = objects["genTau"].vertexRho
+        objects["genSUSYTaus","disp"] = objects["genSUSYTaus"].decayVertexRho
+        objects["genTau"] = ak.with_field(objects["genTau"], objects["genTau"].parentLxy, "transverse_length")
 
         events[self.collections.Jets.name,"px"] = events[self.collections.Jets.name].x
         events[self.collections.Jets.name,"py"] = events[self.collections.Jets.name].y
@@ -553,13 +564,16 @@ def regionStudy(cfg: DictConfig) -> None:
         print("Apply DisTauTag scrore from file!")
         for name in samples.keys():
             score_files = glob.glob(f'{cfg.input_disID[name]}/**/*.root', recursive=True)
+            score_index = {}
+            for score_file in score_files:
+                score_index.setdefault(os.path.basename(score_file), []).append(score_file)
             id_scores[name] = {}
             for file in samples[name]:
                 base = os.path.basename(file)
                 file_id = base.replace("nanoaod_with-disTauTagScore", "nanoaod_only-disTauTagScore")
-                matching = [s for s in score_files if file_id in s]
+                matching = score_index.get(file_id, [])
                 if len(matching) != 1:
-                    raise RuntimeError("Matching error (no or many matches): ", matching)
+                    raise RuntimeError("Matching error (no or many matches): ", file, matching)
                 id_scores[name][file] = matching[0]
 
     os.makedirs(cfg.output, exist_ok=True)
@@ -0,0 +1,167 @@
+import os
+import sys
+import json
+import zlib
+import fnmatch
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from incremental_runproc import load_config, expand_datasets
+
+# Integrity scan of all input files of a config, writes the bad files to the
+# bad_file_paths json of the config (a list of paths, as the hand-made ones).
+# Every file is checked in a separate process for
+#   - the tree header (the file and the tree can be opened),
+#   - all baskets of the selected branches (--branches, default all) can be
+#     read and decompressed,
+#   - all branches have the number of entries of the tree and the jagged
+#     branches as many values as their counter branch (nJet, ...) gives.
+# The results are cached per file (size and mtime, with --checksum the
+# adler32 of the content as well) in <bad file json>.scan.json, so rescans
+# only check new or changed files. Files found bad are added to the list,
+# with --prune listed files which are good now are removed.
+#   python scan_bad_files.py ./configs/proc_2018/stau2018_signal.json -j 16
+#   python scan_bad_files.py ./configs/proc_2018/stau2018_signal.json -j 16 --branches "n*" "Jet_*" "PFCandidate_*" --datasets DYJetsToLL_M-50_TuneCP5_13TeV-madgraphMLM-pythia8
+
+
+def adler32(path, blocksize=16 * 1024**2):
+    value = 1
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
+                break
+            value = zlib.adler32(block, value)
+    return f"{value:08x}"
+
+
+def fingerprint(path, checksum=False):
+    stat = os.stat(path)
+    result = {"size": stat.st_size, "mtime": stat.st_mtime_ns}
+    if checksum:
+        result["adler32"] = adler32(path)
+    return result
+
+
+def select_branches(names, patterns):
+    if not patterns:
+        return list(names)
+    return [name for name in names if any(fnmatch.fnmatchcase(name, p) for p in patterns)]
+
+
+def check_file(path, patterns, treename="Events"):
+    """None if the file is fine, otherwise the reason"""
+    import uproot
+    import numpy as np
+    import awkward as ak
+    try:
+        with uproot.open(path) as f:
+            tree = f[treename]
+            n_entries = tree.num_entries
+            branches = select_branches(tree.keys(), patterns)
+            for name in branches:
+                branch = tree[name]
+                if branch.num_entries != n_entries:
+                    return f"{name}: {branch.num_entries} entries, tree has {n_entries}"
+                if branch.num_baskets > 0 and branch.entry_offsets[-1] != n_entries:
+                    return f"{name}: baskets cover {branch.entry_offsets[-1]} of {n_entries} entries"
+                for i in range(branch.num_baskets):
+                    branch.basket(i)
+            # jagged branches against their counters
+            checked = set()
+            for name in branches:
+                branch = tree[name]
+                counter = getattr(branch, "count_branch", None)
+                if counter is None or counter.name in checked:
+                    continue
+                checked.add(counter.name)
+                counts = counter.array(library="np")
+                values = ak.num(branch.array(library="ak"), axis=1)
+                if len(values) != len(counts) or not np.array_equal(ak.to_numpy(values), counts):
+                    return f"{name}: does not match {counter.name}"
+    except Exception as e:
+        return f"{type(e).__name__}: {e}"
+    return None
+
+
+def scan(path, patterns, checksum, treename):
+    return path, fingerprint(path, checksum), check_file(path, patterns, treename)
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_json(path, content):
+    with open(path + ".tmp", "w") as f:
+        json.dump(content, f, indent=4)
+    os.replace(path + ".tmp", path)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Scan the input files of a config and list the bad ones")
+    parser.add_argument("config", help="Pepper config")
+    parser.add_argument("-o", "--output", default=None,
+                        help="Bad file json, default: bad_file_paths of the config")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count())
+    parser.add_argument("--branches", nargs="*", default=None,
+                        help="Branches to check (patterns), default all")
+    parser.add_argument("--datasets", nargs="*", default=None, help="Only scan these datasets")
+    parser.add_argument("--tree", default="Events")
+    parser.add_argument("--checksum", action="store_true",
+                        help="Cache by the adler32 of the content as well")
+    parser.add_argument("--prune", action="store_true",
+                        help="Remove listed files which are good now")
+    parser.add_argument("--rescan", action="store_true", help="Ignore the cache")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    output = args.output or config.get("bad_file_paths")
+    if not output:
+        sys.exit("No --output and no bad_file_paths in the config")
+    cache_path = os.path.splitext(output)[0] + ".scan.json"
+    cache = {} if args.rescan else load_json(cache_path, {})
+    listed = load_json(output, [])
+
+    # all files, also the ones already listed
+    config.pop("bad_file_paths", None)
+    files = [path for datasets in expand_datasets(config, args.datasets).values()
+             for ds in datasets.values() for path in ds]
+    branches_key = sorted(args.branches) if args.branches else ["*"]
+
+    todo = []
+    for path in files:
+        entry = cache.get(path)
+        if entry is not None and entry["branches"] == branches_key:
+            stat = os.stat(path)
+            if (entry["size"], entry["mtime"]) == (stat.st_size, stat.st_mtime_ns):
+                continue
+            if args.checksum and entry.get("adler32") == adler32(path):
+                entry["mtime"] = stat.st_mtime_ns
+                continue
+        todo.append(path)
+    print(f"{len(files)} files, {len(todo)} to scan")
+
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [executor.submit(scan, path, args.branches, args.checksum, args.tree)
+                   for path in todo]
+        for i, future in enumerate(as_completed(futures)):
+            path, stamp, error = future.result()
+            cache[path] = dict(stamp, branches=branches_key, error=error)
+            if error is not None:
+                print(f"[{i + 1}/{len(todo)}] bad: {path}\n    {error}")
+            if (i + 1) % 100 == 0:
+                write_json(cache_path, cache)
+    write_json(cache_path, cache)
+
+    bad = [path for path in files if cache[path]["error"] is not None]
+    result = list(listed)
+    if args.prune:
+        scanned = set(files)
+        result = [path for path in result if path not in scanned or cache[path]["error"] is not None]
+    result += [path for path in bad if path not in result]
+    write_json(output, result)
+    print(f"{len(bad)} bad files of {len(files)}, {len(result)} files in {output}")
@@ -10,6 +10,9 @@ import numpy as np
 from pepper import Config
 # from utils.plotter import plot1D, plot2D
 from utils.plotter  import ColorIterator, root_plot1D, root_plot2D
+from utils.cutflow_store import load_cutflow
+from utils.hist_store import root_hist
+from utils.abcd import ABCDInputs, region_categories, closure_summary, write_closure
 
 ## Two fakes and fake genuine
 
@@ -95,7 +98,18 @@ parser.add_argument(
 parser.add_argument(
     "--ext", choices=["pdf", "svg", "png"], help="Output file format",
     default="svg")
+parser.add_argument(
+    "--regions", default=None, help="JSON file with named region definitions "
+    "({name: {\"A\": [[...], ...], ...}}) evaluated instead of region_contruct")
+parser.add_argument(
+    "--mode", choices=["binned", "integrated"], default="binned",
+    help="A = B*C/D per bin or with the transfer factor C/D of the integrals")
+parser.add_argument(
+    "--closure-only", action="store_true", help="Only write the closure metrics, no plots")
 
+parser.add_argument(
+    "--era", default=None, help="Era of the cutflow in the store, default "
+    "the year of the plot config")
 
 args = parser.parse_args()
 
@@ -111,18 +125,27 @@ except:
     raise ValueError('Error reading/open file with crosssections')
 
 try:
-    with open(args.cutflow) as f:
-        cutflow = json.load(f)
+    cutflow = load_cutflow(args.cutflow, args.era or config["year"])
 except:
     raise ValueError('Error reading/open file with cutflow')
 
+if args.regions is not None:
+    with open(args.regions) as f:
+        definitions = json.load(f)
+else:
+    definitions = {region_contruct["A"][-1][0]: region_contruct}
+definition_names = list(definitions)
+constructs = [definitions[name] for name in definition_names]
+categories = sorted({category for construct in constructs
+                     for region in region_categories(construct).values() for category in region})
+
 histfiles = []
 histnames = []
 for histfile in args.histfile:
     if histfile.endswith(".json"):
         dirname = os.path.dirname(histfile)
         with open(histfile) as f:
-            f = json.load(f)
+            f = json.load(f)["content"]
             for keys, histfile in zip(*f):
                 if len(keys) != 2:
                     continue
@@ -136,140 +159,113 @@ for histfile in args.histfile:
     else:
         raise ValueError('Json should be provided')
 
-output = args.outdir + "/" + region_contruct["A"][-1][0]
+# background groups and the normalisation of their datasets
+groups = {_group_name: list(config["Labels"][_group_name]) for _group_name in config["Labels"]
+          if not (_group_name in config["Signal_samples"] or _group_name in config["Data"])}
+scales = {}
+for _datasets in groups.values():
+    for _histogram_data in _datasets:
+        N = cutflow[_histogram_data]["all"]["Before cuts"]
+        scales[_histogram_data] = (crosssections[_histogram_data] * config["luminosity"]) / N
 
+closures = {}
 for _histfile, _histname in zip(histfiles,histnames):
         
     if not any([cut in str(_histfile) for cut in config["cuts"]]):
         continue
-    
-    # sum up histograms for each abcd-region     
-    _histograms_predict = {"A":[], "B":[], "C":[], "D":[]}
-    _histograms_stack = {"A":[], "B":[], "C":[], "D":[]}
-    
-    for region_name in ["A", "B", "C", "D"]:
-    
-        # The plots are done for specific cut step specified in config.
-        file = ROOT.TFile.Open(str(_histfile), 'read')
-        for _group_idx, _group_name in enumerate(config["Labels"].keys()):
-            
-            if _group_name in config["Signal_samples"] or _group_name in config["Data"]:
-                continue
-            
-            # Accumulate histograms amoung categories accroding to region_contruct
-            categories_list = list(itertools.product(*region_contruct[region_name]))
-            categories_list = ["_".join(cat) for cat in categories_list]
-            
-            for _ci, _categ in enumerate(categories_list):
-                
-                # Accumulate the dataset for the particular data group as specified in config “Labels”.
-                for _idx, _histogram_data in enumerate(config["Labels"][_group_name]):
-                    
-                    # Rescaling according to cross-section and luminosity
-                    print("Reading data:", _histogram_data + "_" + _categ)
-                    hist = file.Get(_histogram_data + "_" + _categ)
-                    hist.SetDirectory(0)
-                    N = cutflow[_histogram_data]["all"]["Before cuts"]
-                    hist.Scale( (crosssections[_histogram_data] * config["luminosity"]) / N)
-
-                    if _histname in config["SetupBins"]:
-                        hist.Rebin(config["SetupBins"][_histname][2])
-                        if config["SetupBins"][_histname][4]:
-                            for bin_i, label in enumerate(config["SetupBins"][_histname][4]):
-                                hist.GetXaxis().SetBinLabel(bin_i, label)
-                                hist.GetXaxis().SetTitle("")
-
-                    hist_copy = hist.Clone()
-                    hist_copy.SetDirectory(0)
-                    # To have histogram for every group
-                    if _ci==0 and _idx == 0:
-                        _histograms_stack[region_name].append(hist_copy)
-                    else:
-                        _histograms_stack[region_name][-1].Add(hist_copy)
-                    
-                    hist_copy = hist.Clone()
-                    hist_copy.SetDirectory(0)
-                    # To sum up histograms for all groups
-                    if _group_idx==0 and _ci==0 and _idx == 0:
-                        _histograms_predict[region_name].append(hist_copy)
-                    else:
-                        _histograms_predict[region_name][-1].Add(hist_copy)
-                
-            color_setup = config["MC_bkgd"][_group_name]  
-            line_color = color_setup[1]
-            fill_color = color_setup[0]
-            
-            _histograms_stack[region_name][-1].SetMarkerSize(0)
-            _histograms_stack[region_name][-1].SetLineWidth(4)
-            _histograms_stack[region_name][-1].SetLineColor(line_color)
-            _histograms_stack[region_name][-1].SetFillColor(fill_color)
-            _histograms_stack[region_name][-1].SetTitle(_group_name)
-            
-        _histograms_predict[region_name][-1].SetMarkerStyle(8)
-        _histograms_predict[region_name][-1].SetMarkerSize(2)
-        _histograms_predict[region_name][-1].SetLineWidth(0)
-        _histograms_predict[region_name][-1].SetFillColor(0)
-        _histograms_predict[region_name][-1].SetTitle("A=B/C*D")
-                
-    # get maximum for the y-scale
-    y_max = _histograms_stack["A"][0].GetMaximum()
-    for _h in _histograms_stack["A"]:
-        y_max = max(y_max,_h.GetMaximum())
-
-    # sort histogram from min to max
-    _histograms_background_entries = []
-    _histograms_background_sorted = []
-    for _h in _histograms_stack["A"]:
-        _histograms_background_entries.append(_h.Integral())
-    _sorted_hist = np.argsort(_histograms_background_entries)
-    for _idx in _sorted_hist:
-        _histograms_background_sorted.append( _histograms_stack["A"][_idx])
-
-    # read the binning if available:
-    if _histname in config["SetupBins"]:
-        xrange_min = config["SetupBins"][_histname][0]
-        xrange_max = config["SetupBins"][_histname][1]
-        overflow =  bool(config["SetupBins"][_histname][3])
-    else:
-        xrange_min = _histograms_stack["A"][0].GetXaxis().GetXmin()
-        xrange_max = _histograms_stack["A"][0].GetXaxis().GetXmax()
-        overflow =  True
-    
-    
-    # ABCD algebra
-    _histograms_predict["A"][0] = _histograms_predict["C"][0].Divide(_histograms_predict["D"][0])*_histograms_predict["B"][0]
-    
-    root_plot1D(
-            l_hist = _histograms_background_sorted,
-            l_hist_overlay = _histograms_predict["A"],
-            outfile = output + "/" + os.path.splitext(os.path.basename(_histfile))[0] + ".png",
-            xrange = [xrange_min, xrange_max],
-            yrange = (0.001,  10000*y_max),
-            logx = False, logy = True,
-            logx_ratio = False, logy_ratio = False,
-            include_overflow = overflow,
-            xtitle = _histograms_stack["A"][0].GetXaxis().GetTitle(),
-            ytitle = "events",
-            xtitle_ratio = _histograms_stack["A"][0].GetXaxis().GetTitle(),
-            ytitle_ratio = "MC_{pred}/MC",
-            centertitlex = True, centertitley = True,
-            centerlabelx = False, centerlabely = False,
-            gridx = True, gridy = True,
-            ndivisionsx = None,
-            stackdrawopt = "",
-            # normilize = True,
-            normilize_overlay = False,
-            legendpos = "UR",
-            legendtitle = f"",
-            legendncol = 3,
-            legendtextsize = 0.025,
-            legendwidthscale = 1.9,
-            legendheightscale = 0.26,
-            lumiText = "2018 (13 TeV)",
-            signal_to_background_ratio = True,
-            ratio_mode = "DATA",
-            yrange_ratio = (0.0, 5.0),
-            draw_errors = True
-            )
-    
-    # exit()
\ No newline at end of file
+
+    # all datasets and categories of the file in one read
+    rebin_factor = config["SetupBins"][_histname][2] if _histname in config["SetupBins"] else 1
+    inputs = ABCDInputs.load(_histfile, groups, categories, scales, rebin_factor)
+    result = inputs.evaluate(constructs, args.mode)
+    closures[os.path.splitext(os.path.basename(_histfile))[0]] = \
+        closure_summary(result["metrics"], definition_names)
+    if args.closure_only:
+        continue
+
+    bin_labels = None
+    if _histname in config["SetupBins"] and config["SetupBins"][_histname][4]:
+        bin_labels = [list(config["SetupBins"][_histname][4])]
+    stack, stack_var = inputs.regions(constructs, per_group=True)
+
+    for _def_idx, _def_name in enumerate(definition_names):
+        output = args.outdir + "/" + _def_name
+        os.makedirs(output, exist_ok=True)
+
+        # region A per group for the stack
+        _histograms_stack = []
+        for _group_idx, _group_name in enumerate(inputs.group_names):
+            hist = root_hist("TH1D", _group_name, _group_name, inputs.edges,
+                             stack[_def_idx, 0, _group_idx], stack_var[_def_idx, 0, _group_idx],
+                             labels=bin_labels)
+            color_setup = config["MC_bkgd"][_group_name]
+            hist.SetMarkerSize(0)
+            hist.SetLineWidth(4)
+            hist.SetLineColor(color_setup[1])
+            hist.SetFillColor(color_setup[0])
+            _histograms_stack.append(hist)
+
+        # ABCD algebra
+        hist_predict = root_hist("TH1D", "predict", "A=B/C*D", inputs.edges,
+                                 result["predicted"][_def_idx], result["var_predicted"][_def_idx],
+                                 labels=bin_labels)
+        hist_predict.SetMarkerStyle(8)
+        hist_predict.SetMarkerSize(2)
+        hist_predict.SetLineWidth(0)
+        hist_predict.SetFillColor(0)
+
+        # get maximum for the y-scale
+        y_max = max(_h.GetMaximum() for _h in _histograms_stack)
+
+        # sort histogram from min to max
+        _sorted_hist = np.argsort([_h.Integral() for _h in _histograms_stack])
+        _histograms_background_sorted = [_histograms_stack[_idx] for _idx in _sorted_hist]
+
+        # read the binning if available:
+        if _histname in config["SetupBins"]:
+            xrange_min = config["SetupBins"][_histname][0]
+            xrange_max = config["SetupBins"][_histname][1]
+            overflow =  bool(config["SetupBins"][_histname][3])
+        else:
+            xrange_min = _histograms_stack[0].GetXaxis().GetXmin()
+            xrange_max = _histograms_stack[0].GetXaxis().GetXmax()
+            overflow =  True
+
+        root_plot1D(
+                l_hist = _histograms_background_sorted,
+                l_hist_overlay = [hist_predict],
+                outfile = output + "/" + os.path.splitext(os.path.basename(_histfile))[0] + ".png",
+                xrange = [xrange_min, xrange_max],
+                yrange = (0.001,  10000*y_max),
+                logx = False, logy = True,
+                logx_ratio = False, logy_ratio = False,
+                include_overflow = overflow,
+                xtitle = _histograms_stack[0].GetXaxis().GetTitle(),
+                ytitle = "events",
+                xtitle_ratio = _histograms_stack[0].GetXaxis().GetTitle(),
+                ytitle_ratio = "MC_{pred}/MC",
+                centertitlex = True, centertitley = True,
+                centerlabelx = False, centerlabely = False,
+                gridx = True, gridy = True,
+                ndivisionsx = None,
+                stackdrawopt = "",
+                # normilize = True,
+                normilize_overlay = False,
+                legendpos = "UR",
+                legendtitle = f"",
+                legendncol = 3,
+                legendtextsize = 0.025,
+                legendwidthscale = 1.9,
+                legendheightscale = 0.26,
+                lumiText = "2018 (13 TeV)",
+                signal_to_background_ratio = True,
+                ratio_mode = "DATA",
+                yrange_ratio = (0.0, 5.0),
+                draw_errors = True
+                )
+
+write_closure(args.outdir + "/closure_abcd.json", closures)
+for _histfile_name, _results in closures.items():
+    for _def_name, _metrics in _results.items():
+        print(f"{_histfile_name} {_def_name}: chi2/ndof = {_metrics['chi2']:.1f}/{_metrics['ndof']}, "
+              f"A/pred = {_metrics['ratio']:.3f} +- {_metrics['ratio_unc']:.3f}")
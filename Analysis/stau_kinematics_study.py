@@ -22,6 +22,7 @@ ROOT.gROOT.SetBatch(True)
 
 #import CMS_lumi, tdrstyle
 import utils
+from utils.gen_ancestry import add_gen_ancestry, gen_particles
 
 from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
 
@@ -91,6 +92,7 @@ class MyProcessor(coffea.processor.ProcessorABC) :
         
         sel_idx = (awkward.num(GenStau, axis = 1) == 2) & (awkward.num(GenLsp, axis = 1) == 2)
         events = events[sel_idx]
+        add_gen_ancestry(events)
         
         #distinctChildren
         
@@ -119,11 +121,12 @@ class MyProcessor(coffea.processor.ProcessorABC) :
         #events = events[sel_idx]
         #GenVisTaul = GenVisTaul[sel_idx]
         
-        GenStaul = GenVisTaul.distinctParent.distinctParent
+        # stau of the leptonic tau (was GenVisTaul.distinctParent.distinctParent)
+        GenStaul = gen_particles(events.GenPart, GenVisTaul.stauIdx)
         GenVisTaul_stauRF = GenVisTaul.boost(-GenStaul.boostvec)
         
         #print(awkward.sum(GenStaul.mass == 0, axis = None))
-        print(awkward.flatten(GenStaul.pdgId[(abs(GenStaul.pdgId) != 1000015) & (abs(GenStaul.pdgId) != 2000015)]))
+        print("leptons without stau ancestor:", awkward.sum(GenVisTaul.stauIdx < 0))
         
         #print("GenVisTaul.distinctParent.pdgId:", GenVisTaul.distinctParent.pdgId)
         #print("GenVisTaul.distinctParent.distinctParent.pdgId:", GenVisTaul.distinctParent.distinctParent.pdgId)
@@ -132,16 +135,13 @@ class MyProcessor(coffea.processor.ProcessorABC) :
         #print(events)
         
         #GenTauh = events[awkward.num(events.GenVisTau, axis = 1) >= 1].GenPart[events.GenVisTau.genPartIdxMother]
-        GenTauh = events.GenVisTau.parent
+        GenTauh = gen_particles(events.GenPart, events.GenVisTau.tauIdx)
         #awkward.drop_none(GenTauh)
         #GenTauh = GenTauh[~awkward.is_none(GenTauh, axis = 1)]
         #GenTauh = GenTauh[(abs(GenTauh.pdgId) == 15)]
         
-        GenStauh = GenTauh.distinctParent
-        GenStauh = GenStauh[
-            ((abs(GenStauh.pdgId) == 1000015) | (abs(GenStauh.pdgId) == 2000015))
-            | ((abs(GenStauh.distinctParent.pdgId) == 1000015) | (abs(GenStauh.distinctParent.pdgId) == 2000015))
-        ]
+        GenStauh = gen_particles(events.GenPart, events.GenVisTau.stauIdx)
+        GenStauh = GenStauh[events.GenVisTau.stauIdx >= 0]
         
         
         print("GenTauh.pdgId:", GenTauh.pdgId)
@@ -4,6 +4,7 @@ from argparse import ArgumentParser
 import re
 
 from pepper import Config
+from utils.cutflow_store import load_cutflow
 from utils.plotter import plot1D, plot2D, plot_predict, plot_predict_sys, plot_predict2D, plotBrMC, doQCDprediction
 
 
@@ -29,6 +30,9 @@ parser.add_argument(
     '-d','--data', action='store_true', help="If True Data/MC comparison will be plotted"
         "otherwise signal/background will be plotted")
 
+parser.add_argument(
+    "--era", default=None, help="Era of the cutflow in the store, default "
+    "the year of the plot config")
 
 args = parser.parse_args()
 
@@ -44,8 +48,7 @@ except:
     raise ValueError('Error reading/open file with crosssections')
 
 try:
-    with open(args.cutflow) as f:
-        cutflow = json.load(f)
+    cutflow = load_cutflow(args.cutflow, args.era or config["year"])
 except:
     raise ValueError('Error reading/open file with cutflow')
 
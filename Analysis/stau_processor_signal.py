@@ -12,7 +12,6 @@ import pepper
 import awkward as ak
 from functools import partial
 import numpy as np
-import mt2
 import numba as nb
 import coffea
 import logging
@@ -21,9 +20,25 @@ from copy import copy
 
 from coffea.nanoevents import NanoAODSchema
 
+from utils.chunk_cache import ChunkCacheMixin
+from utils.adaptive_chunks import MemoryProbeMixin
+from utils.input_stage import InputStageMixin
+from utils.mt2_numba import MT2Calculator, jets_met_mt2
+from utils.category_codes import SEARCH_CODE, search_bin
+from utils.scale_factors import ScaleFactorEngine, variation_ratios, per_event_any
+from utils.stitching import stitching_tables, add_stitching_cuts
+from utils.fill_plan import FillPlanMixin
+from utils.syst_axis import SystAxisMixin
+from utils.column_compaction import ColumnCompactionMixin
+from utils.threshold_scan import scan_columns
+from utils.gen_ancestry import tau_decays, mother_field, VERTEX_FIELDS, FROM_HARD_PROCESS_FLAG
+from utils.lifetime_reweighting import stau_proper_lengths, lifetime_weights, \
+    parse_ctau, ctau_label
+
 logger = logging.getLogger(__name__)
 
-class Processor(pepper.ProcessorBasicPhysics):
+class Processor(InputStageMixin, ChunkCacheMixin, MemoryProbeMixin, FillPlanMixin, SystAxisMixin,
+                ColumnCompactionMixin, pepper.ProcessorBasicPhysics):
     # We use the ConfigTTbarLL instead of its base Config, to use some of its
     # predefined extras
     config_class = pepper.ConfigSTau
@@ -41,6 +56,9 @@ class Processor(pepper.ProcessorBasicPhysics):
         config["histogram_format"] = "root"
         # Need to call parent init to make histograms and such ready
         super().__init__(config, eventdir)
+        self.mt2_calculator = MT2Calculator()
+        self.sf_engine = ScaleFactorEngine(self.config)
+        self.stitching = stitching_tables(self.config)
 
         if "pileup_reweighting" not in config:
             logger.error("No pileup reweigthing specified")
@@ -107,26 +125,16 @@ class Processor(pepper.ProcessorBasicPhysics):
         selector.add_cut("Trigger", partial(
             self.passing_trigger, pos_triggers, neg_triggers))
         
-        if is_mc and ( dsname.startswith("DYJetsToLL_M-50") or \
-                    dsname.startswith("DY1JetsToLL_M-50") or \
-                    dsname.startswith("DY2JetsToLL_M-50") or \
-                    dsname.startswith("DY3JetsToLL_M-50") or \
-                    dsname.startswith("DY4JetsToLL_M-50") ):
-            selector.add_cut("DY jet reweighting",
-                partial(self.do_dy_jet_reweighting))
-        if is_mc and ( dsname.startswith("WJetsToLNu") or \
-                    dsname.startswith("W1JetsToLNu") or \
-                    dsname.startswith("W2JetsToLNu") or \
-                    dsname.startswith("W3JetsToLNu") or \
-                    dsname.startswith("W4JetsToLNu") ):
-            selector.systematics["weight"] = \
-                ak.full_like(selector.systematics["weight"], 1.0)
-            selector.add_cut("W jet reweighting",
-                partial(self.do_w_jet_reweighting))
+        if is_mc:
+            add_stitching_cuts(selector, dsname, self.stitching)
 
         if is_mc and "pileup_reweighting" in self.config:
             selector.add_cut("Pileup reweighting", partial(
                 self.do_pileup_reweighting, dsname))
+
+        if (is_mc and dsname.startswith("SMS-TStauStau")
+                and "ctau_targets" in self.config and self.config["ctau_targets"]):
+            selector.add_cut("ctau_reweighting", partial(self.ctau_reweighting, dsname=dsname))
         
         if is_mc and self.config["year"] in ("2016", "2017", "ul2016pre",
                                         "ul2016post", "ul2017"):
@@ -229,6 +237,8 @@ class Processor(pepper.ProcessorBasicPhysics):
         selector.set_column("Jet_lead_pfcand", partial(self.get_matched_pfCands, match_object="Jet_select", dR=0.4))
         selector.set_column("Jet_select", self.set_jet_dxy)
         selector.add_cut("two_loose_jets", self.has_two_jets)
+        if "threshold_scan" in self.config and self.config["threshold_scan"]:
+            selector.set_multiple_columns(scan_columns)
 
         selector.set_column("sum_jj", self.sum_jj)
         selector.set_multiple_columns(self.missing_energy)
@@ -244,6 +254,7 @@ class Processor(pepper.ProcessorBasicPhysics):
         # Scale factors should be calculated -
         # before cuts on the number of the jets
         selector.set_multiple_columns(self.set_njets_pass)
+        selector.set_column("search_code", self.search_code)
         if self.config["compute_systematics"] and is_mc and self.propagate_eff_factors:
             selector.add_cut("signal_eff_sfs", partial(self.signal_eff_unc, dsname=dsname))
         # selector.set_multiple_columns(self.set_njets_pass_finebin)
@@ -279,6 +290,8 @@ class Processor(pepper.ProcessorBasicPhysics):
     ### Signal process study ---->
 
     def signal_process_study(self, selector, dsname, is_mc):
+        # Decay mode, visible momentum and vertices of the taus from the staus
+        selector.set_column("GenTauDecay", self.gen_tau_decays)
         # Define lifetime of GenVisTau:
         selector.set_column("GenVisTau", self.gen_vis_tau)
         selector.set_column("Jet_select", self.jet_selection)
@@ -297,28 +310,37 @@ class Processor(pepper.ProcessorBasicPhysics):
     def jet_veto(self, data, jet_name):
         # mask events with at least one jet in veto map (might be too tight)
         jets = data[jet_name]
-        config = self.config["jet_veto_map"]
-        mask_per_jet = config(eta=jets.eta, phi=jets.phi)
-        mask = ak.any(mask_per_jet, axis=-1)
+        mask_per_jet, counts = self.sf_engine.evaluate(
+            "jet_veto_map", eta=jets.eta, phi=jets.phi, return_counts=True)
+        mask = per_event_any(mask_per_jet[0], counts)
         return ~mask
 
+    @zero_handler
+    def gen_tau_decays(self, data):
+        return tau_decays(data["GenPart"])
+
     def gen_vis_tau(self, data):
         tau = data.GenVisTau
         # define trevel distance and transverse travel distance of GenVisTau
-        genpart = tau.parent
-        assert ak.all(abs(genpart.pdgId) == 15)
+        # (vertex of the decaying tau, the mother of the GenVisTau)
+        assert ak.all(abs(mother_field(data.GenPart, tau, "pdgId", 0)) == 15)
+        vertex = {field: mother_field(data.GenPart, tau, field) for field in VERTEX_FIELDS}
         # calculate travel distance and transverse travel distance wrt. to the mother vertex
-        tau["travel"] = np.sqrt(genpart.vertexX**2 + genpart.vertexY**2 + genpart.vertexZ**2)
-        tau["tr_travel"] = np.sqrt(genpart.vertexX**2 + genpart.vertexY**2)
+        tau["travel"] = np.sqrt(vertex["vertexX"]**2 + vertex["vertexY"]**2 + vertex["vertexZ"]**2)
+        tau["tr_travel"] = np.sqrt(vertex["vertexX"]**2 + vertex["vertexY"]**2)
         return tau
 
+    def hard_tau_vis(self, data):
+        # visible taus of taus from the hard process (pt > 30, |eta| < 2.4)
+        tau = data.GenVisTau
+        from_hard = (mother_field(data.GenPart, tau, "statusFlags", 0) & FROM_HARD_PROCESS_FLAG) != 0
+        return tau[(tau.pt > 30) & (abs(tau.eta) < 2.4) & from_hard]
+
     @zero_handler
     def jet_tauvis_match(self, data, is_mc):
         jets = data["Jet_select"]
         if not is_mc: return jets
-        tau_vis = data.GenVisTau[ ((data.GenVisTau.pt > 30) & (abs(data.GenVisTau.eta) < 2.4) &
-                                  (data.GenVisTau.parent.hasFlags(["fromHardProcess"])))
-                                ]
+        tau_vis = self.hard_tau_vis(data)
         matches_h, dRlist = jets.nearest(tau_vis, return_metric=True, threshold=0.3)
         # add travel distance
         jets["travel"] = matches_h.travel
@@ -365,23 +387,21 @@ class Processor(pepper.ProcessorBasicPhysics):
         weight = np.ones(len(data))
         if is_mc and dsname.startswith("DY"):
             z_boson = data["sum_ll_gen"]
-            dy_gen_sfs = self.config["DY_lo_sfs"](mass=z_boson.mass, pt=z_boson.pt)
-            weight *= ak.to_numpy(dy_gen_sfs)
+            dy_gen_sfs = self.sf_engine.evaluate("DY_lo_sfs", mass=z_boson.mass, pt=z_boson.pt)
+            weight *= dy_gen_sfs[0]
             return weight
         else:
             return weight
 
     @zero_handler
-    def do_dy_jet_reweighting(self, data):
-        njet = data["LHE"]["Njets"]
-        weights = self.config["DY_jet_reweight"][njet]
-        return weights
-    
-    @zero_handler
-    def do_w_jet_reweighting(self, data):
-        njet = data["LHE"]["Njets"]
-        weights = self.config["W_jet_reweight"][njet]
-        return weights
+    def ctau_reweighting(self, data, dsname):
+        # weights to the other ctau points as weight variations ctau_<value>
+        targets = self.config["ctau_targets"]
+        lengths, event = stau_proper_lengths(data["GenPart"])
+        weights = lifetime_weights(lengths, event, len(data), parse_ctau(dsname), targets)
+        systematics = {f"ctau_{ctau_label(target)}": weight
+                       for target, weight in zip(targets, weights)}
+        return np.ones(len(data)), systematics
 
     @zero_handler
     def skim_jets(self, data):
@@ -396,21 +416,21 @@ class Processor(pepper.ProcessorBasicPhysics):
         if not os.path.exists(path):
             os.makedirs(path)
         ak.to_parquet(jets, f"{path}/"+prefix+file_name+".parquet")
+        self.register_chunk_file(f"{path}/"+prefix+file_name+".parquet")
         return np.ones(len(data))
     
     @zero_handler
     def MET_trigger_sfs(self, data, met_name="MET"):
-        met_pt = data[met_name].pt
-        scale_factors = self.config["MET_trigger_sfs"]
-        sfs = scale_factors(pt=met_pt)
+        met_pt = ak.to_numpy(data[met_name].pt)
         systematics = {}
-        if self.config["compute_systematics"]:
-            sfs_up = scale_factors(variation="up", pt=met_pt)
-            sfs_down = scale_factors(variation="down", pt=met_pt)
-            # ratio of the up/down to nominal and for 120-250 GeV - 2x stat. unc. of the MET_trigger_sfs is used, for > 250 - 1x stat. unc.
-            systematics["MET_trigger_sfs_up"] = ak.where(met_pt > 250, sfs_up / sfs, 2 * sfs_up / sfs)
-            systematics["MET_trigger_sfs_down"] = ak.where(met_pt > 250, sfs_down / sfs, 2 * sfs_down / sfs)
-        return sfs, systematics
+        if not self.config["compute_systematics"]:
+            return self.sf_engine.evaluate("MET_trigger_sfs", pt=met_pt)[0], systematics
+        sfs = self.sf_engine.evaluate("MET_trigger_sfs", ("central", "up", "down"), pt=met_pt)
+        # ratio of the up/down to nominal and for 120-250 GeV - 2x stat. unc. of the MET_trigger_sfs is used, for > 250 - 1x stat. unc.
+        up, down = variation_ratios(sfs, inflate=np.where(met_pt > 250, 1, 2))
+        systematics["MET_trigger_sfs_up"] = up
+        systematics["MET_trigger_sfs_down"] = down
+        return sfs[0], systematics
     
     @zero_handler
     def HEM_veto(self, data, is_mc):
@@ -442,9 +462,7 @@ class Processor(pepper.ProcessorBasicPhysics):
     def jet_tau(self, data, is_mc):
         jets = data["Jet_select"]
         if not is_mc: return jets
-        tau_vis = data.GenVisTau[ ((data.GenVisTau.pt > 30) & (abs(data.GenVisTau.eta) < 2.4) &
-                                  (data.GenVisTau.parent.hasFlags(["fromHardProcess"])))
-                                ]
+        tau_vis = self.hard_tau_vis(data)
         matches_h, dRlist = jets.nearest(tau_vis, return_metric=True, threshold=0.3)
         tau_jet = jets[~ak.is_none(matches_h, axis=1)]
         return tau_jet
@@ -453,9 +471,7 @@ class Processor(pepper.ProcessorBasicPhysics):
     def jet_taupass(self, data, is_mc):
         jets = data["Jet_pass"]
         if not is_mc: return jets
-        tau_vis = data.GenVisTau[ ((data.GenVisTau.pt > 30) & (abs(data.GenVisTau.eta) < 2.4) &
-                                  (data.GenVisTau.parent.hasFlags(["fromHardProcess"])))
-                                ]
+        tau_vis = self.hard_tau_vis(data)
         matches_h, dRlist = jets.nearest(tau_vis, return_metric=True, threshold=0.3)
         tau_jet = jets[~ak.is_none(matches_h, axis=1)]
         return tau_jet
@@ -464,9 +480,7 @@ class Processor(pepper.ProcessorBasicPhysics):
     def jet_taupass2(self, data, is_mc):
         jets = data["Jet_pass"]
         if not is_mc: return jets
-        tau_vis = data.GenVisTau[ ((data.GenVisTau.pt > 30) & (abs(data.GenVisTau.eta) < 2.4) &
-                                  (data.GenVisTau.parent.hasFlags(["fromHardProcess"])))
-                                ]
+        tau_vis = self.hard_tau_vis(data)
         matches_h, dRlist = jets.nearest(tau_vis, return_metric=True, threshold=0.3)
         two_jets_pass = (ak.num(jets) == 2)
         tau_jet = jets[ (~ak.is_none(matches_h, axis=1)) & two_jets_pass]
@@ -482,15 +496,9 @@ class Processor(pepper.ProcessorBasicPhysics):
     
     @zero_handler    
     def get_mt2(self, data):
-        jet1 = data["Jet_select"][:,0]
-        jet2 = data["Jet_select"][:,1]
-        met = data["MET"]
-        return mt2.mt2(
-            jet1.mass, jet1.px, jet1.py,
-            jet2.mass, jet2.px, jet2.py,
-            met.px, met.py,
-            0, 0
-        )
+        # events with less than two jets are skipped (NaN), results of events
+        # with unchanged inputs are reused between the jet variations
+        return jets_met_mt2(self.mt2_calculator, data)
         
     @zero_handler
     def missing_energy(self, data):
@@ -916,9 +924,7 @@ class Processor(pepper.ProcessorBasicPhysics):
         jets = data["Jet_select"]
         
         # add hadronic tau flavour:
-        tau_vis = data.GenVisTau[ ((data.GenVisTau.pt > 30) & (abs(data.GenVisTau.eta) < 2.4) &
-                                  (data.GenVisTau.parent.hasFlags(["fromHardProcess"])))
-                                ]
+        tau_vis = self.hard_tau_vis(data)
         matches_tauhad, _ = jets.nearest(tau_vis, return_metric=True, threshold=0.4)
         matches_mu, _  = jets.nearest(data["gen_mu"], return_metric=True, threshold=0.4)
         matches_ele, _ = jets.nearest(data["gen_ele"], return_metric=True, threshold=0.4)
@@ -937,17 +943,12 @@ class Processor(pepper.ProcessorBasicPhysics):
         met = data["MET"].pt
         jet2_pt = jets[:,1].pt
         mt2 = data["mt2_j1_j2_MET"]
-        # create empty binning
-        bins = np.full((len(met)), np.nan)
-        B1 = (jet2_pt < 50) & (met >= 250)
-        B2 = (jet2_pt < 50) & (met < 250) & (mt2 < 100)
-        B3 = (jet2_pt < 50) & (met < 250) & (mt2 >= 100)
-        B4 = (jet2_pt >= 50) & (jet2_pt < 100)
-        B5 = (jet2_pt >= 100)
-        bins[B1] = 1
-        bins[B2] = 2
-        bins[B3] = 3
-        bins[B4] = 4
-        bins[B5] = 5
-
-        return bins
\ No newline at end of file
+        # bins B1-B5 as 1-5, NaN if no bin applies
+        return search_bin(ak.to_numpy(jet2_pt), ak.to_numpy(met), mt2) + 1
+
+    @zero_handler
+    def search_code(self, data):
+        # number of tight tagged jets and search bin packed into one code
+        # (see utils/category_codes.py), filled once instead of per category
+        return SEARCH_CODE.encode(ak.to_numpy(data["tight_pass"]),
+                                  ak.to_numpy(data["binning_schema"]) - 1)
\ No newline at end of file
@@ -4,7 +4,6 @@ import pepper
 import awkward as ak
 from functools import partial
 import numpy as np
-import mt2
 import numba as nb
 import coffea
 import logging
@@ -12,6 +11,9 @@ import os
 
 from coffea.nanoevents import NanoAODSchema
 
+from utils.mt2_numba import MT2Calculator, jets_met_mt2
+from utils.stitching import stitching_tables, add_stitching_cuts
+
 logger = logging.getLogger(__name__)
 
 class Processor(pepper.ProcessorBasicPhysics):
@@ -30,6 +32,8 @@ class Processor(pepper.ProcessorBasicPhysics):
         config["histogram_format"] = "root"
 
         super().__init__(config, eventdir)
+        self.mt2_calculator = MT2Calculator()
+        self.stitching = stitching_tables(self.config)
 
         if "pileup_reweighting" not in config:
             logger.warning("No pileup reweigthing specified")
@@ -68,23 +72,8 @@ class Processor(pepper.ProcessorBasicPhysics):
         selector.add_cut("Trigger", partial(
             self.passing_trigger, pos_triggers, neg_triggers))
         
-        if is_mc and ( dsname.startswith("DYJetsToLL_M-50") or \
-                    dsname.startswith("DY1JetsToLL_M-50") or \
-                    dsname.startswith("DY2JetsToLL_M-50") or \
-                    dsname.startswith("DY3JetsToLL_M-50") or \
-                    dsname.startswith("DY4JetsToLL_M-50") ):
-            selector.add_cut("DY jet reweighting",
-                partial(self.do_dy_jet_reweighting))
-        
-        if is_mc and ( dsname.startswith("WJetsToLNu") or \
-                    dsname.startswith("W1JetsToLNu") or \
-                    dsname.startswith("W2JetsToLNu") or \
-                    dsname.startswith("W3JetsToLNu") or \
-                    dsname.startswith("W4JetsToLNu") ):
-            selector.systematics["weight"] = \
-                ak.full_like(selector.systematics["weight"], 1.0)
-            selector.add_cut("W jet reweighting",
-                partial(self.do_w_jet_reweighting))
+        if is_mc:
+            add_stitching_cuts(selector, dsname, self.stitching)
 
         if is_mc and "pileup_reweighting" in self.config:
             selector.add_cut("Pileup reweighting", partial(
@@ -225,18 +214,6 @@ class Processor(pepper.ProcessorBasicPhysics):
         else:
             return weight
 
-    @zero_handler
-    def do_dy_jet_reweighting(self, data):
-        njet = data["LHE"]["Njets"]
-        weights = self.config["DY_jet_reweight"][njet]
-        return weights
-    
-    @zero_handler
-    def do_w_jet_reweighting(self, data):
-        njet = data["LHE"]["Njets"]
-        weights = self.config["W_jet_reweight"][njet]
-        return weights
-
     @zero_handler
     def MET_trigger_sfs(self, data):
         met_pt = data["MET"].pt
@@ -260,15 +237,9 @@ class Processor(pepper.ProcessorBasicPhysics):
     
     @zero_handler    
     def get_mt2(self, data):
-        jet1 = data["Jet_select"][:,0]
-        jet2 = data["Jet_select"][:,1]
-        met = data["MET"]
-        return mt2.mt2(
-            jet1.mass, jet1.px, jet1.py,
-            jet2.mass, jet2.px, jet2.py,
-            met.px, met.py,
-            0, 0
-        )
+        # events with less than two jets are skipped (NaN), results of events
+        # with unchanged inputs are reused between the jet variations
+        return jets_met_mt2(self.mt2_calculator, data)
         
     @zero_handler
     def missing_energy(self, data):
@@ -3,7 +3,6 @@ import pepper
 import awkward as ak
 from functools import partial
 import numpy as np
-import mt2
 import numba as nb
 import coffea
 from copy import copy
@@ -14,9 +13,14 @@ import os
 
 from coffea.nanoevents import NanoAODSchema
 
+from utils.mt2_numba import MT2Calculator, jets_met_mt2
+from utils.scale_factors import ScaleFactorEngine
+from utils.stitching import stitching_tables, add_stitching_cuts
+from utils.fill_plan import FillPlanMixin
+
 logger = logging.getLogger(__name__)
 
-class Processor(pepper.ProcessorBasicPhysics):
+class Processor(FillPlanMixin, pepper.ProcessorBasicPhysics):
     # We use the ConfigTTbarLL instead of its base Config, to use some of its
     # predefined extras
     config_class = pepper.ConfigSTau
@@ -34,6 +38,9 @@ class Processor(pepper.ProcessorBasicPhysics):
         config["histogram_format"] = "root"
         # Need to call parent init to make histograms and such ready
         super().__init__(config, eventdir)
+        self.mt2_calculator = MT2Calculator()
+        self.sf_engine = ScaleFactorEngine(self.config)
+        self.stitching = stitching_tables(self.config, ("DY",))
 
         if "pileup_reweighting" not in config:
             logger.warning("No pileup reweigthing specified")
@@ -74,13 +81,8 @@ class Processor(pepper.ProcessorBasicPhysics):
             self.passing_trigger, pos_triggers, neg_triggers))
         
         
-        if is_mc and ( dsname.startswith("DYJetsToLL_M-50_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY1JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY2JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY3JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY4JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") ):
-            selector.add_cut("DY jet reweighting",
-                partial(self.do_dy_jet_reweighting))
+        if is_mc:
+            add_stitching_cuts(selector, dsname, self.stitching, ("DY",))
 
         if is_mc and "pileup_reweighting" in self.config:
             selector.add_cut("Pileup reweighting", partial(
@@ -372,15 +374,9 @@ class Processor(pepper.ProcessorBasicPhysics):
     
     @zero_handler    
     def get_mt2(self, data):
-        jet1 = data["Jet_select"][:,0]
-        jet2 = data["Jet_select"][:,1]
-        met = data["MET"]
-        return mt2.mt2(
-            jet1.mass, jet1.px, jet1.py,
-            jet2.mass, jet2.px, jet2.py,
-            met.px, met.py,
-            0, 0
-        )
+        # events with less than two jets are skipped (NaN), results of events
+        # with unchanged inputs are reused between the jet variations
+        return jets_met_mt2(self.mt2_calculator, data)
     
     # @zero_handler
     # def skim_jets(self, data):
@@ -421,12 +417,6 @@ class Processor(pepper.ProcessorBasicPhysics):
         jets = jets[(jets.disTauTag_score1 >= self.config["tight_thr"])]
         return jets
 
-    @zero_handler
-    def do_dy_jet_reweighting(self, data):
-        njet = data["LHE"]["Njets"]
-        weights = self.config["DY_jet_reweight"][njet]
-        return weights
-
     @zero_handler
     def MET_cut_max(self, data):
         return data["MET"].pt < self.config["MET_cut_max"]
@@ -589,33 +579,14 @@ class Processor(pepper.ProcessorBasicPhysics):
         """Compute identification and isolation scale factors for
            leptons (electrons and muons). Also possible
            to use for muon trigger scale factors."""
-        weight = np.ones(len(muons))
-        systematics = {}
-        # Muon identification and isolation efficiency
-        for i, sffunc in enumerate(self.config[sfs_name_config]):
-            params = {}
-            for dimlabel in sffunc.dimlabels:
-                if dimlabel == "abseta":
-                    params["abseta"] = abs(muons.eta)
-                else:
-                    params[dimlabel] = getattr(muons, dimlabel)
-            central = ak.prod(sffunc(**params), axis=1)
-            key = f"{sfs_name_config}{i}"
-            if self.config["compute_systematics"]:
-                if ("split_muon_uncertainty" not in self.config
-                        or not self.config["split_muon_uncertainty"]):
-                    unctypes = ("",)
-                else:
-                    unctypes = ("stat ", "syst ")
-                for unctype in unctypes:
-                    up = ak.prod(sffunc(
-                        **params, variation=f"{unctype}up"), axis=1)
-                    down = ak.prod(sffunc(
-                        **params, variation=f"{unctype}down"), axis=1)
-                    systematics[key + unctype.replace(" ", "")] = (
-                        up / central, down / central)
-            weight = weight * central
-        return weight, systematics
+        unctypes = None
+        if self.config["compute_systematics"]:
+            if ("split_muon_uncertainty" not in self.config
+                    or not self.config["split_muon_uncertainty"]):
+                unctypes = ("",)
+            else:
+                unctypes = ("stat ", "syst ")
+        return self.sf_engine.object_sfs(sfs_name_config, muons, unctypes)
 
     @zero_handler
     def jet_selection(self, data):
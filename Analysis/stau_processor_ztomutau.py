@@ -13,9 +13,13 @@ from coffea.nanoevents import NanoAODSchema
 from functools import partial
 import logging
 
+from utils.scale_factors import ScaleFactorEngine
+from utils.stitching import stitching_tables, add_stitching_cuts
+from utils.fill_plan import FillPlanMixin
+
 logger = logging.getLogger(__name__)
 
-class Processor(pepper.ProcessorBasicPhysics):
+class Processor(FillPlanMixin, pepper.ProcessorBasicPhysics):
     # We use the ConfigTTbarLL instead of its base Config, to use some of its
     # predefined extras
     config_class = pepper.ConfigSTau
@@ -33,6 +37,8 @@ class Processor(pepper.ProcessorBasicPhysics):
         config["histogram_format"] = "root"
         # Need to call parent init to make histograms and such ready
         super().__init__(config, eventdir)
+        self.sf_engine = ScaleFactorEngine(self.config)
+        self.stitching = stitching_tables(self.config)
 
         if "pileup_reweighting" not in config:
             logger.warning("No pileup reweigthing specified")
@@ -70,23 +76,8 @@ class Processor(pepper.ProcessorBasicPhysics):
         selector.add_cut("Trigger", partial(
             self.passing_trigger, pos_triggers, neg_triggers))
         
-        if is_mc and ( dsname.startswith("DYJetsToLL_M-50_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY1JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY2JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY3JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") or \
-                       dsname.startswith("DY4JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8") ):
-            selector.add_cut("DY jet reweighting",
-                partial(self.do_dy_jet_reweighting))
-
-        if is_mc and ( dsname.startswith("WJetsToLNu") or \
-                    dsname.startswith("W1JetsToLNu") or \
-                    dsname.startswith("W2JetsToLNu") or \
-                    dsname.startswith("W3JetsToLNu") or \
-                    dsname.startswith("W4JetsToLNu") ):
-            selector.systematics["weight"] = \
-                ak.full_like(selector.systematics["weight"], 1.0)
-            selector.add_cut("W jet reweighting",
-                partial(self.do_w_jet_reweighting))
+        if is_mc:
+            add_stitching_cuts(selector, dsname, self.stitching)
 
         if is_mc and "pileup_reweighting" in self.config:
             selector.add_cut("Pileup reweighting", partial(
@@ -314,18 +305,6 @@ class Processor(pepper.ProcessorBasicPhysics):
             "antiiso" : antiiso
         }
     
-    @zero_handler
-    def do_dy_jet_reweighting(self, data):
-        njet = data["LHE"]["Njets"]
-        weights = self.config["DY_jet_reweight"][njet]
-        return weights
-    
-    @zero_handler
-    def do_w_jet_reweighting(self, data):
-        njet = data["LHE"]["Njets"]
-        weights = self.config["W_jet_reweight"][njet]
-        return weights
-
     def delta_phi(self, phi1_ak, phi2_ak):
         phi1 = np.array(phi1_ak)
         phi2 = np.array(phi2_ak)
@@ -543,33 +522,14 @@ class Processor(pepper.ProcessorBasicPhysics):
         """Compute identification and isolation scale factors for
            leptons (electrons and muons). Also possible
            to use for muon trigger scale factors."""
-        weight = np.ones(len(muons))
-        systematics = {}
-        # Muon identification and isolation efficiency
-        for i, sffunc in enumerate(self.config[sfs_name_config]):
-            params = {}
-            for dimlabel in sffunc.dimlabels:
-                if dimlabel == "abseta":
-                    params["abseta"] = abs(muons.eta)
-                else:
-                    params[dimlabel] = getattr(muons, dimlabel)
-            central = ak.prod(sffunc(**params), axis=1)
-            key = f"{sfs_name_config}{i}"
-            if self.config["compute_systematics"]:
-                if ("split_muon_uncertainty" not in self.config
-                        or not self.config["split_muon_uncertainty"]):
-                    unctypes = ("",)
-                else:
-                    unctypes = ("stat ", "syst ")
-                for unctype in unctypes:
-                    up = ak.prod(sffunc(
-                        **params, variation=f"{unctype}up"), axis=1)
-                    down = ak.prod(sffunc(
-                        **params, variation=f"{unctype}down"), axis=1)
-                    systematics[key + unctype.replace(" ", "")] = (
-                        up / central, down / central)
-            weight = weight * central
-        return weight, systematics
+        unctypes = None
+        if self.config["compute_systematics"]:
+            if ("split_muon_uncertainty" not in self.config
+                    or not self.config["split_muon_uncertainty"]):
+                unctypes = ("",)
+            else:
+                unctypes = ("stat ", "syst ")
+        return self.sf_engine.object_sfs(sfs_name_config, muons, unctypes)
 
     @zero_handler
     def jet_selection(self, data):
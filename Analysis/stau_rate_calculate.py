@@ -11,7 +11,10 @@ from pepper import Config
 import utils.utils as utils
 from utils.utils import *
 from utils.hist_rebin import TH3Histogram, th3_to_cumulative
-ROOT.gInterpreter.Declare('#include "utils/histogram2d.cpp"')
+from utils.histogram2d import Histogram2D
+from utils.cutflow_store import load_cutflow, norm_factors
+from utils.stitching import stitching_group
+from utils.hist_store import open_hist_file
 
 parser = ArgumentParser(
     description="The following script calculate fake rate for stau analysis.")
@@ -25,6 +28,9 @@ parser.add_argument(
     "where histfile is located", default='hist_output')
 parser.add_argument(
     "--cutflow", help="cutflow file", required=True)
+parser.add_argument(
+    "--era", default=None, help="Era of the cutflow in the store, default "
+    "the year of the plot config")
 
 args = parser.parse_args()
 
@@ -40,8 +46,7 @@ except:
     raise ValueError('Error reading/open file with crosssections')
 
 try:
-    with open(args.cutflow) as f:
-        cutflow = json.load(f)
+    cutflow = load_cutflow(args.cutflow, args.era or config["year"], config["crosssections"])
 except:
     raise ValueError('Error reading/open file with cutflow')
 
@@ -53,10 +58,11 @@ if config["fake_rate"]["mode"] == "ratio":
 
     dirname = os.path.dirname(args.histfile[0])
     isDATA = False
+    norm = norm_factors(cutflow, crosssections, config["luminosity"])
     hist_fake = {}
     for region, name in zip([nominator, denominator], ["nom", "denom"]):
         file_path = dirname + "/" + region[0] + ".root"
-        file = ROOT.TFile.Open(str(file_path), 'read')
+        file = open_hist_file(str(file_path))
         hist_fake[name] = None
         for _group_idx, _group_name in enumerate(config["Labels"].keys()):
             # if (not _group_name in config["MC_bkgd"]) and (not _group_name in config["Signal_samples"]):
@@ -88,26 +94,13 @@ if config["fake_rate"]["mode"] == "ratio":
                 else:
                     if isDATA: raise("Can not combine data and MC")
 
-                    if config["DY_stitching_applied"] and (
-                            "DYJetsToLL_M-50" in _histogram_data or
-                            "DY1JetsToLL_M-50" in _histogram_data or
-                            "DY2JetsToLL_M-50" in _histogram_data or
-                            "DY3JetsToLL_M-50" in _histogram_data or
-                            "DY4JetsToLL_M-50" in _histogram_data ):
-                        # print("Stitching:", _histogram_data)
-                        hist.Scale(config["luminosity"])
-                    elif config["W_stitching_applied"] and (
-                            ("WJetsToLNu" in _histogram_data and (not "TTWJets" in _histogram_data)) or
-                            "W1JetsToLNu" in _histogram_data or
-                            "W2JetsToLNu" in _histogram_data or
-                            "W3JetsToLNu" in _histogram_data or
-                            "W4JetsToLNu" in _histogram_data ):
+                    group = stitching_group(_histogram_data)
+                    if group is not None and config[f"{group}_stitching_applied"]:
                         # print("Stitching:", _histogram_data)
                         hist.Scale(config["luminosity"])
                     else:
                         # N = cutflow[_histogram_data]["all"]["NanDrop"] #After Nan dropper
-                        N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                        hist.Scale( (crosssections[_histogram_data] * config["luminosity"]) / N)
+                        hist.Scale(norm[_histogram_data])
                         print(_group_name, "integral:", hist.Integral())
 
                         
@@ -172,8 +165,8 @@ if config["fake_rate"]["mode"] == "ratio":
             y_axis =  np.array(rebin_non_unifor["y_axis"], dtype=np.double)
             xmin, xmax = float(x_axis[0][0]), float(x_axis[0][-1])
             # print("nom_nonunif_" + project + options, y_axis, xmin, xmax)
-            nom_nonunif = ROOT.Histogram_2D("nom_nonunif_" + project + options, y_axis, xmin, xmax)
-            den_nonunif = ROOT.Histogram_2D("den_nonunif_" + project + options, y_axis, xmin, xmax)
+            nom_nonunif = Histogram2D("nom_nonunif_" + project + options, y_axis, xmin, xmax)
+            den_nonunif = Histogram2D("den_nonunif_" + project + options, y_axis, xmin, xmax)
             for i in range(len(x_axis)):
                 nom_nonunif.add_x_binning_by_index(i, np.array(x_axis[i], dtype=np.double))
                 den_nonunif.add_x_binning_by_index(i, np.array(x_axis[i], dtype=np.double))
@@ -181,7 +174,7 @@ if config["fake_rate"]["mode"] == "ratio":
             try:
                 nom_nonunif.th2d_add(hist_projection_nom)
                 den_nonunif.th2d_add(hist_projection_den)
-            except:
+            except ValueError:
                 print("Error is inside project nonunif histograms")
                 print("Error: can not add histogram because of the inconsistency")
                 del nom_nonunif
@@ -228,7 +221,7 @@ if config["fake_rate"]["mode"] == "score-dim": # calculated for data
     hist_fake = None
 
     file_path = dirname + "/" + config["fake_rate"]["histogram"] + ".root"
-    file = ROOT.TFile.Open(str(file_path), 'read')
+    file = open_hist_file(str(file_path))
     print(file_path)
     for _group_idx, _group_name in enumerate(config["Labels"].keys()):
         
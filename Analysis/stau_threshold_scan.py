@@ -0,0 +1,93 @@
+import os
+import json
+from argparse import ArgumentParser
+
+import numpy as np
+
+from utils.cutflow_store import load_cutflow, norm_factors
+from utils.threshold_scan import ThresholdScan, predict, significance, to_json
+
+# Yields, fake rates and jet fake predictions for a grid of tagger score and
+# dxy working points from the threshold scan histograms of a processing run
+# with "threshold_scan": true (see utils/threshold_scan.py). The fake rate is
+# taken from the region of --fake-rate-histfile (e.g. the wjets run) and
+# applied to the yields of the predicted region, with --signal-datasets the
+# working points are ranked by s / sqrt(b) of the 1->2 prediction.
+#   python stau_threshold_scan.py ${DIR}/hists/Cut_014_two_loose_jets_final_threshold_scan_dxy.root --datasets MET_Run2018A MET_Run2018B --fake-rate-histfile ${WJETS}/hists/Cut_013_two_loose_jets_final_threshold_scan_dxy.root --fake-rate-datasets SingleMuon_Run2018A --tight 0.9 0.95 0.99 0.9972 --dxy 0.5 1 2 -o scan.json
+#   python stau_threshold_scan.py ${DIR}/hists/Cut_014_two_loose_jets_final_threshold_scan_dxy.root --datasets ... --signal-datasets SMS-TStauStau_MStau-250_ctau-10mm_mLSP-1 --cutflow ${DIR}/cutflows.json --crosssections ./configs/crosssections.json --luminosity 59.8
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Yields, fake rates and predictions for a grid "
+                            "of tagger score and dxy working points from the threshold "
+                            "scan histograms")
+    parser.add_argument("histfile", help="Scan histogram file of the predicted region "
+                        "(ROOT file or packed into hists.h5)")
+    parser.add_argument("--datasets", nargs="+", required=True, help="Datasets of the region")
+    parser.add_argument("--fake-rate-histfile", default=None,
+                        help="Scan histogram file of the fake rate region, default histfile")
+    parser.add_argument("--fake-rate-datasets", nargs="+", default=None,
+                        help="Datasets of the fake rate region, default --datasets")
+    parser.add_argument("--signal-histfile", default=None, help="Default histfile")
+    parser.add_argument("--signal-datasets", nargs="+", default=None,
+                        help="Signal datasets for s / sqrt(b) of the 1->2 prediction")
+    parser.add_argument("--loose", nargs="+", type=float, default=None,
+                        help="Loose score thresholds, default the lowest edge")
+    parser.add_argument("--tight", nargs="+", type=float, default=None,
+                        help="Tight score thresholds, default all edges")
+    parser.add_argument("--dxy", nargs="+", type=float, default=None,
+                        help="dxy (dxysig) thresholds, default all edges")
+    parser.add_argument("--sys", default=None,
+                        help="Variation in the histogram path (nominal for runs with systematics)")
+    parser.add_argument("--cutflow", default=None, help="Cutflow to scale the MC datasets")
+    parser.add_argument("--crosssections", default=None)
+    parser.add_argument("--era", default=None, help="Era of the cutflow, required with --cutflow")
+    parser.add_argument("--luminosity", type=float, default=None)
+    parser.add_argument("-o", "--output", default=None, help="Output json")
+    args = parser.parse_args()
+
+    scales = {}
+    if args.cutflow is not None:
+        if args.era is None:
+            parser.error("--era is required with --cutflow")
+        with open(args.crosssections) as f:
+            xsecs = json.load(f)
+        scales = norm_factors(load_cutflow(args.cutflow, args.era, args.crosssections), xsecs,
+                              args.luminosity)
+
+    region = ThresholdScan.load(args.histfile, args.datasets, scales, args.sys)
+    fake_region = ThresholdScan.load(args.fake_rate_histfile or args.histfile,
+                                     args.fake_rate_datasets or args.datasets,
+                                     scales, args.sys)
+    grid = region.grid(args.loose, args.tight, args.dxy)
+    yields = region.yields(*grid)
+    rate = fake_region.fake_rate(*grid)
+    arrays = dict(yields, fake_rate=rate, **predict(yields, *rate))
+    if args.signal_datasets is not None:
+        signal = ThresholdScan.load(args.signal_histfile or args.histfile,
+                                    args.signal_datasets, scales, args.sys)
+        signal_yields = signal.yields(*grid)
+        arrays["signal_N_2"] = signal_yields["N_2"]
+        arrays["significance"] = (significance(signal_yields["N_2"][0], *arrays["from1to2"]),
+                                  np.zeros(signal_yields["N_2"][0].shape))
+
+    print(f"{'loose':>8} {'tight':>8} {'dxy':>8} {'N_0':>12} {'N_1':>12} {'N_2':>12} "
+          f"{'f':>10} {'pred 1->2':>12}" + (f" {'s/sqrt(b)':>10}" if "significance" in arrays else ""))
+    for i, loose in enumerate(grid[0]):
+        for j, tight in enumerate(grid[1]):
+            for k, dxy in enumerate(grid[2]):
+                line = (f"{loose:8.4g} {tight:8.4g} {dxy:8.4g} {yields['N_0'][0][i, j, k]:12.4g} "
+                        f"{yields['N_1'][0][i, j, k]:12.4g} {yields['N_2'][0][i, j, k]:12.4g} "
+                        f"{rate[0][i, j, k]:10.4g} {arrays['from1to2'][0][i, j, k]:12.4g}")
+                if "significance" in arrays:
+                    line += f" {arrays['significance'][0][i, j, k]:10.4g}"
+                print(line)
+    if "significance" in arrays:
+        best = np.unravel_index(np.nanargmax(arrays["significance"][0]),
+                                tuple(map(len, grid)))
+        print("Best working point: loose {:g}, tight {:g}, dxy {:g}".format(
+            *(axis[i] for axis, i in zip(grid, best))))
+    if args.output is not None:
+        with open(args.output + ".tmp", "w") as f:
+            json.dump(to_json(grid, arrays), f, indent=4)
+        os.replace(args.output + ".tmp", args.output)
@@ -16,6 +16,7 @@ from functools import partial
 import numpy as np
 import mt2
 
+
 from coffea.nanoevents import NanoAODSchema
 # np.set_printoptions(threshold=np.inf)
 
@@ -87,6 +88,7 @@ class Processor(pepper.ProcessorBasicPhysics):
         selector.set_column("jets_valid", self.jets_valid)
         # selector.set_column("hps_taus_valid", self.hps_taus_valid)
 
+        selector.set_column("tau_daughter", self.tau_daughter)
         selector.set_column("tau_muons", self.tau_muon)
         selector.set_column("tau_elecs", self.tau_elec)
 
@@ -305,24 +307,31 @@ class Processor(pepper.ProcessorBasicPhysics):
         sort_idx = ak.argsort(results.pt, axis=-1, ascending=False)
         return results[sort_idx]
                       
+    @zero_handler
+    def tau_daughter(self, data):
+        # particles with a tau as mother, i.e. the tau decay products (the
+        # leptons selected from them are children of the isLastCopy taus)
+        counts = ak.to_numpy(ak.num(data.GenPart, axis=1))
+        pdg = ak.to_numpy(ak.flatten(data.GenPart.pdgId))
+        mother = ak.to_numpy(ak.flatten(data.GenPart.genPartIdxMother)).astype(np.int64)
+        has_mother = mother >= 0
+        event_start = np.repeat(np.cumsum(counts) - counts, counts)
+        from_tau = np.zeros(len(pdg), dtype=bool)
+        from_tau[has_mother] = np.abs(pdg[mother[has_mother] + event_start[has_mother]]) == 15
+        return ak.unflatten(from_tau, counts)
+
     @zero_handler
     def tau_muon(self, data):
-        taus = data.GenPart[ (abs(data.GenPart.pdgId) == 15) & (data.GenPart.hasFlags(["isLastCopy"])) ]
-        muons = taus.children
+        muons = data.GenPart[ data["tau_daughter"] ]
         muons = muons[ ( abs(muons.pdgId) == 13 ) & (muons.pt > 30) & (muons.eta < 2.4) & (-2.4 < muons.eta) ]
-        muons = ak.firsts(muons,axis=2)
-        muons = muons[ (~ak.is_none(muons, axis=1)) ]
         muons['Lxy'] = np.sqrt( muons.vertexX*muons.vertexX + muons.vertexY*muons.vertexY )
         # print(muons)
         return muons
     
     @zero_handler
     def tau_elec(self, data):
-        taus = data.GenPart[ (abs(data.GenPart.pdgId) == 15) & (data.GenPart.hasFlags(["isLastCopy"])) ]
-        elec = taus.children
+        elec = data.GenPart[ data["tau_daughter"] ]
         elec = elec[ ( abs(elec.pdgId) == 11 ) & (elec.pt > 30) & (elec.eta < 2.4) & (-2.4 < elec.eta)  ] # every tau may have only one lepton as child
-        elec = ak.firsts(elec,axis=2)
-        elec = elec[ (~ak.is_none(elec, axis=1)) ]
         elec['Lxy'] = np.sqrt( elec.vertexX*elec.vertexX + elec.vertexY*elec.vertexY )
         # print(elec)
         return elec
\ No newline at end of file
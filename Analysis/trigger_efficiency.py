@@ -17,6 +17,7 @@ ROOT.gROOT.SetBatch(True)
 
 #import CMS_lumi, tdrstyle
 import utils
+from utils.gen_ancestry import add_gen_ancestry
 
 from coffea.nanoevents import NanoEventsFactory, NanoAODSchema
 
@@ -144,10 +145,12 @@ class MyProcessor(coffea.processor.ProcessorABC) :
     # we will receive a NanoEvents instead of a coffea DataFrame
     def process(self, events) :
         
+        add_gen_ancestry(events)
+        
+        # first stau of every chain (no stau ancestor)
         genStau = events.GenPart[
             (abs(events.GenPart.pdgId) == 1000015)
-            #& (events.GenPart.genPartIdxMother >= 0)
-            & (abs(events.GenPart.pdgId[events.GenPart.genPartIdxMother]) != 1000015)
+            & (events.GenPart.stauIdx < 0)
         ]
         
         print(genStau.pdgId)
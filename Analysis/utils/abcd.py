@@ -0,0 +1,218 @@
+import os
+import json
+import itertools
+
+import numpy as np
+
+from .hist_store import find_store
+
+# ABCD estimate on arrays.
+# All histograms of a histogram file needed for the regions (every dataset x
+# category, named <dataset>_<category> as written by the MC study) are read
+# once into values / variances (n_datasets, n_categories, *bins), scaled to
+# the luminosity and summed into the regions by one contraction with the
+# region membership of the categories. Region definitions are given as in
+# stau_abcd_MC.py
+#     {"A": [["M3"], ["G1G2"], ["PP"]], "B": [["M1", "M2"], ["G1G2"], ["PP"]], ...}
+# (categories are the products of the lists joined by _), several definitions
+# are evaluated together, so alternative regions (other tagger score or dxy
+# working points) are compared without reading the histograms again.
+# The prediction of A is
+#     binned:      A_i = B_i * C_i / D_i
+#     integrated:  A_i = B_i * C / D    (C, D summed over all bins)
+# with the statistical covariance of the prediction (the transfer factor
+# C / D correlates all bins of the integrated prediction). The closure
+# metrics compare the prediction with A: chi2 / ndof with the full
+# covariance, pulls per bin and the ratio of the yields.
+
+REGIONS = ("A", "B", "C", "D")
+
+
+def region_categories(construct):
+    """{region: [category names]} of a region definition"""
+    return {region: ["_".join(parts) for parts in itertools.product(*construct[region])]
+            for region in REGIONS}
+
+
+def read_arrays(histfile, names):
+    """values, variances (n_names, *bins with flow) and the edges of the
+    histograms names of a ROOT file or of a file packed into hists.h5"""
+    histfile = str(histfile)
+    if not os.path.exists(histfile):
+        store = find_store(histfile)
+        packed = os.path.basename(histfile)
+        if store is not None and packed in store:
+            values = np.stack([store.values(packed, name) for name in names])
+            variances = np.stack([store.variances(packed, name) for name in names])
+            return values, variances, store.edges(packed)
+    import uproot
+    with uproot.open(histfile) as f:
+        hists = []
+        for name in names:
+            if name not in f:
+                raise KeyError(f"Histogram {name} not found in {histfile}")
+            hists.append(f[name])
+        values = np.stack([hist.values(flow=True) for hist in hists])
+        variances = np.stack([hist.variances(flow=True) for hist in hists])
+        edges = [np.asarray(axis.edges()) for axis in hists[0].axes]
+    return values, variances, edges
+
+
+def rebin(values, edges, factor):
+    """Merge factor neighbouring bins of the first axis (as TH1::Rebin,
+    remaining bins go to the overflow), values (..., *bins with flow)"""
+    if factor == 1:
+        return values, edges
+    axis = values.ndim - len(edges)
+    inner = np.moveaxis(values, axis, -1)
+    n_bins = (inner.shape[-1] - 2) // factor
+    merged = inner[..., 1:1 + n_bins * factor].reshape(inner.shape[:-1] + (n_bins, factor)).sum(-1)
+    overflow = inner[..., 1 + n_bins * factor:].sum(-1, keepdims=True)
+    result = np.concatenate([inner[..., :1], merged, overflow], axis=-1)
+    return np.moveaxis(result, -1, axis), [edges[0][::factor][:n_bins + 1]] + list(edges[1:])
+
+
+def predict(b, c, d, var_b, var_c, var_d, mode="binned"):
+    """Prediction of A over the flattened bins (last axis) with the diagonal
+    of its covariance and the correlated part, cov = diag(var) + s * u u^T"""
+    if mode == "binned":
+        ratio = np.divide(c, d, out=np.zeros_like(c), where=d > 0)
+        pred = b * ratio
+        rel = (np.divide(var_b, b**2, out=np.zeros_like(b), where=b != 0)
+               + np.divide(var_c, c**2, out=np.zeros_like(c), where=c != 0)
+               + np.divide(var_d, d**2, out=np.zeros_like(d), where=d != 0))
+        return pred, pred**2 * rel, np.zeros_like(pred), np.zeros(pred.shape[:-1])
+    if mode == "integrated":
+        c_sum, d_sum = c.sum(-1), d.sum(-1)
+        ratio = np.divide(c_sum, d_sum, out=np.zeros_like(c_sum), where=d_sum > 0)
+        var_ratio = ratio**2 * (
+            np.divide(var_c.sum(-1), c_sum**2, out=np.zeros_like(c_sum), where=c_sum != 0)
+            + np.divide(var_d.sum(-1), d_sum**2, out=np.zeros_like(d_sum), where=d_sum != 0))
+        pred = b * ratio[..., None]
+        return pred, var_b * ratio[..., None]**2, b, var_ratio
+    raise ValueError(f"Unknown ABCD mode {mode}")
+
+
+def closure(observed, var_observed, pred, var_pred, u, s):
+    """Closure metrics of the prediction, all arrays over the flattened bins
+    (last axis) with arbitrary leading dimensions"""
+    diag = var_observed + var_pred
+    used = diag > 0
+    inv = np.divide(1, diag, out=np.zeros_like(diag), where=used)
+    residual = np.where(used, observed - pred, 0)
+    pulls = residual * np.sqrt(inv)
+    # inverse of diag + s u u^T (Sherman-Morrison)
+    u_inv_r = (u * inv * residual).sum(-1)
+    u_inv_u = (u * inv * u).sum(-1)
+    chi2 = (residual**2 * inv).sum(-1) - s * u_inv_r**2 / (1 + s * u_inv_u)
+    sum_obs, sum_pred = observed.sum(-1), pred.sum(-1)
+    var_sum_pred = var_pred.sum(-1) + s * u.sum(-1)**2
+    ratio = np.divide(sum_obs, sum_pred, out=np.full_like(sum_obs, np.nan), where=sum_pred > 0)
+    ratio_unc = np.abs(ratio) * np.sqrt(
+        np.divide(var_observed.sum(-1), sum_obs**2, out=np.zeros_like(sum_obs), where=sum_obs != 0)
+        + np.divide(var_sum_pred, sum_pred**2, out=np.zeros_like(sum_pred), where=sum_pred != 0))
+    return {
+        "chi2": chi2,
+        "ndof": used.sum(-1),
+        "max_abs_pull": np.abs(pulls).max(-1, initial=0),
+        "pulls": pulls,
+        "observed": sum_obs,
+        "predicted": sum_pred,
+        "ratio": ratio,
+        "ratio_unc": ratio_unc,
+    }
+
+
+class ABCDInputs:
+    """Histograms of one file for all datasets and categories, scaled to
+    the luminosity"""
+
+    def __init__(self, values, variances, edges, datasets, categories, groups):
+        self.values = values
+        self.variances = variances
+        self.edges = edges
+        self.datasets = list(datasets)
+        self.categories = list(categories)
+        # (n_groups, n_datasets)
+        self.group_names = list(groups)
+        self.groups = np.array([[dataset in groups[group] for dataset in self.datasets]
+                                for group in self.group_names], dtype=np.float64)
+
+    @classmethod
+    def load(cls, histfile, groups, categories, scales, rebin_factor=1):
+        """groups: {group: [datasets]}, scales: {dataset: lumi * xsec / N}"""
+        datasets = [dataset for group in groups.values() for dataset in group]
+        names = [f"{dataset}_{category}" for dataset in datasets for category in categories]
+        values, variances, edges = read_arrays(histfile, names)
+        shape = (len(datasets), len(categories)) + values.shape[1:]
+        scale = np.array([scales[dataset] for dataset in datasets])
+        scale = scale.reshape((-1,) + (1,) * (len(shape) - 1))
+        values = values.reshape(shape) * scale
+        variances = variances.reshape(shape) * scale**2
+        values, new_edges = rebin(values, edges, rebin_factor)
+        variances, _ = rebin(variances, edges, rebin_factor)
+        return cls(values, variances, new_edges, datasets, categories, groups)
+
+    def membership(self, constructs):
+        """(n_definitions, 4, n_categories) region membership"""
+        result = np.zeros((len(constructs), len(REGIONS), len(self.categories)))
+        for i, construct in enumerate(constructs):
+            for j, categories in enumerate(region_categories(construct).values()):
+                for category in categories:
+                    result[i, j, self.categories.index(category)] = 1
+        return result
+
+    def regions(self, constructs, per_group=False):
+        """values and variances summed into the regions of every definition,
+        (n_definitions, 4, [n_groups,] *bins)"""
+        membership = self.membership(constructs)
+        if per_group:
+            values = np.einsum("gd,krc,dc...->krg...", self.groups, membership, self.values)
+            variances = np.einsum("gd,krc,dc...->krg...", self.groups, membership, self.variances)
+        else:
+            weight = self.groups.sum(0)
+            values = np.einsum("d,krc,dc...->kr...", weight, membership, self.values)
+            variances = np.einsum("d,krc,dc...->kr...", weight, membership, self.variances)
+        return values, variances
+
+    def evaluate(self, constructs, mode="binned"):
+        """Prediction of A and closure metrics for every definition"""
+        values, variances = self.regions(constructs)
+        n_def = len(constructs)
+        flat = values.reshape(n_def, len(REGIONS), -1)
+        flat_var = variances.reshape(n_def, len(REGIONS), -1)
+        a, b, c, d = (flat[:, i] for i in range(4))
+        var_a, var_b, var_c, var_d = (flat_var[:, i] for i in range(4))
+        pred, var_pred, u, s = predict(b, c, d, var_b, var_c, var_d, mode)
+        metrics = closure(a, var_a, pred, var_pred, u, s)
+        shape = (n_def,) + values.shape[2:]
+        return {
+            "observed": a.reshape(shape),
+            "var_observed": var_a.reshape(shape),
+            "predicted": pred.reshape(shape),
+            "var_predicted": var_pred.reshape(shape),
+            "metrics": metrics,
+        }
+
+
+def closure_summary(metrics, names):
+    """JSON-able metrics per definition name"""
+    summary = {}
+    for i, name in enumerate(names):
+        summary[name] = {
+            "chi2": float(metrics["chi2"][i]),
+            "ndof": int(metrics["ndof"][i]),
+            "max_abs_pull": float(metrics["max_abs_pull"][i]),
+            "observed": float(metrics["observed"][i]),
+            "predicted": float(metrics["predicted"][i]),
+            "ratio": float(metrics["ratio"][i]),
+            "ratio_unc": float(metrics["ratio_unc"][i]),
+        }
+    return summary
+
+
+def write_closure(path, closures):
+    """closures: {histogram: {definition: metrics}}"""
+    with open(path + ".tmp", "w") as f:
+        json.dump(closures, f, indent=4)
+    os.replace(path + ".tmp", path)
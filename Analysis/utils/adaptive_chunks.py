@@ -0,0 +1,218 @@
+import os
+import json
+import time
+import socket
+import resource
+import logging
+
+import numpy as np
+
+# Chunk sizes from the memory needed per event.
+# The memory added while processing a chunk is modelled as
+#     bytes = per_event * n_events + sum_c per_object[c] * n_objects[c]
+# with the object multiplicities taken from the counter branches
+# (nPFCandidate, nJet, ...) of every file, which are read before processing.
+# Every file gets the largest chunk size for which all of its chunks (as
+# split by coffea, equal parts of the file) stay below the memory budget.
+# Processors with the MemoryProbeMixin append the measured peak RSS of every
+# chunk to the file given by "memory_log" in the config, the model is refit
+# from these records (see adaptive_runproc.py).
+
+logger = logging.getLogger(__name__)
+
+# bytes per object (per event for "events") as starting point of the model
+DEFAULT_MODEL = {
+    "events": 4000.,
+    "PFCandidate": 350.,
+    "Jet": 900.,
+    "GenPart": 250.,
+    "Muon": 600.,
+    "Electron": 600.,
+    "Tau": 600.,
+    "SV": 300.,
+}
+
+# records needed before the per-object coefficients are fit individually,
+# with less only the overall scale of the model is adjusted
+MIN_RECORDS_PER_PARAMETER = 3
+
+
+def read_multiplicities(path, collections, treename="Events"):
+    """Number of events and objects per event of the collections (from their
+    counter branches, collections without one are skipped)"""
+    import uproot
+    with uproot.open(path) as f:
+        tree = f[treename]
+        branches = [f"n{name}" for name in collections if f"n{name}" in tree]
+        counts = tree.arrays(branches, library="np") if len(branches) > 0 else {}
+        n_events = tree.num_entries
+    return n_events, {branch[1:]: np.asarray(values, dtype=np.int64)
+                      for branch, values in counts.items()}
+
+
+class MemoryModel:
+
+    def __init__(self, coefficients=None):
+        self.coefficients = dict(DEFAULT_MODEL if coefficients is None else coefficients)
+
+    @classmethod
+    def load(cls, path):
+        if path is None or not os.path.exists(path):
+            return cls()
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.coefficients, f, indent=4)
+        os.replace(path + ".tmp", path)
+
+    @property
+    def collections(self):
+        return [name for name in self.coefficients if name != "events"]
+
+    def per_event(self, n_events, counts):
+        """Estimated bytes for every event"""
+        memory = np.full(n_events, self.coefficients["events"])
+        for name, values in counts.items():
+            if name in self.coefficients:
+                memory += self.coefficients[name] * values
+        return memory
+
+    def features(self, n_events, counts, start, stop):
+        # per chunk: number of events and summed multiplicities
+        return [stop - start] + [
+            float(counts[name][start:stop].sum()) if name in counts else 0.
+            for name in self.collections]
+
+    def fit(self, features, observed):
+        """Refit to the observed bytes per chunk"""
+        features = np.asarray(features, dtype=np.float64)
+        observed = np.asarray(observed, dtype=np.float64)
+        if len(observed) == 0:
+            return
+        names = ["events"] + self.collections
+        current = np.array([self.coefficients[name] for name in names])
+        predicted = features @ current
+        if len(observed) >= MIN_RECORDS_PER_PARAMETER * len(names):
+            solution, _, rank, _ = np.linalg.lstsq(features, observed, rcond=None)
+            if rank == len(names) and np.all(solution >= 0):
+                self.coefficients = dict(zip(names, solution.tolist()))
+                return
+        # not enough (or degenerate) records, only the scale is adjusted
+        valid = predicted > 0
+        if np.any(valid):
+            scale = float(np.median(observed[valid] / predicted[valid]))
+            self.coefficients = {name: value * scale for name, value in self.coefficients.items()}
+
+
+def file_chunksize(memory, budget, max_chunksize=None, min_chunksize=1):
+    """Largest chunk size for which the file (estimated bytes per event) split
+    in equal parts as coffea does stays below the budget"""
+    n_events = len(memory)
+    if n_events == 0:
+        return max_chunksize or min_chunksize
+    cumulative = np.concatenate(([0.], np.cumsum(memory)))
+    n_chunks = max(int(np.ceil(cumulative[-1] / budget)), 1)
+    if max_chunksize is not None:
+        n_chunks = max(n_chunks, int(np.ceil(n_events / max_chunksize)))
+    while True:
+        size = int(np.ceil(n_events / n_chunks))
+        if size <= min_chunksize:
+            return min_chunksize
+        edges = np.minimum(np.arange(0, n_events + size, size), n_events)
+        if np.max(np.diff(cumulative[edges])) <= budget:
+            return size
+        n_chunks = max(n_chunks + 1, int(n_chunks * 1.05))
+
+
+def coffea_chunksize(chunksizes, n_events):
+    """Chunk size argument for a group of files: with coffea splitting a file
+    in round(n / chunksize) equal parts no chunk is larger than the one
+    planned for its file. Files without events do not constrain it, for a
+    group of only such files the largest planned chunk size is used"""
+    sizes = [n / np.ceil(n / size) for size, n in zip(chunksizes, n_events) if n > 0]
+    if len(sizes) == 0:
+        return max(chunksizes)
+    return min(sizes)
+
+
+def _read_status(field):
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(field + ":"):
+                return int(line.split()[1]) * 1024
+    raise OSError(f"{field} not found")
+
+
+def _reset_peak():
+    # resets VmHWM to the current RSS (Linux >= 4.0)
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def rss():
+    try:
+        return _read_status("VmRSS")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def peak_rss():
+    try:
+        return _read_status("VmHWM")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def read_memory_log(path):
+    records = []
+    if not os.path.exists(path):
+        return records
+    with open(path) as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                continue
+    return records
+
+
+class MemoryProbeMixin:
+    """Processor mixin recording the peak RSS increase of every chunk.
+
+    Enabled by setting ``memory_log`` in the config to a JSON-lines file,
+    it is only exact if the peak can be reset (Linux >= 4.0), otherwise only
+    chunks raising the peak of the process are recorded."""
+
+    def process(self, data):
+        if not ("memory_log" in self.config and self.config["memory_log"]):
+            return super().process(data)
+        reset = _reset_peak()
+        before = rss()
+        peak_before = peak_rss()
+        start = time.time()
+        output = super().process(data)
+        peak = peak_rss()
+        if reset or peak > peak_before:
+            metadata = data.metadata
+            line = json.dumps({
+                "filename": metadata["filename"],
+                "dataset": metadata.get("dataset"),
+                "entrystart": int(metadata["entrystart"]),
+                "entrystop": int(metadata["entrystop"]),
+                "rss_before": before,
+                "peak_rss": peak,
+                "time": time.time() - start,
+                "host": socket.gethostname(),
+            }) + "\n"
+            try:
+                with open(self.config["memory_log"], "a") as f:
+                    f.write(line)
+            except OSError as e:
+                logger.warning(f"Could not write memory log: {e}")
+        return output
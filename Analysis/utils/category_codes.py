@@ -0,0 +1,139 @@
+import os
+import json
+import itertools
+from argparse import ArgumentParser
+
+import numpy as np
+
+# Dense integer encoding of event categories.
+# All category axes of an event (e.g. number of tight tagged jets and the
+# search bin) are packed into one code
+#     code = ((i_0 * n_1) + i_1) * n_2 + i_2 ...
+# so a histogram is filled once along the code axis instead of once per
+# category, events outside of all categories get the code -1 (underflow).
+# The per-category histograms are recovered afterwards, either as numpy views
+# (CategoryCode.split) or written to ROOT files in the usual pepper layout
+# <dataset>/<systematic>/<category>/hist with
+#   python utils/category_codes.py ./output/hists/hists.json search_code --name binning_schema_pass
+
+
+class CategoryCode:
+
+    def __init__(self, axes):
+        # axes: list of (name, list of labels), first axis is the slowest
+        self.names = [name for name, _ in axes]
+        self.labels = [list(labels) for _, labels in axes]
+        self.shape = tuple(len(labels) for labels in self.labels)
+        self.n_codes = int(np.prod(self.shape))
+
+    def encode(self, *indices):
+        """Code from one integer index array per axis, -1 if any index is
+        out of range (NaN and negative values included)"""
+        valid = np.ones(len(indices[0]), dtype=bool)
+        clean = []
+        for index, size in zip(indices, self.shape):
+            index = np.asarray(index, dtype=np.float64)
+            valid &= (index >= 0) & (index < size)
+            clean.append(np.where(valid, index, 0).astype(np.int64))
+        code = np.ravel_multi_index(clean, self.shape)
+        return np.where(valid, code, -1)
+
+    def decode(self, code):
+        code = np.asarray(code)
+        indices = np.unravel_index(np.where(code >= 0, code, 0), self.shape)
+        return [np.where(code >= 0, index, -1) for index in indices]
+
+    def categories(self):
+        """Label tuples in the order of the codes"""
+        return list(itertools.product(*self.labels))
+
+    def split(self, values):
+        """View of the per-code values (first axis) as one axis per category"""
+        values = np.asarray(values)
+        return values.reshape(self.shape + values.shape[1:])
+
+
+# number of tight tagged jets (as tight_bin0/1/2) x search bins B1-B5
+SEARCH_CODE = CategoryCode([
+    ("tagged_jets", ["bin0", "bin1", "bin2"]),
+    ("search_bin", ["B1", "B2", "B3", "B4", "B5"]),
+])
+
+
+def search_bin(jet2_pt, met, mt2):
+    """Index of the search bin (0 for B1 ... 4 for B5), NaN if none applies"""
+    jet2_pt = np.asarray(jet2_pt, dtype=np.float64)
+    met = np.asarray(met, dtype=np.float64)
+    mt2 = np.asarray(mt2, dtype=np.float64)
+    low_pt = np.where(met >= 250, 0, np.where(mt2 < 100, 1, np.where(mt2 >= 100, 2, np.nan)))
+    index = np.where(jet2_pt >= 100, 4, np.where(jet2_pt >= 50, 3, low_pt))
+    # comparisons with NaN are all False, keep these events uncategorized
+    return np.where(np.isnan(jet2_pt) | np.isnan(met), np.nan, index)
+
+
+def split_code_file(path, out_path, code, nbins, lo, hi, value_offset=1):
+    """Write the per-category histograms of a code histogram file.
+
+    The last axis of ``code`` is used as x axis of the new histograms
+    (index i filled at value i + value_offset with nbins in [lo, hi]),
+    the other axes form the category name."""
+    import ROOT
+    in_file = ROOT.TFile.Open(path, "read")
+    out_file = ROOT.TFile.Open(out_path, "recreate")
+    n_x = code.shape[-1]
+    outer = list(itertools.product(*code.labels[:-1]))
+
+    def walk(directory, prefix):
+        for key in directory.GetListOfKeys():
+            obj = key.ReadObj()
+            name = prefix + [key.GetName()]
+            if obj.InheritsFrom("TDirectory"):
+                walk(obj, name)
+            elif obj.InheritsFrom("TH1"):
+                for i_cat, labels in enumerate(outer):
+                    path_out = "/".join(name[:-1] + ["_".join(labels)])
+                    if not out_file.GetDirectory(path_out):
+                        out_file.mkdir(path_out)
+                    out_file.cd(path_out)
+                    hist = ROOT.TH1D(name[-1], obj.GetTitle(), nbins, lo, hi)
+                    for i_x in range(n_x):
+                        src = obj.FindBin(i_cat * n_x + i_x + 0.5)
+                        dst = hist.FindBin(i_x + value_offset)
+                        hist.SetBinContent(dst, obj.GetBinContent(src))
+                        hist.SetBinError(dst, obj.GetBinError(src))
+                    hist.SetEntries(obj.GetEntries())
+                    hist.Write()
+
+    walk(in_file, [])
+    out_file.Close()
+    in_file.Close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Split histograms filled along a category code into the per-category layout")
+    parser.add_argument("histjson", help="hists.json of the pepper output")
+    parser.add_argument("histname", help="Name of the code histogram, e.g. search_code")
+    parser.add_argument("--name", required=True, help="Name of the new histograms")
+    parser.add_argument("--nbins", type=int, default=11)
+    parser.add_argument("--lo", type=float, default=-1)
+    parser.add_argument("--hi", type=float, default=10)
+    args = parser.parse_args()
+
+    dirname = os.path.dirname(args.histjson)
+    with open(args.histjson) as f:
+        index = json.load(f)
+    keys_all, files_all = index["content"]
+    for keys, histfile in list(zip(keys_all, files_all)):
+        if keys[-1] != args.histname:
+            continue
+        new_keys = keys[:-1] + [args.name]
+        new_file = histfile.replace(args.histname, args.name)
+        print(f"{histfile} -> {new_file}")
+        split_code_file(os.path.join(dirname, histfile), os.path.join(dirname, new_file),
+                        SEARCH_CODE, args.nbins, args.lo, args.hi)
+        if new_keys not in keys_all:
+            keys_all.append(new_keys)
+            files_all.append(new_file)
+    with open(args.histjson, "w") as f:
+        json.dump(index, f, indent=4)
@@ -0,0 +1,344 @@
+import os
+import sys
+import json
+import time
+import fcntl
+import shutil
+import socket
+import inspect
+import hashlib
+import logging
+import threading
+from argparse import ArgumentParser
+
+import coffea.util
+
+# On-disk cache of the per-chunk processor outputs.
+# The key of a chunk is built from the input file (path, uuid and mtime), the
+# entry range, a hash of the processor source together with the modules of
+# utils/ it imports, a hash of the config with the keys that do not influence
+# the chunk output removed and a hash of the content of the files the config
+# points to (histogram definitions, scale factors, pileup, ...). Entries are stored
+# as <key>.coffea in the cache directory, files written next to the output
+# (e.g. parquet skims) are copied to <key>.files/ and restored on a hit.
+# Least recently used entries are removed once the cache exceeds max_size.
+# Every lookup is appended to stats.jsonl, a summary is printed with
+#   python utils/chunk_cache.py report /path/to/cache
+#   python utils/chunk_cache.py clear /path/to/cache
+
+logger = logging.getLogger(__name__)
+
+# config keys that do not change the content of a chunk output
+IGNORED_CONFIG_KEYS = [
+    "chunk_cache", "chunk_cache_max_size", "chunk_cache_ignore",
+    "exp_datasets", "mc_datasets",
+    "file_mode", "xrootddomain", "bad_file_paths", "store",
+    "histogram_format", "hists_to_plot",
+    "memory_log", "input_stage", "input_stage_max_size", "input_stage_prefetch",
+]
+
+
+def _hash(obj):
+    text = json.dumps(obj, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def file_hash(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def source_hash(obj):
+    """Hash of the source file defining ``obj`` (class or module) and of
+    the loaded modules of utils/, which the processors import"""
+    module = inspect.getmodule(obj)
+    paths = {os.path.realpath(inspect.getsourcefile(module))}
+    utils_dir = os.path.dirname(os.path.realpath(__file__))
+    for loaded in list(sys.modules.values()):
+        path = getattr(loaded, "__file__", None)
+        if path is None or not path.endswith(".py"):
+            continue
+        path = os.path.realpath(path)
+        if os.path.dirname(path) == utils_dir:
+            paths.add(path)
+    return _hash({os.path.basename(path): file_hash(path) for path in sorted(paths)})
+
+
+def _config_strings(value):
+    if isinstance(value, str):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from _config_strings(item)
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from _config_strings(item)
+
+
+def _expand_path(value, config, raw):
+    # pepper replaces $CONFDIR (special_vars), $STOREDIR and $DATADIR
+    special_vars = getattr(config, "special_vars", None) or {}
+    for var, path in special_vars.items():
+        if isinstance(path, str):
+            value = value.replace(var, path)
+    for var, key in (("$STOREDIR", "store"), ("$DATADIR", "datadir")):
+        if key in raw and isinstance(raw[key], str):
+            value = value.replace(var, raw[key])
+    return value
+
+
+def config_files_hash(config, ignore=()):
+    """Hash of the content of the files the config points to, e.g. the
+    histogram definitions and the scale factor and pileup inputs"""
+    raw = getattr(config, "_config", config)
+    ignore = set(IGNORED_CONFIG_KEYS) | set(ignore)
+    hashes = {}
+    for key, value in raw.items():
+        if key in ignore:
+            continue
+        for text in _config_strings(value):
+            path = _expand_path(text, config, raw)
+            if "$" in path:
+                logger.debug(f"Could not resolve {text} of {key} for the chunk cache key")
+            elif os.path.isfile(path):
+                hashes[f"{key}:{text}"] = file_hash(path)
+    return _hash(hashes)
+
+
+def config_hash(config, ignore=()):
+    """Hash of the raw config content, skipping the keys in ``ignore``"""
+    # pepper keeps the parsed json in _config, keys set at runtime
+    # (e.g. histogram_format in the processor __init__) are not part of it
+    raw = getattr(config, "_config", config)
+    ignore = set(IGNORED_CONFIG_KEYS) | set(ignore)
+    return _hash({k: v for k, v in raw.items() if k not in ignore})
+
+
+def file_fingerprint(metadata):
+    filename = metadata["filename"]
+    fingerprint = {
+        "filename": filename,
+        "fileuuid": str(metadata.get("fileuuid", "")),
+        "treename": metadata.get("treename"),
+        "dataset": metadata.get("dataset"),
+        "entrystart": int(metadata["entrystart"]),
+        "entrystop": int(metadata["entrystop"]),
+    }
+    # remote files (root://) have no mtime available, the uuid is used then
+    if os.path.exists(filename):
+        fingerprint["mtime"] = os.stat(filename).st_mtime_ns
+    return fingerprint
+
+
+class ChunkCache:
+
+    def __init__(self, cache_dir, max_size=None):
+        # max_size in GB, None for no limit
+        self.cache_dir = cache_dir
+        self.max_size = None if max_size is None else float(max_size) * 1024**3
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, metadata, *hashes):
+        return _hash([file_fingerprint(metadata)] + list(hashes))
+
+    def _output_path(self, key):
+        return os.path.join(self.cache_dir, key + ".coffea")
+
+    def _files_dir(self, key):
+        return os.path.join(self.cache_dir, key + ".files")
+
+    def get(self, key):
+        path = self._output_path(key)
+        try:
+            output = coffea.util.load(path)
+        except (OSError, EOFError):
+            self.record(key, False)
+            return None
+        files_dir = self._files_dir(key)
+        if os.path.isdir(files_dir):
+            with open(os.path.join(files_dir, "files.json")) as f:
+                files = json.load(f)
+            for name, target in files.items():
+                if not os.path.exists(target):
+                    os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+                    shutil.copy2(os.path.join(files_dir, name), target)
+        # mtime is used as time of last access for the LRU eviction
+        os.utime(path, None)
+        self.record(key, True)
+        return output
+
+    def put(self, key, output, files=()):
+        tmp = self._output_path(key) + f".tmp{os.getpid()}"
+        coffea.util.save(output, tmp)
+        if len(files) > 0:
+            files_dir = self._files_dir(key)
+            os.makedirs(files_dir, exist_ok=True)
+            index = {}
+            for i, target in enumerate(files):
+                name = f"{i}_{os.path.basename(target)}"
+                shutil.copy2(target, os.path.join(files_dir, name))
+                index[name] = os.path.abspath(target)
+            with open(os.path.join(files_dir, "files.json"), "w") as f:
+                json.dump(index, f)
+        # the output file is moved in last, it marks the entry as complete
+        os.replace(tmp, self._output_path(key))
+        if self.max_size is not None:
+            self.evict()
+
+    def entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".coffea"):
+                continue
+            key = name[:-len(".coffea")]
+            path = self._output_path(key)
+            try:
+                size = os.path.getsize(path)
+                last_used = os.path.getmtime(path)
+            except OSError:
+                continue
+            files_dir = self._files_dir(key)
+            if os.path.isdir(files_dir):
+                for sub in os.listdir(files_dir):
+                    size += os.path.getsize(os.path.join(files_dir, sub))
+            entries.append((last_used, size, key))
+        return entries
+
+    def remove(self, key):
+        try:
+            os.remove(self._output_path(key))
+        except FileNotFoundError:
+            pass
+        shutil.rmtree(self._files_dir(key), ignore_errors=True)
+
+    def evict(self):
+        with open(os.path.join(self.cache_dir, ".lock"), "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = sorted(self.entries())
+            total = sum(size for _, size, _ in entries)
+            for _, size, key in entries:
+                if total <= self.max_size:
+                    break
+                self.remove(key)
+                total -= size
+                logger.debug(f"Evicted chunk cache entry {key}")
+
+    def record(self, key, hit):
+        line = json.dumps({
+            "key": key, "hit": hit, "time": time.time(),
+            "host": socket.gethostname()}) + "\n"
+        # single small appends are atomic, several workers can share the file
+        with open(os.path.join(self.cache_dir, "stats.jsonl"), "a") as f:
+            f.write(line)
+
+    def report(self, since=None):
+        hits, misses = 0, 0
+        path = os.path.join(self.cache_dir, "stats.jsonl")
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if since is not None and record["time"] < since:
+                        continue
+                    if record["hit"]:
+                        hits += 1
+                    else:
+                        misses += 1
+        entries = self.entries()
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / (hits + misses) if hits + misses > 0 else None,
+            "n_entries": len(entries),
+            "size_gb": sum(size for _, size, _ in entries) / 1024**3,
+        }
+
+
+class ChunkCacheMixin:
+    """Processor mixin caching the output of ``process`` per chunk.
+
+    Enabled by setting ``chunk_cache`` in the config to the cache directory,
+    ``chunk_cache_max_size`` (GB) limits the size and ``chunk_cache_ignore``
+    lists additional config keys not entering the hash."""
+
+    _chunk_files = threading.local()
+
+    def _get_chunk_cache(self):
+        if not ("chunk_cache" in self.config and self.config["chunk_cache"]):
+            return None
+        if getattr(self, "_chunk_cache", None) is None:
+            max_size = None
+            if "chunk_cache_max_size" in self.config:
+                max_size = self.config["chunk_cache_max_size"]
+            ignore = []
+            if "chunk_cache_ignore" in self.config:
+                ignore = self.config["chunk_cache_ignore"]
+            self._chunk_cache = ChunkCache(self.config["chunk_cache"], max_size)
+            self._chunk_cache_hashes = (
+                source_hash(type(self)), config_hash(self.config, ignore),
+                config_files_hash(self.config, ignore))
+        return self._chunk_cache
+
+    def __getstate__(self):
+        # the cache object is recreated on the worker
+        state = self.__dict__.copy()
+        state.pop("_chunk_cache", None)
+        return state
+
+    def register_chunk_file(self, path):
+        """Register a file written while processing the current chunk,
+        it is stored in the cache together with the output"""
+        files = getattr(self._chunk_files, "paths", None)
+        if files is not None:
+            files.append(path)
+
+    def process(self, data):
+        cache = self._get_chunk_cache()
+        if cache is None:
+            return super().process(data)
+        key = cache.key(data.metadata, *self._chunk_cache_hashes)
+        output = cache.get(key)
+        if output is not None:
+            return output
+        self._chunk_files.paths = []
+        try:
+            output = super().process(data)
+            files = self._chunk_files.paths
+        finally:
+            self._chunk_files.paths = None
+        try:
+            cache.put(key, output, files)
+        except OSError as e:
+            logger.warning(f"Could not write chunk cache entry: {e}")
+        return output
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Inspect or clear a chunk cache")
+    parser.add_argument("command", choices=["report", "clear"])
+    parser.add_argument("cache_dir")
+    parser.add_argument("--since", type=float, default=None,
+                        help="Only count lookups in the last N hours")
+    args = parser.parse_args()
+
+    cache = ChunkCache(args.cache_dir)
+    if args.command == "report":
+        since = None if args.since is None else time.time() - args.since * 3600
+        result = cache.report(since)
+        rate = "-" if result["hit_rate"] is None else f"{100 * result['hit_rate']:.1f}%"
+        print(f"lookups: {result['hits'] + result['misses']} "
+              f"(hits {result['hits']}, misses {result['misses']}, hit rate {rate})")
+        print(f"entries: {result['n_entries']}, size: {result['size_gb']:.2f} GB")
+    elif args.command == "clear":
+        for _, _, key in cache.entries():
+            cache.remove(key)
+        stats = os.path.join(args.cache_dir, "stats.jsonl")
+        if os.path.exists(stats):
+            os.remove(stats)
+        print(f"Cleared {args.cache_dir}")
@@ -0,0 +1,305 @@
+import os
+import json
+import logging
+from functools import wraps
+
+import numpy as np
+import awkward as ak
+
+# Memory-lean columns of the selector.
+# Columns set with set_column / set_multiple_columns keep all fields of the
+# NanoAOD collection they come from plus the added ones, often promoted to
+# float64, and stay in the selector data until the end of the selection.
+# With "column_compaction" in the processor config
+#     "column_compaction": {
+#         "fields": {"Jet_lead_pfcand": ["dxy", "dz", ...]},
+#         "float32": {"Jet_select": ["dxy", "dxysig", ...]},
+#         "release": ["PfCands", "Jet_lead_pfcand"],
+#         "trace_dir": "./output/column_traces"
+#     }
+# every column listed in "fields" keeps only these fields, the fields listed
+# in "float32" are stored as float32, and the columns in "release" are
+# removed from the selector data after their last use.
+# The last use comes from a liveness analysis of the set_column / add_cut
+# sequence: the first chunk of every dataset is run with all columns and the
+# columns read by every step (data[...] or data.<column> in the step
+# function) are recorded; later chunks of the dataset run the same sequence
+# and drop a released column after the last step reading it. Columns filled
+# into histograms and categories are never released. Chunks in which a step
+# runs on no events (zero_handler skips the reads) are not used as trace, and
+# if the sequence of a chunk differs from the trace nothing more is released
+# in it.
+# The executors unpickle a new processor for every chunk, so the traces are
+# kept per worker process and, with "trace_dir" (a directory all workers can
+# read, e.g. on the shared file system of the condor jobs), written to
+# <trace_dir>/<processor>_<dataset>_<mc|data>.json for the other workers and
+# the next runs. Use a new trace_dir after changing the selection.
+# Not enabled in the configs yet: the peak RSS per chunk with and without
+# compaction ("memory_log", see utils/adaptive_chunks.py) has to be compared
+# on real chunks first.
+
+logger = logging.getLogger(__name__)
+
+_tracing_classes = {}
+
+
+def _tracing_class(cls):
+    """Subclass of an awkward array class recording the fields read"""
+    if cls not in _tracing_classes:
+        def __getitem__(self, where):
+            if isinstance(where, str):
+                type(self).reads.add(where)
+            elif isinstance(where, (list, tuple)):
+                type(self).reads.update(x for x in where if isinstance(x, str))
+            return cls.__getitem__(self, where)
+
+        def __getattr__(self, where):
+            # only called for names which are not attributes of the class,
+            # i.e. the fields (data.Jet)
+            if not where.startswith("_"):
+                type(self).reads.add(where)
+            return cls.__getattr__(self, where)
+
+        _tracing_classes[cls] = type("Tracing" + cls.__name__, (cls,),
+                                     {"__getitem__": __getitem__, "__getattr__": __getattr__,
+                                      "reads": set()})
+    return _tracing_classes[cls]
+
+
+def traced_call(func, data):
+    """func(data) and the fields of data read by it, None if they can not
+    be recorded"""
+    cls = type(data)
+    tracing = _tracing_class(cls)
+    try:
+        data.__class__ = tracing
+    except TypeError:
+        return func(data), None
+    tracing.reads = set()
+    try:
+        return func(data), tracing.reads
+    finally:
+        data.__class__ = cls
+
+
+def compact(column, fields=None, float32=()):
+    """Column with only the given fields, float32 fields as float32"""
+    if not isinstance(column, ak.Array) or len(ak.fields(column)) == 0:
+        return column
+    if fields is not None:
+        keep = [field for field in ak.fields(column) if field in fields]
+        column = column[keep]
+    for field in float32:
+        if field in ak.fields(column):
+            column[field] = ak.values_astype(column[field], np.float32)
+    return column
+
+
+class ColumnTrace:
+    """Step sequence of a dataset with the columns read by every step"""
+
+    def __init__(self, steps, reads):
+        self.steps = steps
+        self.reads = reads
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            trace = json.load(f)
+        return cls([tuple(step) for step in trace["steps"]],
+                   [None if reads is None else set(reads) for reads in trace["reads"]])
+
+    def save(self, path):
+        # written to a temporary file first, other workers may read the file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"steps": [list(step) for step in self.steps],
+                       "reads": [None if reads is None else sorted(reads)
+                                 for reads in self.reads]}, f)
+        os.replace(tmp_path, path)
+
+    def release_after(self, columns, pinned=()):
+        """{step index: [columns]} dropped after the last step using them,
+        nothing if the reads of a step are unknown"""
+        if any(reads is None for reads in self.reads):
+            return {}
+        last = {}
+        for i, (step, reads) in enumerate(zip(self.steps, self.reads)):
+            for column in columns:
+                if column not in pinned and (column in reads or step[1] == column):
+                    last[column] = i
+        result = {}
+        for column, i in last.items():
+            result.setdefault(i, []).append(column)
+        return result
+
+
+class ColumnCompaction:
+    """Wraps the column methods of a selector for one chunk"""
+
+    def __init__(self, config, trace=None, pinned=()):
+        self.fields = {name: set(fields) for name, fields in config.get("fields", {}).items()}
+        self.float32 = {name: list(fields) for name, fields in config.get("float32", {}).items()}
+        self.release = list(config.get("release", []))
+        self.trace = trace
+        self.pinned = set(pinned)
+        self.release_plan = {} if trace is None else trace.release_after(self.release, self.pinned)
+        self.steps = []
+        self.reads = []
+        self.complete = True
+        self.diverged = False
+
+    def compact(self, name, column):
+        if name not in self.fields and name not in self.float32:
+            return column
+        return compact(column, self.fields.get(name), self.float32.get(name, ()))
+
+    def _step(self, kind, name, func=None):
+        """Record the step, func(data) is run with its reads recorded"""
+        index = len(self.steps)
+        self.steps.append((kind, name))
+        self.reads.append(set())
+        if self.trace is not None and not self.diverged:
+            if index >= len(self.trace.steps) or self.trace.steps[index] != (kind, name):
+                self.diverged = True
+                logger.debug(f"Column sequence differs from the trace at {kind} {name}")
+        if func is None:
+            return None
+
+        def traced(data):
+            if len(data) == 0:
+                self.complete = False
+            result, self.reads[index] = traced_call(func, data)
+            return result
+
+        return traced
+
+    def _release(self, selector):
+        index = len(self.steps) - 1
+        if self.diverged or index not in self.release_plan:
+            return
+        pinned = set(self.pinned)
+        for names in (getattr(selector, "cats", None) or {}).values():
+            pinned.update(names)
+        fields = ak.fields(selector.data)
+        release = [column for column in self.release_plan[index]
+                   if column not in pinned and column in fields]
+        if len(release) == 0:
+            return
+        # rebuilt from the remaining fields (ak.without_field is not available
+        # in awkward 1.x), keeping the record name and behavior of the events
+        data = selector.data
+        selector.data = ak.zip(
+            {field: data[field] for field in fields if field not in release},
+            depth_limit=1, with_name=data.layout.purelist_parameter("__record__"),
+            behavior=data.behavior)
+
+    def attach(self, selector):
+        set_column = selector.set_column
+        set_multiple_columns = selector.set_multiple_columns
+        add_cut = selector.add_cut
+
+        @wraps(set_column)
+        def compact_set_column(column_name, column, *args, **kwargs):
+            if callable(column):
+                traced = self._step("column", column_name, column)
+                column = lambda data: self.compact(column_name, traced(data))
+            else:
+                self._step("column", column_name)
+                column = self.compact(column_name, column)
+            result = set_column(column_name, column, *args, **kwargs)
+            self._release(selector)
+            return result
+
+        @wraps(set_multiple_columns)
+        def compact_set_multiple_columns(columns, *args, **kwargs):
+            def compact_all(columns):
+                if not isinstance(columns, dict):
+                    return columns
+                return {name: self.compact(name, column) for name, column in columns.items()}
+
+            if callable(columns):
+                name = getattr(getattr(columns, "func", columns), "__name__", "")
+                traced = self._step("columns", name, columns)
+                columns = lambda data: compact_all(traced(data))
+            else:
+                self._step("columns", "")
+                columns = compact_all(columns)
+            result = set_multiple_columns(columns, *args, **kwargs)
+            self._release(selector)
+            return result
+
+        @wraps(add_cut)
+        def compact_add_cut(name, accept, *args, **kwargs):
+            if callable(accept):
+                accept = self._step("cut", name, accept)
+            else:
+                self._step("cut", name)
+            result = add_cut(name, accept, *args, **kwargs)
+            self._release(selector)
+            return result
+
+        selector.set_column = compact_set_column
+        selector.set_multiple_columns = compact_set_multiple_columns
+        selector.add_cut = compact_add_cut
+        return selector
+
+    def result_trace(self):
+        """Trace of this chunk if it can be used for the next ones"""
+        if not self.complete or self.diverged:
+            return None
+        return ColumnTrace(self.steps, self.reads)
+
+
+def hist_columns(filler):
+    """Columns read by the histograms of an OutputFiller"""
+    columns = set()
+    for definition in getattr(filler, "hist_dict", {}).values():
+        for method in getattr(definition, "fill_methods", {}).values():
+            if isinstance(method, dict):
+                # categories of the histogram config, {value: path}
+                paths = method.values()
+            else:
+                paths = [method]
+            for path in paths:
+                if len(path) > 0 and isinstance(path[0], str):
+                    columns.add(path[0])
+    return columns
+
+
+# traces of the worker process, {(processor, dataset, is_mc): ColumnTrace}
+_column_traces = {}
+
+
+class ColumnCompactionMixin:
+    """Processor mixin compacting the selector columns, enabled by
+    "column_compaction" in the config"""
+
+    def _column_trace_path(self, trace_dir, dsname, is_mc):
+        name = f"{type(self).__name__}_{dsname}_{'mc' if is_mc else 'data'}.json"
+        return os.path.join(trace_dir, name)
+
+    def process_selection(self, selector, dsname, is_mc, filler):
+        if not ("column_compaction" in self.config and self.config["column_compaction"]):
+            return super().process_selection(selector, dsname, is_mc, filler)
+        compaction_config = self.config["column_compaction"]
+        trace_dir = compaction_config.get("trace_dir")
+        key = (type(self).__name__, dsname, is_mc)
+        if key not in _column_traces and trace_dir:
+            trace = ColumnTrace.load(self._column_trace_path(trace_dir, dsname, is_mc))
+            if trace is not None:
+                _column_traces[key] = trace
+        compaction = ColumnCompaction(compaction_config, _column_traces.get(key),
+                                      hist_columns(filler))
+        compaction.attach(selector)
+        result = super().process_selection(selector, dsname, is_mc, filler)
+        if key not in _column_traces:
+            trace = compaction.result_trace()
+            if trace is not None:
+                _column_traces[key] = trace
+                if trace_dir:
+                    os.makedirs(trace_dir, exist_ok=True)
+                    trace.save(self._column_trace_path(trace_dir, dsname, is_mc))
+        return result
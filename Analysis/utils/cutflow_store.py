@@ -0,0 +1,352 @@
+import os
+import json
+import sqlite3
+import operator
+import functools
+from argparse import ArgumentParser
+
+# Indexed store of the pepper cutflows and cross sections (SQLite file).
+# cutflows.json ({dataset: {category: ... {cut: yield}}}) is ingested once
+# into <output>/cutflows.sqlite and only read again if it changed. The store
+# can be used in place of the parsed json (store[dataset]["all"]["BeforeCuts"]
+# is a single indexed query), the normalisation lumi * xsec / N of all
+# datasets is returned by one query with norm_factors.
+#   python utils/cutflow_store.py ingest cutflows.sqlite --cutflow ${DIR}/cutflows.json --xsec ./configs/crosssections.json --era 2018
+#   python utils/cutflow_store.py norm cutflows.sqlite --lumi 59.8 --era 2018
+#   python utils/cutflow_store.py cutflow cutflows.sqlite DATASET all
+# The schema is also read by Limits/utils/commonutils.py.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    path TEXT, kind TEXT, era TEXT, size INTEGER, mtime_ns INTEGER,
+    PRIMARY KEY (path, kind, era));
+CREATE TABLE IF NOT EXISTS cutflow (
+    era TEXT, dataset TEXT, category TEXT, cut TEXT, position INTEGER,
+    yield REAL, source TEXT,
+    PRIMARY KEY (era, dataset, category, cut));
+CREATE INDEX IF NOT EXISTS cutflow_category ON cutflow (era, category, cut);
+CREATE TABLE IF NOT EXISTS xsec (
+    era TEXT, dataset TEXT, xsec REAL, source TEXT,
+    PRIMARY KEY (era, dataset));
+"""
+
+# cutflow entry used for the normalisation
+NORM_KEY = ("all", "BeforeCuts")
+
+
+def flatten_cutflow(cutflow):
+    """(dataset, category, cut, position, yield) rows of a nested cutflow,
+    the category is the path of keys between dataset and cut joined by /"""
+    rows = []
+
+    def walk(dataset, keys, node):
+        for position, (key, value) in enumerate(node.items()):
+            if isinstance(value, dict):
+                walk(dataset, keys + [key], value)
+            else:
+                rows.append((dataset, "/".join(keys), key, position, float(value)))
+
+    for dataset, node in cutflow.items():
+        walk(dataset, [], node)
+    return rows
+
+
+class _Node:
+    """Nested view of the cutflow of one dataset, behaves like the dict
+    of the json file for reading"""
+
+    def __init__(self, store, era, dataset, keys):
+        self._store = store
+        self._era = era
+        self._dataset = dataset
+        self._keys = keys
+
+    def __getitem__(self, key):
+        keys = self._keys + [key]
+        category = "/".join(self._keys)
+        value = self._store._execute(
+            "SELECT yield FROM cutflow WHERE era=? AND dataset=? AND category=? AND cut=?",
+            (self._era, self._dataset, category, key)).fetchone()
+        if value is not None:
+            return value[0]
+        if self._store._has_category(self._era, self._dataset, "/".join(keys)):
+            return _Node(self._store, self._era, self._dataset, keys)
+        raise KeyError("/".join([self._dataset] + keys))
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._store._children(self._era, self._dataset, self._keys)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def to_dict(self):
+        return {key: value.to_dict() if isinstance(value, _Node) else value
+                for key, value in self.items()}
+
+
+class CutflowStore:
+
+    def __init__(self, path, era=""):
+        # era is the default era of the queries
+        self.path = path
+        self.era = era
+        self._conn = sqlite3.connect(path)
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        self._conn.close()
+
+    def _execute(self, query, parameters=()):
+        return self._conn.execute(query, parameters)
+
+    def _has_category(self, era, dataset, prefix):
+        return self._execute(
+            "SELECT 1 FROM cutflow WHERE era=? AND dataset=? "
+            "AND (category=? OR substr(category, 1, ?)=?) LIMIT 1",
+            (era, dataset, prefix, len(prefix) + 1, prefix + "/")).fetchone() is not None
+
+    def _children(self, era, dataset, keys):
+        prefix = "/".join(keys)
+        rows = self._execute(
+            "SELECT category, cut, position FROM cutflow WHERE era=? AND dataset=? "
+            "ORDER BY rowid", (era, dataset)).fetchall()
+        children = []
+        for category, cut, _ in rows:
+            path = (category.split("/") if category else []) + [cut]
+            if path[:len(keys)] != keys or len(path) == len(keys):
+                continue
+            if path[len(keys)] not in children:
+                children.append(path[len(keys)])
+        if prefix and len(children) == 0:
+            raise KeyError("/".join([dataset] + keys))
+        return children
+
+    def _changed(self, path, kind, era):
+        stat = os.stat(path)
+        row = self._execute(
+            "SELECT size, mtime_ns FROM sources WHERE path=? AND kind=? AND era=?",
+            (os.path.abspath(path), kind, era)).fetchone()
+        return row is None or tuple(row) != (stat.st_size, stat.st_mtime_ns)
+
+    def _record_source(self, path, kind, era):
+        stat = os.stat(path)
+        self._execute(
+            "INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?, ?)",
+            (os.path.abspath(path), kind, era, stat.st_size, stat.st_mtime_ns))
+
+    def ingest_cutflow(self, path, era=None, force=False):
+        """Read a pepper cutflows.json, skipped if the file did not change"""
+        era = self.era if era is None else era
+        if not force and not self._changed(path, "cutflow", era):
+            return False
+        with open(path) as f:
+            rows = flatten_cutflow(json.load(f))
+        source = os.path.abspath(path)
+        with self._conn:
+            self._execute("DELETE FROM cutflow WHERE source=? AND era=?", (source, era))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO cutflow VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(era,) + row + (source,) for row in rows])
+            self._record_source(path, "cutflow", era)
+        return True
+
+    def ingest_xsec(self, path, era=None, force=False):
+        """Read a cross section json ({dataset: xsec})"""
+        era = self.era if era is None else era
+        if not force and not self._changed(path, "xsec", era):
+            return False
+        with open(path) as f:
+            xsecs = json.load(f)
+        source = os.path.abspath(path)
+        with self._conn:
+            self._execute("DELETE FROM xsec WHERE source=? AND era=?", (source, era))
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO xsec VALUES (?, ?, ?, ?)",
+                [(era, dataset, float(value), source) for dataset, value in xsecs.items()])
+            self._record_source(path, "xsec", era)
+        return True
+
+    # dict-like access to the cutflow of the default era
+    def __getitem__(self, dataset):
+        if dataset not in self:
+            raise KeyError(dataset)
+        return _Node(self, self.era, dataset, [])
+
+    def __contains__(self, dataset):
+        return self._execute(
+            "SELECT 1 FROM cutflow WHERE era=? AND dataset=? LIMIT 1",
+            (self.era, dataset)).fetchone() is not None
+
+    def keys(self, era=None):
+        era = self.era if era is None else era
+        return [row[0] for row in self._execute(
+            "SELECT dataset FROM cutflow WHERE era=? GROUP BY dataset ORDER BY min(rowid)",
+            (era,))]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def items(self):
+        return [(dataset, self[dataset]) for dataset in self.keys()]
+
+    def eras(self):
+        return [row[0] for row in self._execute("SELECT DISTINCT era FROM cutflow")]
+
+    def value(self, dataset, category, cut, era=None):
+        era = self.era if era is None else era
+        row = self._execute(
+            "SELECT yield FROM cutflow WHERE era=? AND dataset=? AND category=? AND cut=?",
+            (era, dataset, category, cut)).fetchone()
+        if row is None:
+            raise KeyError(f"{dataset}/{category}/{cut}")
+        return row[0]
+
+    def values(self, category, cut, datasets=None, era=None):
+        """{dataset: yield} of one cutflow entry for all (or the given) datasets"""
+        era = self.era if era is None else era
+        rows = self._execute(
+            "SELECT dataset, yield FROM cutflow WHERE era=? AND category=? AND cut=?",
+            (era, category, cut)).fetchall()
+        result = dict(rows)
+        if datasets is not None:
+            result = {dataset: result[dataset] for dataset in datasets if dataset in result}
+        return result
+
+    def cutflow(self, dataset, category, era=None):
+        """[(cut, yield, efficiency w.r.t. the first cut, w.r.t. the previous cut)]"""
+        era = self.era if era is None else era
+        rows = self._execute(
+            "SELECT cut, yield FROM cutflow WHERE era=? AND dataset=? AND category=? "
+            "ORDER BY position", (era, dataset, category)).fetchall()
+        result = []
+        for i, (cut, value) in enumerate(rows):
+            first = rows[0][1]
+            previous = rows[i - 1][1] if i > 0 else value
+            result.append((cut, value,
+                           value / first if first else float("nan"),
+                           value / previous if previous else float("nan")))
+        return result
+
+    def xsecs(self, era=None):
+        era = self.era if era is None else era
+        return dict(self._execute("SELECT dataset, xsec FROM xsec WHERE era=?", (era,)))
+
+    def norm_factors(self, lumi, key=NORM_KEY, datasets=None, era=None, xsecs=None):
+        """{dataset: lumi * xsec / N} for the datasets with a cross section,
+        N is the cutflow entry key = (category path..., cut). The cross
+        sections are the ingested ones unless given as {dataset: xsec}"""
+        era = self.era if era is None else era
+        category, cut = "/".join(key[:-1]), key[-1]
+        if xsecs is not None:
+            counts = self.values(category, cut, era=era)
+            result = {dataset: float(lumi) * xsec / counts[dataset]
+                      for dataset, xsec in xsecs.items() if dataset in counts}
+        else:
+            rows = self._execute(
+                "SELECT c.dataset, ? * x.xsec / c.yield FROM cutflow c "
+                "JOIN xsec x ON x.dataset = c.dataset AND x.era = c.era "
+                "WHERE c.era=? AND c.category=? AND c.cut=?",
+                (float(lumi), era, category, cut)).fetchall()
+            result = dict(rows)
+        if datasets is not None:
+            result = {dataset: result[dataset] for dataset in datasets if dataset in result}
+        return result
+
+def open_store(cutflow_path, era, xsec_path=None, store_path=None):
+    """Store of the era next to the cutflow json (cutflows.sqlite), the json
+    files are ingested under the era if they changed. A .sqlite path is
+    opened directly and has to contain the era."""
+    if cutflow_path.endswith(".sqlite"):
+        if not os.path.exists(cutflow_path):
+            raise FileNotFoundError(cutflow_path)
+        store = CutflowStore(cutflow_path, era)
+        if era not in store.eras():
+            eras = store.eras()
+            store.close()
+            raise KeyError(f"Era '{era}' not in {cutflow_path} (eras: {eras})")
+        return store
+    if store_path is None:
+        store_path = os.path.splitext(cutflow_path)[0] + ".sqlite"
+    store = CutflowStore(store_path, era)
+    store.ingest_cutflow(cutflow_path)
+    if xsec_path is not None:
+        store.ingest_xsec(xsec_path)
+    return store
+
+
+def norm_factors(cutflow, xsecs, lumi, key=NORM_KEY):
+    """{dataset: lumi * xsec / N} of the given cross sections, from a
+    CutflowStore or from the parsed cutflow json"""
+    if isinstance(cutflow, CutflowStore):
+        return cutflow.norm_factors(lumi, key, xsecs=xsecs)
+    result = {}
+    for dataset, xsec in xsecs.items():
+        try:
+            n_events = functools.reduce(operator.getitem, [dataset] + list(key), cutflow)
+        except KeyError:
+            continue
+        result[dataset] = lumi * xsec / n_events
+    return result
+
+
+def load_cutflow(cutflow_path, era, xsec_path=None):
+    """Cutflow of the era for the plotting scripts, the store if it can be
+    used and the parsed json otherwise (e.g. read-only output directories)"""
+    try:
+        return open_store(cutflow_path, era, xsec_path)
+    except sqlite3.Error:
+        with open(cutflow_path) as f:
+            return json.load(f)
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Cutflow and cross section store")
+    parser.add_argument("command", choices=["ingest", "norm", "cutflow", "datasets"])
+    parser.add_argument("store", help="SQLite file")
+    parser.add_argument("args", nargs="*", help="cutflow: dataset and category")
+    parser.add_argument("--cutflow", nargs="*", default=[], help="cutflows.json to ingest")
+    parser.add_argument("--xsec", nargs="*", default=[], help="Cross section json to ingest")
+    parser.add_argument("--era", required=True)
+    parser.add_argument("--lumi", type=float, default=1.0)
+    parser.add_argument("--key", default="/".join(NORM_KEY),
+                        help="Cutflow entry used as N, e.g. all/BeforeCuts")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    store = CutflowStore(args.store, args.era)
+    if args.command == "ingest":
+        for path in args.cutflow:
+            changed = store.ingest_cutflow(path, force=args.force)
+            print(f"{path}: {'ingested' if changed else 'unchanged'}")
+        for path in args.xsec:
+            changed = store.ingest_xsec(path, force=args.force)
+            print(f"{path}: {'ingested' if changed else 'unchanged'}")
+    elif args.command == "norm":
+        norms = store.norm_factors(args.lumi, tuple(args.key.split("/")))
+        for dataset, norm in sorted(norms.items()):
+            print(f"{dataset:<80} {norm:.6g}")
+    elif args.command == "cutflow":
+        dataset, category = args.args
+        for cut, value, eff_first, eff_previous in store.cutflow(dataset, category):
+            print(f"{cut:<40} {value:14.2f} {eff_first:10.4f} {eff_previous:10.4f}")
+    elif args.command == "datasets":
+        for era in store.eras():
+            print(f"era '{era}': {len(store.keys(era))} datasets")
+            for dataset in store.keys(era):
+                print(f"    {dataset}")
+    store.close()
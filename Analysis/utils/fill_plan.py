@@ -0,0 +1,165 @@
+import json
+import logging
+from functools import partial
+from argparse import ArgumentParser
+
+# Histogram fill plan.
+# The fill entries of the histogram config are paths into the chunk data,
+# e.g. ["Jet_select", "pt", {"leading": 1}], and many histograms share them
+# (the signal config has ~140 fill entries but only ~50 different paths).
+# With the FillPlanMixin every path, and every prefix of it ("Jet_select"),
+# is evaluated once per cut and shared by all histograms filled at that cut;
+# evaluating the single steps is left to the pick_data of the pepper
+# histogram definitions, so the path syntax stays the one of pepper.
+# Which histograms are filled at which cut is given by
+#     "cuts_per_histogram": {"jet1_pt": ["two_loose_jets_final"], ...}
+# in the processor config, histograms not listed there are filled at the
+# cuts of "cuts_to_histogram" (all cuts if not given).
+# The plan of a histogram config can be inspected with
+#   python utils/fill_plan.py ./configs/hists_configs/stau2018_signal_hist.json --config ./configs/proc_2018/stau2018_signal.json
+
+logger = logging.getLogger(__name__)
+
+
+def path_key(method):
+    return json.dumps(method, sort_keys=True)
+
+
+def load_json(path):
+    import hjson
+    with open(path) as f:
+        return hjson.load(f)
+
+
+class FillPlan:
+
+    def __init__(self, hist_config=None, cuts_to_histogram=None, cuts_per_histogram=None):
+        self.cuts_to_histogram = None if cuts_to_histogram is None else set(cuts_to_histogram)
+        self.cuts_per_histogram = {name: set(cuts) for name, cuts in (cuts_per_histogram or {}).items()}
+        # histogram -> fill name -> path, from the histogram config if given
+        self.fills = {}
+        for name, definition in (hist_config or {}).items():
+            self.fills[name] = {fill: list(path) for fill, path in definition.get("fill", {}).items()}
+        self._values = {}
+        self._roots = {}
+
+    @classmethod
+    def from_config(cls, config, hist_config=None):
+        return cls(
+            hist_config,
+            config["cuts_to_histogram"] if "cuts_to_histogram" in config else None,
+            config["cuts_per_histogram"] if "cuts_per_histogram" in config else None)
+
+    def fills_at(self, histname, cut):
+        if histname in self.cuts_per_histogram:
+            return cut in self.cuts_per_histogram[histname]
+        return self.cuts_to_histogram is None or cut in self.cuts_to_histogram
+
+    def histograms_at(self, cut, histnames=None):
+        histnames = self.fills if histnames is None else histnames
+        return [name for name in histnames if self.fills_at(name, cut)]
+
+    def columns_at(self, cut):
+        """Different paths (and their prefixes) evaluated at the cut"""
+        paths, prefixes = set(), set()
+        for name in self.histograms_at(cut):
+            for path in self.fills[name].values():
+                paths.add(path_key(path))
+                for i in range(1, len(path) + 1):
+                    prefixes.add(path_key(path[:i]))
+        return paths, prefixes
+
+    def reset(self):
+        """Forget the values, called before the histograms of a cut are filled"""
+        self._values = {}
+        self._roots = {}
+
+    def pick(self, method, data, pick_data):
+        """pick_data(method, data) with every prefix of the method evaluated
+        once until the next reset"""
+        root = id(data)
+        # keep the data alive, its id is part of the keys
+        self._roots[root] = data
+        method = list(method)
+        start, value = 0, data
+        for i in range(len(method), 0, -1):
+            key = (root, path_key(method[:i]))
+            if key in self._values:
+                start, value = i, self._values[key]
+                break
+        for i in range(start, len(method)):
+            value = pick_data([method[i]], value)
+            self._values[(root, path_key(method[:i + 1]))] = value
+        return value
+
+    def attach(self, filler):
+        """Fill the histograms of an OutputFiller through the plan"""
+        for definition in filler.hist_dict.values():
+            if getattr(definition, "_fill_plan", None) is self:
+                continue
+            if not hasattr(definition, "pick_data"):
+                logger.debug("Histogram definition without pick_data, paths are not shared")
+                continue
+            original = getattr(definition, "_unplanned_pick_data", definition.pick_data)
+            definition._unplanned_pick_data = original
+            definition.pick_data = partial(self.pick, pick_data=original)
+            definition._fill_plan = self
+        fill_hists = filler.fill_hists
+        plan = self
+
+        def planned_fill_hists(data, systematics, cut, *args, **kwargs):
+            hist_dict = filler.hist_dict
+            selected = {name: hist_dict[name] for name in plan.histograms_at(cut, hist_dict)}
+            if len(selected) == 0:
+                return
+            plan.reset()
+            filler.hist_dict = selected
+            try:
+                return fill_hists(data, systematics, cut, *args, **kwargs)
+            finally:
+                filler.hist_dict = hist_dict
+                plan.reset()
+
+        filler.fill_hists = planned_fill_hists
+        return filler
+
+    def summary(self, cuts):
+        lines = []
+        n_fills = sum(len(fills) for fills in self.fills.values())
+        unique = {path_key(path) for fills in self.fills.values() for path in fills.values()}
+        lines.append(f"{len(self.fills)} histograms, {n_fills} fill entries, "
+                     f"{len(unique)} different paths")
+        for cut in cuts:
+            histograms = self.histograms_at(cut)
+            paths, prefixes = self.columns_at(cut)
+            lines.append(f"{cut:<40} {len(histograms):4d} histograms {len(paths):4d} paths "
+                         f"{len(prefixes):4d} evaluated steps")
+        return "\n".join(lines)
+
+
+class FillPlanMixin:
+    """Processor mixin filling the histograms through a FillPlan (shared
+    paths, per histogram cut lists)"""
+
+    def setup_outputfiller(self, dsname, is_mc):
+        filler = super().setup_outputfiller(dsname, is_mc)
+        if getattr(self, "fill_plan", None) is None:
+            self.fill_plan = FillPlan.from_config(self.config)
+        return self.fill_plan.attach(filler)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Show the fill plan of a histogram config")
+    parser.add_argument("hists", help="Histogram config (json)")
+    parser.add_argument("--config", default=None,
+                        help="Processor config with cuts_to_histogram / cuts_per_histogram")
+    parser.add_argument("--cuts", nargs="*", default=None, help="Cuts to show")
+    args = parser.parse_args()
+
+    config = load_json(args.config) if args.config is not None else {}
+    plan = FillPlan.from_config(config, load_json(args.hists))
+    cuts = args.cuts
+    if cuts is None:
+        cuts = sorted(set(config.get("cuts_to_histogram", [])).union(
+            *plan.cuts_per_histogram.values()))
+    print(plan.summary(cuts))
@@ -0,0 +1,292 @@
+import numpy as np
+import numba as nb
+import awkward as ak
+
+# Gen-ancestry columns of a chunk, computed in one numba pass over
+# GenPart_genPartIdxMother instead of chained .parent/.distinctParent/.children
+# lookups (every one of those is a gather over the whole GenPart collection).
+# Added to GenPart (indices are local, i.e. per event as genPartIdxMother,
+# -1 if there is none):
+#   distinctParentIdx  first ancestor with a different pdgId (.distinctParent)
+#   stauIdx            nearest stau (1000015/2000015) ancestor
+#   tauIdx             nearest tau ancestor, the last copy of the decaying tau
+#   firstChildIdx      first daughter (.children[:,:,0])
+#   decayMode          of a decaying tau, as GenVisTau_status for hadronic
+#                      decays (0, 1, 2 one prong + pi0s, 10, 11 three prong
+#                      + pi0s, 15 other), -11/-13 for the leptonic ones,
+#                      -1 for everything else
+#   nCharged, nPi0     charged hadrons and pi0s of a decaying tau, -1 else
+#   visPt/Eta/Phi/Mass visible four-momentum of a decaying tau (sum of its
+#                      direct decay products, isDirect(Prompt)TauDecayProduct
+#                      in statusFlags, without neutrinos), NaN for the others
+# and if the vertex branches are present:
+#   decayVertexX/Y/Z/Rho  production vertex of the first daughter, NaN if none
+#   decayLxy           transverse distance from production to decay vertex
+#   parentLxy          transverse distance to the production vertex of the
+#                      mother (transverse_length(p) in region_study)
+# Added to GenVisTau (through its genPartIdxMother, the decaying tau):
+#   tauIdx, stauIdx, decayMode, parentLxy (of the tau) and stauLxy (decayLxy
+#   of the stau)
+# Usage, once per chunk before any selection:
+#   from utils.gen_ancestry import add_gen_ancestry, gen_particles
+#   add_gen_ancestry(events)
+#   stau = gen_particles(events.GenPart, events.GenVisTau.stauIdx)
+# mother_field(genpart, particles, field) and gen_daughters(genpart, index)
+# replace .parent[field] and .children with gathers on genPartIdxMother.
+# tau_decays(genpart) gives the decaying taus of every event with their
+# decay mode, visible four-momentum and production / decay vertex as one
+# record, e.g. as column for histograms (GenTauDecay in the signal study).
+
+STAU_IDS = (1000015, 2000015)
+CHARGED_HADRON_IDS = (211, 321)
+VERTEX_FIELDS = ("vertexX", "vertexY", "vertexZ")
+# statusFlags bits of isDirectTauDecayProduct and isDirectPromptTauDecayProduct
+DIRECT_TAU_DECAY_FLAGS = (1 << 4) | (1 << 5)
+# statusFlags bit of fromHardProcess
+FROM_HARD_PROCESS_FLAG = 1 << 8
+
+
+@nb.njit(cache=True)
+def _is_stau(pdg):
+    return pdg == 1000015 or pdg == -1000015 or pdg == 2000015 or pdg == -2000015
+
+
+@nb.njit(cache=True)
+def _ancestry(offsets, mother, pdg, flags, px, py, pz, energy):
+    n = len(mother)
+    distinct = np.full(n, -1, dtype=np.int64)
+    stau = np.full(n, -1, dtype=np.int64)
+    tau = np.full(n, -1, dtype=np.int64)
+    first_child = np.full(n, -1, dtype=np.int64)
+    n_charged = np.zeros(n, dtype=np.int64)
+    n_pi0 = np.zeros(n, dtype=np.int64)
+    lepton = np.zeros(n, dtype=np.int64)
+    has_nu = np.zeros(n, dtype=np.bool_)
+    decay_mode = np.full(n, -1, dtype=np.int64)
+    vis = np.zeros((n, 4))
+    has_kinematics = len(px) == n
+    has_flags = len(flags) == n
+    for iev in range(len(offsets) - 1):
+        start = offsets[iev]
+        size = offsets[iev + 1] - start
+        for i in range(size):
+            g = start + i
+            m = mother[g]
+            if m < 0 or m >= size:
+                continue
+            gm = start + m
+            if first_child[gm] < 0 or i < first_child[gm]:
+                first_child[gm] = i
+            if m < i:
+                # mothers are stored before their daughters, reuse the mother
+                distinct[g] = distinct[gm] if pdg[gm] == pdg[g] else m
+                stau[g] = m if _is_stau(pdg[gm]) else stau[gm]
+                tau[g] = m if abs(pdg[gm]) == 15 else tau[gm]
+            else:
+                # walk up the chain, bounded in case of a loop
+                cur = i
+                for _ in range(size):
+                    cm = mother[start + cur]
+                    if cm < 0 or cm >= size:
+                        break
+                    cpdg = pdg[start + cm]
+                    if distinct[g] < 0 and cpdg != pdg[g]:
+                        distinct[g] = cm
+                    if stau[g] < 0 and _is_stau(cpdg):
+                        stau[g] = cm
+                    if tau[g] < 0 and abs(cpdg) == 15:
+                        tau[g] = cm
+                    cur = cm
+        # content of the tau decays
+        for i in range(size):
+            g = start + i
+            t = tau[g]
+            if t < 0:
+                continue
+            gt = start + t
+            apdg = abs(pdg[g])
+            if apdg == 211 or apdg == 321:
+                n_charged[gt] += 1
+            elif apdg == 111:
+                n_pi0[gt] += 1
+            elif mother[g] == t and (apdg == 11 or apdg == 13):
+                lepton[gt] = apdg
+            elif mother[g] == t and apdg == 16:
+                has_nu[gt] = True
+            if not has_kinematics or apdg == 12 or apdg == 14 or apdg == 16:
+                continue
+            # visible products, the direct ones if the flags are known
+            if (has_flags and flags[g] & DIRECT_TAU_DECAY_FLAGS) or (not has_flags and mother[g] == t):
+                vis[gt, 0] += px[g]
+                vis[gt, 1] += py[g]
+                vis[gt, 2] += pz[g]
+                vis[gt, 3] += energy[g]
+        for i in range(size):
+            g = start + i
+            if abs(pdg[g]) != 15 or not has_nu[g]:
+                continue
+            if lepton[g] > 0:
+                decay_mode[g] = -lepton[g]
+            elif n_charged[g] == 1:
+                decay_mode[g] = n_pi0[g] if n_pi0[g] <= 2 else 15
+            elif n_charged[g] == 3 and n_pi0[g] <= 1:
+                decay_mode[g] = 10 + n_pi0[g]
+            else:
+                decay_mode[g] = 15
+    return distinct, stau, tau, first_child, decay_mode, n_charged, n_pi0, vis
+
+
+def _flat(array):
+    return np.asarray(ak.to_numpy(ak.flatten(array)))
+
+
+def _gather(flat_values, index, offsets_of_index, fill=np.nan):
+    """flat_values at the local indices (flat, one event offset per entry),
+    fill where the index is -1"""
+    valid = index >= 0
+    out = np.full(len(index), fill, dtype=flat_values.dtype)
+    out[valid] = flat_values[index[valid] + offsets_of_index[valid]]
+    return out
+
+
+def gen_ancestry(genpart):
+    """Dict of flat numpy columns (see above) and the GenPart counts"""
+    counts = np.asarray(ak.to_numpy(ak.num(genpart, axis=1)), dtype=np.int64)
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    mother = _flat(genpart.genPartIdxMother).astype(np.int64)
+    pdg = _flat(genpart.pdgId).astype(np.int64)
+    empty = np.zeros(0)
+    flags = (_flat(genpart.statusFlags).astype(np.int64) if "statusFlags" in genpart.fields
+             else np.zeros(0, dtype=np.int64))
+    if all(field in genpart.fields for field in ("pt", "eta", "phi", "mass")):
+        pt, eta, phi, mass = (_flat(genpart[field]).astype(np.float64)
+                              for field in ("pt", "eta", "phi", "mass"))
+        px, py, pz = pt * np.cos(phi), pt * np.sin(phi), pt * np.sinh(eta)
+        energy = np.sqrt(px**2 + py**2 + pz**2 + mass**2)
+    else:
+        px = py = pz = energy = empty
+    distinct, stau, tau, first_child, decay_mode, n_charged, n_pi0, vis = _ancestry(
+        offsets, mother, pdg, flags, px, py, pz, energy)
+    decaying = decay_mode != -1
+    columns = {
+        "distinctParentIdx": distinct,
+        "stauIdx": stau,
+        "tauIdx": tau,
+        "firstChildIdx": first_child,
+        "decayMode": decay_mode,
+        "nCharged": np.where(decaying, n_charged, -1),
+        "nPi0": np.where(decaying, n_pi0, -1),
+    }
+    if len(px) == len(pdg):
+        vis_pt = np.hypot(vis[:, 0], vis[:, 1])
+        vis_p = np.sqrt(vis_pt**2 + vis[:, 2]**2)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            columns["visPt"] = np.where(decaying, vis_pt, np.nan)
+            columns["visEta"] = np.where(decaying, np.arcsinh(vis[:, 2] / vis_pt), np.nan)
+            columns["visPhi"] = np.where(decaying, np.arctan2(vis[:, 1], vis[:, 0]), np.nan)
+            columns["visMass"] = np.where(
+                decaying, np.sqrt(np.maximum(vis[:, 3]**2 - vis_p**2, 0)), np.nan)
+    if all(field in genpart.fields for field in VERTEX_FIELDS):
+        event_start = np.repeat(offsets[:-1], counts)
+        vx, vy, vz = (_flat(genpart[field]).astype(np.float64) for field in VERTEX_FIELDS)
+        columns["decayVertexX"] = _gather(vx, first_child, event_start)
+        columns["decayVertexY"] = _gather(vy, first_child, event_start)
+        columns["decayVertexZ"] = _gather(vz, first_child, event_start)
+        columns["decayVertexRho"] = np.hypot(columns["decayVertexX"], columns["decayVertexY"])
+        columns["decayLxy"] = np.hypot(columns["decayVertexX"] - vx, columns["decayVertexY"] - vy)
+        columns["parentLxy"] = np.hypot(_gather(vx, mother, event_start) - vx,
+                                        _gather(vy, mother, event_start) - vy)
+    return columns, counts
+
+
+def add_gen_ancestry(events, gen_vis_taus="GenVisTau"):
+    """Add the ancestry columns to events.GenPart and events[gen_vis_taus],
+    returns the events for convenience"""
+    columns, counts = gen_ancestry(events.GenPart)
+    for name, values in columns.items():
+        events["GenPart", name] = ak.unflatten(values, counts)
+    if gen_vis_taus is None or gen_vis_taus not in events.fields:
+        return events
+
+    offsets = np.zeros(len(counts) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
+    vis_counts = np.asarray(ak.to_numpy(ak.num(events[gen_vis_taus], axis=1)), dtype=np.int64)
+    event_start = np.repeat(offsets[:-1], vis_counts)
+    tau = _flat(events[gen_vis_taus].genPartIdxMother).astype(np.int64)
+    stau = _gather(columns["stauIdx"], tau, event_start, fill=-1)
+    vis_columns = {
+        "tauIdx": tau,
+        "stauIdx": stau,
+        "decayMode": _gather(columns["decayMode"], tau, event_start, fill=-1),
+    }
+    if "decayLxy" in columns:
+        vis_columns["parentLxy"] = _gather(columns["parentLxy"], tau, event_start)
+        vis_columns["stauLxy"] = _gather(columns["decayLxy"], stau, event_start)
+    for name, values in vis_columns.items():
+        events[gen_vis_taus, name] = ak.unflatten(values, vis_counts)
+    return events
+
+
+def tau_decays(genpart, columns=None, counts=None, from_stau=True):
+    """Decaying taus (last copies) of every event with their decay
+    classification, visible four-momentum and vertices, only the ones from a
+    stau decay if from_stau; columns, counts of gen_ancestry if computed"""
+    if columns is None:
+        columns, counts = gen_ancestry(genpart)
+    selected = columns["decayMode"] != -1
+    if from_stau:
+        selected &= columns["stauIdx"] >= 0
+    fields = ["decayMode", "nCharged", "nPi0", "stauIdx", "visPt", "visEta", "visPhi",
+              "visMass", "decayVertexX", "decayVertexY", "decayVertexZ", "decayLxy"]
+    record = {field: columns[field][selected] for field in fields if field in columns}
+    record["idx"] = (np.arange(len(selected)) - np.repeat(
+        np.cumsum(counts) - counts, counts))[selected]
+    for field in ("pt", "eta", "phi", "pdgId") + VERTEX_FIELDS:
+        if field in genpart.fields:
+            record[field] = _flat(genpart[field])[selected]
+    event = np.repeat(np.arange(len(counts)), counts)[selected]
+    tau_counts = np.bincount(event, minlength=len(counts))
+    return ak.zip({field: ak.unflatten(values, tau_counts) for field, values in record.items()})
+
+
+def gen_particles(genpart, index):
+    """GenPart at the (local, jagged) indices, None where the index is -1"""
+    return genpart[ak.mask(index, index >= 0)]
+
+
+def _event_starts(genpart):
+    counts = np.asarray(ak.to_numpy(ak.num(genpart, axis=1)), dtype=np.int64)
+    return np.cumsum(counts) - counts
+
+
+def mother_field(genpart, particles, field, fill=np.nan):
+    """field of the GenPart mother (genPartIdxMother) of every particle of a
+    collection of the same events (e.g. GenVisTau, as .parent[field]), fill
+    where there is none"""
+    counts = np.asarray(ak.to_numpy(ak.num(particles, axis=1)), dtype=np.int64)
+    mother = _flat(particles.genPartIdxMother).astype(np.int64)
+    values = _gather(_flat(genpart[field]), mother, np.repeat(_event_starts(genpart), counts), fill)
+    return ak.unflatten(values, counts)
+
+
+def gen_daughters(genpart, index):
+    """Daughters (as .children) of the GenPart at the (local, jagged)
+    indices, one list per index, empty for an index of -1"""
+    starts = _event_starts(genpart)
+    n_index = np.asarray(ak.to_numpy(ak.num(index, axis=1)), dtype=np.int64)
+    index = _flat(index).astype(np.int64)
+    key = np.where(index >= 0, index + np.repeat(starts, n_index), -1)
+    counts = np.asarray(ak.to_numpy(ak.num(genpart, axis=1)), dtype=np.int64)
+    mother = _flat(genpart.genPartIdxMother).astype(np.int64)
+    mother_key = np.where(mother >= 0, mother + np.repeat(starts, counts), -2)
+    # daughters ordered by their mother, then by their own index
+    order = np.argsort(mother_key, kind="stable")
+    sorted_key = mother_key[order]
+    first = np.searchsorted(sorted_key, key, side="left")
+    n_daughters = np.searchsorted(sorted_key, key, side="right") - first
+    n_daughters[key < 0] = 0
+    taken = order[np.repeat(first, n_daughters) + (
+        np.arange(n_daughters.sum()) - np.repeat(np.cumsum(n_daughters) - n_daughters, n_daughters))]
+    daughters = ak.flatten(genpart)[taken]
+    return ak.unflatten(ak.unflatten(daughters, n_daughters), n_index)
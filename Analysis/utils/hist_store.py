@@ -0,0 +1,507 @@
+import os
+import json
+import fnmatch
+from argparse import ArgumentParser
+
+import numpy as np
+
+# Consolidated histogram store (one HDF5 file instead of one ROOT file per
+# cut x histogram).
+# Every ROOT file of hists.json becomes a group of hists.h5 named like the
+# file without .root, e.g. Cut_014_two_loose_jets_final_jet1_pt, holding all
+# histograms of the file (dataset / systematic / category, the object paths
+# of the ROOT file as "paths") stacked in
+#     values, variances    (n_paths, *bins including under- and overflow)
+#     entries              (n_paths,)
+#     edges_<axis>, labels_<axis>
+# Histograms filled with a systematic axis (utils/syst_axis.py) have the
+# variations as second dimension, values (n_paths, n_sys, *bins), with their
+# names in "sys" and the paths without the systematic; the path
+# <dataset>/<sys>/<category>/hist of the ROOT layout is resolved to the slice
+# of the variation (nominal if the path has no variation).
+# with one compressed chunk per histogram, so reading one histogram reads one
+# chunk. With --compression none the arrays are stored contiguously and read
+# through np.memmap. The content of hists.json is kept in the store as well.
+# The plotting scripts open the ROOT files through open_hist_file, which
+# falls back to hists.h5 in the same directory if the ROOT file does not
+# exist and returns an object with Get/Close as a TFile, so the packed
+# ROOT files can be removed:
+#   python utils/hist_store.py pack ${DIR}/hists/hists.json --remove
+#   python utils/hist_store.py list ${DIR}/hists/hists.h5 --hists "*jet1_pt*"
+#   python utils/hist_store.py show ${DIR}/hists/hists.h5 Cut_014_two_loose_jets_final_jet1_pt DYJetsToLL_M-50_TuneCP5_13TeV-madgraphMLM-pythia8/nominal/hist
+# incremental_runproc.py --hist-store merges the batches directly into the
+# store.
+
+STORE_NAME = "hists.h5"
+
+COMPRESSION = {
+    "gzip": {"compression": "gzip", "compression_opts": 4, "shuffle": True},
+    "lzf": {"compression": "lzf", "shuffle": True},
+    "none": {},
+}
+
+
+def _read_root_hists(path):
+    """{object path: histogram record} of all histograms in a ROOT file"""
+    import uproot
+    hists = {}
+    with uproot.open(path) as f:
+        for name, classname in f.classnames(cycle=False).items():
+            if not classname.startswith("TH"):
+                continue
+            hist = f[name]
+            axes = [hist.member("fXaxis"), hist.member("fYaxis"), hist.member("fZaxis")]
+            axes = axes[:len(hist.axes)]
+            hists[name] = {
+                "classname": classname,
+                "title": hist.member("fTitle"),
+                "values": np.asarray(hist.values(flow=True), dtype=np.float64),
+                "variances": np.asarray(hist.variances(flow=True), dtype=np.float64),
+                "entries": float(hist.member("fEntries")),
+                "edges": [np.asarray(axis.edges(flow=False), dtype=np.float64) for axis in axes],
+                "labels": [axis.labels() for axis in axes],
+                "axis_titles": [axis.member("fTitle") for axis in axes],
+            }
+    return hists
+
+
+def _with_sys(record, sysnames):
+    """values and variances of a record with a systematic axis reordered to
+    sysnames, variations the record does not have are its nominal"""
+    shape = (len(sysnames),) + record["values"].shape[1:]
+    values, variances = np.zeros(shape), np.zeros(shape)
+    has_sys = np.zeros(len(sysnames), dtype=bool)
+    index = {name: i for i, name in enumerate(record["sys"])}
+    nominal = index.get("nominal")
+    for i, name in enumerate(sysnames):
+        j = index.get(name, nominal)
+        has_sys[i] = name in index
+        if j is not None:
+            values[i] = record["values"][j]
+            variances[i] = record["variances"][j]
+    return values, variances, has_sys
+
+
+def _merge_records(total, record, name, path):
+    if len(total["edges"]) != len(record["edges"]) or any(
+            not np.array_equal(a, b) for a, b in zip(total["edges"], record["edges"])):
+        raise ValueError(f"Binning of {name} in {path} differs from the other inputs")
+    if ("sys" in total) != ("sys" in record):
+        raise ValueError(f"{name} in {path} has a systematic axis only in some inputs")
+    if "sys" in total and list(total["sys"]) != list(record["sys"]):
+        sysnames = list(total["sys"]) + [s for s in record["sys"] if s not in total["sys"]]
+        total["values"], total["variances"], _ = _with_sys(total, sysnames)
+        record = dict(record)
+        record["values"], record["variances"], _ = _with_sys(record, sysnames)
+        total["sys"] = sysnames
+    total["values"] = total["values"] + record["values"]
+    total["variances"] = total["variances"] + record["variances"]
+    total["entries"] += record["entries"]
+
+
+def _write_group(parent, groupname, keys, hists, compression):
+    first = next(iter(hists.values()))
+    sysnames = None
+    if "sys" in first:
+        if not all("sys" in record for record in hists.values()):
+            raise ValueError(f"{groupname}: histograms with and without systematic axis")
+        sysnames = []
+        for record in hists.values():
+            sysnames += [name for name in record["sys"] if name not in sysnames]
+        rows = [_with_sys(record, sysnames) for record in hists.values()]
+        hists = {name: dict(record, values=values, variances=variances)
+                 for (name, record), (values, variances, _) in zip(hists.items(), rows)}
+    cell_shape = next(iter(hists.values()))["values"].shape
+    for name, record in hists.items():
+        if record["values"].shape != cell_shape or any(
+                not np.array_equal(a, b) for a, b in zip(first["edges"], record["edges"])):
+            raise ValueError(f"{groupname}: histograms with different binning ({name})")
+    shape = (len(hists),) + cell_shape
+    options = dict(COMPRESSION[compression])
+    if compression != "none":
+        # one chunk per histogram with all its variations
+        options["chunks"] = (1,) + cell_shape
+    group = parent.require_group(groupname)
+    if sysnames is not None:
+        group.create_dataset("sys", data=np.array(sysnames, dtype=object), dtype=_string_dtype())
+        group.create_dataset("has_sys", data=np.array([has for _, _, has in rows]))
+    group.attrs["keys"] = json.dumps(keys)
+    group.attrs["classname"] = first["classname"]
+    group.attrs["axis_titles"] = json.dumps(first["axis_titles"])
+    group.create_dataset("paths", data=np.array(list(hists), dtype=object),
+                         dtype=_string_dtype())
+    group.create_dataset("titles", data=np.array([r["title"] for r in hists.values()], dtype=object),
+                         dtype=_string_dtype())
+    for field in ("values", "variances"):
+        data = group.create_dataset(field, shape=shape, dtype=np.float64, **options)
+        for i, record in enumerate(hists.values()):
+            data[i] = record[field]
+    group.create_dataset("entries", data=np.array([r["entries"] for r in hists.values()]))
+    for i, (edges, labels) in enumerate(zip(first["edges"], first["labels"])):
+        group.create_dataset(f"edges_{i}", data=edges)
+        if labels is not None:
+            group.create_dataset(f"labels_{i}", data=np.array(list(labels), dtype=object),
+                                 dtype=_string_dtype())
+
+
+def _string_dtype():
+    import h5py
+    return h5py.string_dtype()
+
+
+def _read_source(source):
+    """Histogram records of a source: a dict of records, a ROOT file or a
+    file packed into the store next to it"""
+    if isinstance(source, dict):
+        return source
+    if os.path.exists(source):
+        return _read_root_hists(source)
+    store = find_store(source)
+    if store is None or os.path.basename(source) not in store:
+        raise FileNotFoundError(f"{source} neither as ROOT file nor in {STORE_NAME}")
+    return store.records(os.path.basename(source))
+
+
+def write_store(path, index, sources, compression="gzip"):
+    """Write the histograms of the sources ({histfile: [sources]}, see
+    _read_source, the sources of one histfile are added up) into the store at
+    path, index is the content of hists.json"""
+    import h5py
+    keys = {histfile: key for key, histfile in zip(*index["content"])}
+    with h5py.File(path + ".tmp", "w") as f:
+        f.attrs["index"] = json.dumps(index)
+        for histfile, histfile_sources in sources.items():
+            hists = {}
+            for source in histfile_sources:
+                for name, record in _read_source(source).items():
+                    if name in hists:
+                        _merge_records(hists[name], record, name, source)
+                    else:
+                        hists[name] = record
+            if len(hists) == 0:
+                continue
+            _write_group(f, group_name(histfile), keys.get(histfile), hists, compression)
+    # an open reader of the old file would not see the new content
+    old = _stores.pop(os.path.abspath(path), None)
+    if old is not None:
+        old.close()
+    os.replace(path + ".tmp", path)
+
+
+def _insert_sys(path, sys):
+    parts = path.split("/")
+    return "/".join(parts[:1] + [sys] + parts[1:])
+
+
+def group_name(histfile):
+    return histfile[:-len(".root")] if histfile.endswith(".root") else histfile
+
+
+def pack(histjson, output=None, compression="gzip", remove=False):
+    """Pack the ROOT files of a hists.json into one store next to it"""
+    dirname = os.path.dirname(os.path.abspath(histjson))
+    with open(histjson) as f:
+        index = json.load(f)
+    output = output or os.path.join(dirname, STORE_NAME)
+    paths = {histfile: os.path.join(dirname, histfile) for histfile in index["content"][1]}
+    # files already in the store (e.g. with systematic axis) are kept
+    store = find_store(histjson)
+    missing = [path for path in paths.values() if not os.path.exists(path)
+               and (store is None or os.path.basename(path) not in store)]
+    if missing:
+        raise FileNotFoundError(f"{len(missing)} files of {histjson} missing, e.g. {missing[0]}")
+    write_store(output, index, {histfile: [path] for histfile, path in paths.items()},
+                compression)
+    if remove:
+        for path in paths.values():
+            if os.path.exists(path):
+                os.remove(path)
+    return output
+
+
+def root_hist(classname, name, title, edges, values, variances, entries=None,
+              axis_titles=None, labels=None):
+    """ROOT TH1/TH2/TH3 (not attached to a directory) from the edges of every
+    axis and values and variances including under- and overflow"""
+    import ROOT
+    args = []
+    for axis_edges in edges:
+        args += [len(axis_edges) - 1, np.asarray(axis_edges, dtype=np.double)]
+    add_directory = ROOT.TH1.AddDirectoryStatus()
+    ROOT.TH1.AddDirectory(False)
+    try:
+        hist = getattr(ROOT, classname)(name, title, *args)
+    finally:
+        ROOT.TH1.AddDirectory(add_directory)
+    hist.Sumw2()
+    # ROOT bin numbering runs fastest along x
+    hist.SetContent(np.ascontiguousarray(np.asarray(values, dtype=np.double).ravel(order="F")))
+    hist.SetError(np.ascontiguousarray(
+        np.sqrt(np.maximum(np.asarray(variances, dtype=np.double), 0)).ravel(order="F")))
+    if entries is not None:
+        hist.SetEntries(entries)
+    axes = [hist.GetXaxis(), hist.GetYaxis(), hist.GetZaxis()]
+    for i, axis_title in enumerate(axis_titles or []):
+        axes[i].SetTitle(axis_title)
+    for i, axis_labels in enumerate(labels or []):
+        for j, label in enumerate(axis_labels or []):
+            axes[i].SetBinLabel(j + 1, label)
+    return hist
+
+
+class StoreFile:
+    """One packed ROOT file, read like a TFile"""
+
+    def __init__(self, store, histfile):
+        self.store = store
+        self.histfile = histfile
+
+    def Get(self, name):
+        try:
+            return self.store.get(self.histfile, name)
+        except KeyError:
+            return None
+
+    def GetName(self):
+        return os.path.join(os.path.dirname(self.store.path), self.histfile)
+
+    def IsOpen(self):
+        return True
+
+    def IsZombie(self):
+        return False
+
+    def Close(self):
+        pass
+
+    def __bool__(self):
+        return True
+
+    def __repr__(self):
+        return f"<StoreFile {self.histfile} in {self.store.path}>"
+
+
+class HistStore:
+
+    def __init__(self, path):
+        import h5py
+        self.path = path
+        self.file = h5py.File(path, "r")
+        self.index = json.loads(self.file.attrs["index"])
+        self._rows = {}
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def histfiles(self):
+        """Group names of the packed files in the order of hists.json"""
+        names = [group_name(histfile) for histfile in self.index["content"][1]]
+        return [name for name in names if name in self.file]
+
+    def __contains__(self, histfile):
+        return group_name(histfile) in self.file
+
+    def _group(self, histfile):
+        name = group_name(histfile)
+        if name not in self.file:
+            raise KeyError(f"{histfile} not in {self.path}")
+        return self.file[name]
+
+    def paths(self, histfile):
+        """Object paths of the histograms of a packed file"""
+        return list(self.rows(histfile))
+
+    def rows(self, histfile):
+        name = group_name(histfile)
+        if name not in self._rows:
+            paths = self._group(histfile)["paths"].asstr()[...]
+            self._rows[name] = {path: i for i, path in enumerate(paths)}
+        return self._rows[name]
+
+    def systematics(self, histfile):
+        """Variations of a file with systematic axis, None otherwise"""
+        group = self._group(histfile)
+        if "sys" not in group:
+            return None
+        return list(group["sys"].asstr()[...])
+
+    def _locate(self, histfile, path, sys=None):
+        """Row and variation index (None without systematic axis) of a path,
+        <dataset>/<sys>/... selects the variation if sys is not given"""
+        rows = self.rows(histfile)
+        sysnames = self.systematics(histfile)
+        if sysnames is None:
+            if sys is not None:
+                path = _insert_sys(path, sys)
+            if path not in rows:
+                raise KeyError(f"{path} not in {histfile}")
+            return rows[path], None
+        if sys is None:
+            parts = path.split("/")
+            if path not in rows and len(parts) > 2 and parts[1] in sysnames:
+                sys, path = parts[1], "/".join(parts[:1] + parts[2:])
+            else:
+                sys = "nominal"
+        if path not in rows or sys not in sysnames:
+            raise KeyError(f"{path} ({sys}) not in {histfile}")
+        row, index = rows[path], sysnames.index(sys)
+        if not self._group(histfile)["has_sys"][row, index]:
+            raise KeyError(f"{path} has no variation {sys} in {histfile}")
+        return row, index
+
+    def _array(self, dataset):
+        # contiguous uncompressed arrays are memory mapped, otherwise h5py
+        # reads only the chunks of the requested rows
+        if dataset.chunks is None and dataset.compression is None:
+            offset = dataset.id.get_offset()
+            if offset is not None:
+                return np.memmap(self.path, dtype=dataset.dtype, mode="r",
+                                 offset=offset, shape=dataset.shape)
+        return dataset
+
+    def values(self, histfile, path, sys=None, flow=True):
+        return self._read(histfile, path, sys, "values", flow)
+
+    def variances(self, histfile, path, sys=None, flow=True):
+        return self._read(histfile, path, sys, "variances", flow)
+
+    def _read(self, histfile, path, sys, field, flow):
+        group = self._group(histfile)
+        row, index = self._locate(histfile, path, sys)
+        selection = row if index is None else (row, index)
+        array = np.asarray(self._array(group[field])[selection])
+        if not flow:
+            array = array[(slice(1, -1),) * array.ndim]
+        return array
+
+    def edges(self, histfile):
+        group = self._group(histfile)
+        edges = []
+        while f"edges_{len(edges)}" in group:
+            edges.append(group[f"edges_{len(edges)}"][...])
+        return edges
+
+    def records(self, histfile):
+        """{path: record} of all histograms of a file as read from ROOT files,
+        used to merge stores"""
+        group = self._group(histfile)
+        edges = self.edges(histfile)
+        labels = [list(group[f"labels_{i}"].asstr()[...]) if f"labels_{i}" in group else None
+                  for i in range(len(edges))]
+        sysnames = self.systematics(histfile)
+        titles = group["titles"].asstr()[...]
+        values, variances = group["values"][...], group["variances"][...]
+        records = {}
+        for row, path in enumerate(self.paths(histfile)):
+            record = {
+                "classname": group.attrs["classname"],
+                "title": titles[row],
+                "values": values[row],
+                "variances": variances[row],
+                "entries": float(group["entries"][row]),
+                "edges": edges,
+                "labels": labels,
+                "axis_titles": json.loads(group.attrs["axis_titles"]),
+            }
+            if sysnames is not None:
+                has_sys = group["has_sys"][row]
+                record["sys"] = [name for name, has in zip(sysnames, has_sys) if has]
+                record["values"] = record["values"][has_sys]
+                record["variances"] = record["variances"][has_sys]
+            records[path] = record
+        return records
+
+    def get(self, histfile, path, sys=None):
+        """The histogram as a ROOT TH1/TH2/TH3 (not attached to a directory)"""
+        group = self._group(histfile)
+        row, _ = self._locate(histfile, path, sys)
+        labels = [list(group[f"labels_{i}"].asstr()[...]) if f"labels_{i}" in group else None
+                  for i in range(len(self.edges(histfile)))]
+        return root_hist(
+            group.attrs["classname"], path.rsplit("/", 1)[-1], group["titles"].asstr()[row],
+            self.edges(histfile), self.values(histfile, path, sys),
+            self.variances(histfile, path, sys), float(group["entries"][row]),
+            json.loads(group.attrs["axis_titles"]), labels)
+
+    def open(self, histfile):
+        self._group(histfile)
+        return StoreFile(self, histfile)
+
+
+_stores = {}
+
+
+def find_store(path):
+    """Store next to a (possibly removed) ROOT file of hists.json, None if
+    there is none"""
+    store_path = os.path.join(os.path.dirname(os.path.abspath(path)), STORE_NAME)
+    if not os.path.exists(store_path):
+        return None
+    if store_path not in _stores:
+        _stores[store_path] = HistStore(store_path)
+    return _stores[store_path]
+
+
+def open_hist_file(path):
+    """ROOT.TFile.Open(path, "read"), for files only in hists.h5 a StoreFile"""
+    import ROOT
+    path = str(path)
+    if "://" not in path and not os.path.exists(path):
+        store = find_store(path)
+        histfile = os.path.basename(path)
+        if store is not None and histfile in store:
+            return store.open(histfile)
+    return ROOT.TFile.Open(path, "read")
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Consolidated histogram store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    parser_pack = subparsers.add_parser("pack", help="Pack the ROOT files of a hists.json")
+    parser_pack.add_argument("histjson", help="hists.json of the pepper output")
+    parser_pack.add_argument("-o", "--output", default=None,
+                             help=f"Store, default: {STORE_NAME} next to hists.json")
+    parser_pack.add_argument("--compression", choices=list(COMPRESSION), default="gzip")
+    parser_pack.add_argument("--remove", action="store_true",
+                             help="Remove the ROOT files after packing")
+    parser_list = subparsers.add_parser("list", help="List the packed histograms")
+    parser_list.add_argument("store")
+    parser_list.add_argument("--hists", default="*", help="Pattern of the packed files")
+    parser_list.add_argument("--paths", action="store_true",
+                             help="Show the histograms in every file")
+    parser_show = subparsers.add_parser("show", help="Print one histogram")
+    parser_show.add_argument("store")
+    parser_show.add_argument("histfile")
+    parser_show.add_argument("path", help="Object path, e.g. <dataset>/nominal/hist")
+    parser_show.add_argument("--sys", default=None, help="Variation of a file with systematic axis")
+    args = parser.parse_args()
+
+    if args.command == "pack":
+        print(f"Written {pack(args.histjson, args.output, args.compression, args.remove)}")
+    elif args.command == "list":
+        with HistStore(args.store) as store:
+            for histfile in store.histfiles():
+                if not fnmatch.fnmatchcase(histfile, args.hists):
+                    continue
+                paths = store.paths(histfile)
+                sysnames = store.systematics(histfile)
+                variations = "" if sysnames is None else f" x {len(sysnames)} variations"
+                print(f"{histfile:<70} {len(paths):6d} histograms{variations}")
+                if args.paths:
+                    for path in paths:
+                        print(f"    {path}")
+    elif args.command == "show":
+        with HistStore(args.store) as store:
+            print("edges:")
+            for edges in store.edges(args.histfile):
+                print(f"    {edges}")
+            print("values (with under- and overflow):")
+            print(store.values(args.histfile, args.path, args.sys))
+            print("variances:")
+            print(store.variances(args.histfile, args.path, args.sys))
@@ -0,0 +1,232 @@
+import numpy as np
+
+# 2D histogram with a separate (variable) x binning in every y slice.
+# Numpy version of the former utils/histogram2d.cpp, it needs ROOT only to
+# import from or export to TH2D and can be pickled, e.g. to build the fake
+# rate maps of several regions in worker processes.
+# As in ROOT the slices and bins are numbered with the underflow as 0 and the
+# overflow as n+1: y slice 0 holds all entries below the y axis and slice
+# len(y_axis) all entries above, every slice keeps its x under- and overflow.
+
+
+def find_bin(edges, values):
+    """ROOT bin number (0 underflow, len(edges) overflow) of the values"""
+    return np.searchsorted(edges, values, side="right")
+
+
+def bin_centers(edges):
+    """Bin centers including under- and overflow, these use the average
+    bin width as TAxis::GetBinCenter"""
+    edges = np.asarray(edges, dtype=np.float64)
+    width = (edges[-1] - edges[0]) / (len(edges) - 1)
+    return np.concatenate((
+        [edges[0] - 0.5 * width],
+        0.5 * (edges[1:] + edges[:-1]),
+        [edges[-1] + 0.5 * width]))
+
+
+def edges_subset(edges, other_edges):
+    """All edges are (within float precision) also in other_edges"""
+    edges = np.asarray(edges, dtype=np.float64)
+    other_edges = np.asarray(other_edges, dtype=np.float64)
+    distance = np.abs(edges[:, None] - other_edges[None, :]).min(axis=1)
+    return bool(np.all(distance < 2 * np.finfo(np.float32).eps))
+
+
+def th2_to_numpy(histo):
+    """Contents, squared errors (both including flow bins, shape (ny+2, nx+2))
+    and edges of a TH2"""
+    x_axis = histo.GetXaxis()
+    y_axis = histo.GetYaxis()
+    nx, ny = x_axis.GetNbins(), y_axis.GetNbins()
+    x_edges = np.array([x_axis.GetBinLowEdge(i) for i in range(1, nx + 2)])
+    y_edges = np.array([y_axis.GetBinLowEdge(i) for i in range(1, ny + 2)])
+    content = np.zeros((ny + 2, nx + 2))
+    sumw2 = np.zeros((ny + 2, nx + 2))
+    for iy in range(ny + 2):
+        for ix in range(nx + 2):
+            content[iy, ix] = histo.GetBinContent(ix, iy)
+            sumw2[iy, ix] = histo.GetBinError(ix, iy)**2
+    return content, sumw2, x_edges, y_edges
+
+
+def extrapolate_zero_bins(content, sumw2):
+    """Empty bins (flow bins excluded) are set to the mean of their non-empty
+    neighbours, bins are treated in order so an extrapolated bin counts as
+    non-empty for the next one"""
+    for i in range(1, len(content) - 1):
+        if content[i] != 0:
+            continue
+        values, errors2 = [], []
+        if i > 1 and content[i - 1] != 0:
+            values.append(content[i - 1])
+            errors2.append(sumw2[i - 1])
+        if i < len(content) - 2 and content[i + 1] != 0:
+            values.append(content[i + 1])
+            errors2.append(sumw2[i + 1])
+        if len(values) == 2:
+            content[i] = (values[0] + values[1]) / 2
+            sumw2[i] = (errors2[0] + errors2[1]) / 4
+        elif len(values) == 1:
+            content[i] = values[0]
+            sumw2[i] = errors2[0]
+
+
+class Histogram2D:
+
+    def __init__(self, name, y_axis, xmin, xmax):
+        self.name = name
+        self.y_axis = np.asarray(y_axis, dtype=np.float64)
+        self.xmin = float(xmin)
+        self.xmax = float(xmax)
+        n_slices = len(self.y_axis) + 1
+        self.x_axes = [None] * n_slices
+        self.content = [None] * n_slices
+        self.sumw2 = [None] * n_slices
+
+    def add_x_binning_by_index(self, index, x_axis):
+        if index < 0 or index >= len(self.x_axes):
+            raise IndexError(f"Index {index} out of y-axis range")
+        x_axis = np.asarray(x_axis, dtype=np.float64)
+        self.x_axes[index] = x_axis
+        self.content[index] = np.zeros(len(x_axis) + 1)
+        self.sumw2[index] = np.zeros(len(x_axis) + 1)
+
+    def _check_initialized(self):
+        missing = [i for i, x_axis in enumerate(self.x_axes) if x_axis is None]
+        if len(missing) > 0:
+            raise ValueError(f"No x binning given for y slices {missing} of {self.name}")
+
+    def can_be_imported(self, x_edges, y_edges):
+        if not edges_subset(self.y_axis, y_edges):
+            print("Invalid y-axis binning found")
+            return False
+        for iy, x_axis in enumerate(self.x_axes):
+            if not edges_subset(x_axis, x_edges):
+                print(f"Invalid x axis binning found for y bin n. {iy}")
+                return False
+        return True
+
+    def add(self, content, sumw2, x_edges, y_edges):
+        """Add a binned 2D array (shape (ny+2, nx+2) with flow bins, rows
+        are y) with a binning finer than the one of this histogram"""
+        self._check_initialized()
+        if not self.can_be_imported(x_edges, y_edges):
+            raise ValueError(f"Histogram can not be imported into {self.name}")
+        content = np.asarray(content, dtype=np.float64)
+        sumw2 = np.asarray(sumw2, dtype=np.float64)
+        x_centers = bin_centers(x_edges)
+        slices = find_bin(self.y_axis, bin_centers(y_edges))
+        for iy, slice_index in enumerate(slices):
+            x_bins = find_bin(self.x_axes[slice_index], x_centers)
+            np.add.at(self.content[slice_index], x_bins, content[iy])
+            np.add.at(self.sumw2[slice_index], x_bins, sumw2[iy])
+
+    def th2d_add(self, histo):
+        content, sumw2, x_edges, y_edges = th2_to_numpy(histo)
+        self.add(content, sumw2, x_edges, y_edges)
+
+    def fill(self, x, y, weight=None):
+        self._check_initialized()
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        weight = np.ones(len(x)) if weight is None else np.asarray(weight, dtype=np.float64)
+        slices = find_bin(self.y_axis, y)
+        for slice_index in np.unique(slices):
+            mask = slices == slice_index
+            x_bins = find_bin(self.x_axes[slice_index], x[mask])
+            np.add.at(self.content[slice_index], x_bins, weight[mask])
+            np.add.at(self.sumw2[slice_index], x_bins, weight[mask]**2)
+
+    def divide(self, histo, option="", extrapolate=False):
+        """Divide by another Histogram2D with the same binning, with errors as
+        TH1::Divide (option "B" for binomial errors)"""
+        self._check_initialized()
+        if not np.array_equal(self.y_axis, histo.y_axis):
+            raise ValueError(f"Invalid y binning detected on denominator for Histogram2D {histo.name}")
+        for iy in range(len(self.x_axes)):
+            if not np.array_equal(self.x_axes[iy], histo.x_axes[iy]):
+                raise ValueError(f"Invalid x-axis binning found for denominator in y bin n. {iy} "
+                                 f"for Histogram2D {histo.name}")
+            b1, e1sq = self.content[iy], self.sumw2[iy]
+            b2, e2sq = histo.content[iy], histo.sumw2[iy]
+            nonzero = b2 != 0
+            safe_b2 = np.where(nonzero, b2, 1)
+            ratio = np.where(nonzero, b1 / safe_b2, 0)
+            if option == "B":
+                sumw2 = np.abs(((1 - 2 * ratio) * e1sq + b1**2 * e2sq / safe_b2**2) / safe_b2**2)
+                sumw2 = np.where(b1 == b2, 0, sumw2)
+            else:
+                sumw2 = (e1sq * safe_b2**2 + e2sq * b1**2) / safe_b2**4
+            self.content[iy] = ratio
+            self.sumw2[iy] = np.where(nonzero, sumw2, 0)
+            if extrapolate and 0 < iy < len(self.x_axes) - 1:
+                extrapolate_zero_bins(self.content[iy], self.sumw2[iy])
+
+    def reset(self):
+        for iy in range(len(self.x_axes)):
+            if self.x_axes[iy] is not None:
+                self.content[iy][:] = 0
+                self.sumw2[iy][:] = 0
+
+    def weights(self, x_edges=None):
+        """Contents and errors (shape (ny+2, nx+2) with flow bins) on the x
+        binning of the first slice (or x_edges) and the y axis, every bin is
+        taken from the slice bin containing its center. Use only for weights,
+        not for counts"""
+        self._check_initialized()
+        if x_edges is None:
+            x_edges = self.x_axes[0]
+        x_centers = bin_centers(x_edges)
+        slices = find_bin(self.y_axis, bin_centers(self.y_axis))
+        content = np.zeros((len(slices), len(x_centers)))
+        errors = np.zeros((len(slices), len(x_centers)))
+        for iy, slice_index in enumerate(slices):
+            x_bins = find_bin(self.x_axes[slice_index], x_centers)
+            content[iy] = self.content[slice_index][x_bins]
+            errors[iy] = np.sqrt(self.sumw2[slice_index][x_bins])
+        return content, errors, np.asarray(x_edges, dtype=np.float64), self.y_axis
+
+    def _to_th2d(self, name, title, content, errors, x_edges, y_edges, flow=True):
+        import ROOT
+        histo = ROOT.TH2D(name, title, len(x_edges) - 1, np.asarray(x_edges, dtype=np.double),
+                          len(y_edges) - 1, np.asarray(y_edges, dtype=np.double))
+        histo.SetDirectory(0)
+        first, last = (0, 2) if flow else (1, 1)
+        for iy in range(first, len(y_edges) + last - 1):
+            for ix in range(first, len(x_edges) + last - 1):
+                histo.SetBinContent(ix, iy, content[iy, ix])
+                histo.SetBinError(ix, iy, errors[iy, ix])
+        return histo
+
+    def get_weights_th2d_simpl(self, name, title):
+        """TH2D in the x binning of the first slice, flow bins included"""
+        content, errors, x_edges, y_edges = self.weights()
+        return self._to_th2d(name, title, content, errors, x_edges, y_edges)
+
+    def get_weights_th2d(self, name, title):
+        """TH2D with uniform bins of the smallest bin width in x and y"""
+        self._check_initialized()
+        y_width = np.diff(self.y_axis).min()
+        x_width = min(np.diff(x_axis).min() for x_axis in self.x_axes)
+        ny = int((self.y_axis[-1] - self.y_axis[0]) / y_width)
+        nx = int((self.xmax - self.xmin) / x_width)
+        x_edges = np.linspace(self.xmin, self.xmax, nx + 1)
+        y_edges = np.linspace(self.y_axis[0], self.y_axis[-1], ny + 1)
+        x_centers = bin_centers(x_edges)
+        slices = find_bin(self.y_axis, bin_centers(y_edges))
+        content = np.zeros((ny + 2, nx + 2))
+        errors = np.zeros((ny + 2, nx + 2))
+        for iy, slice_index in enumerate(slices):
+            x_bins = find_bin(self.x_axes[slice_index], x_centers)
+            content[iy] = self.content[slice_index][x_bins]
+            errors[iy] = np.sqrt(self.sumw2[slice_index][x_bins])
+        return self._to_th2d(name, title, content, errors, x_edges, y_edges, flow=False)
+
+    def print(self, dir=""):
+        for iy, x_axis in enumerate(self.x_axes):
+            print(f"{self.name}{iy}: y slice {iy}")
+            if x_axis is None:
+                continue
+            for ix in range(len(x_axis) + 1):
+                print(f"  bin {ix}: {self.content[iy][ix]} +- {np.sqrt(self.sumw2[iy][ix])}")
@@ -0,0 +1,399 @@
+import os
+import re
+import glob
+import time
+import queue
+import shutil
+import sqlite3
+import logging
+import threading
+import subprocess
+import weakref
+from argparse import ArgumentParser
+
+# Node-local staging of the input files.
+# Processors with the InputStageMixin copy the files following the current
+# one in its dataset (and the current one, for the next chunks) in a
+# background thread to a local cache directory while the chunk is processed.
+# Every later open of a staged file by uproot in any worker on the node is
+# served from the local copy, files not staged yet are read remotely as
+# before. The cache is shared by all workers of a node through an SQLite
+# index in the cache directory: files are staged once, reads hold a
+# reference (per process, released when the file is closed) and the least
+# recently used files without references are evicted to stay below the size
+# limit. /pnfs and root:// paths of the same file share one entry.
+# Enabled in the processor config with
+#     "input_stage": "$TMPDIR/llstau_stage",   (environment variables are expanded)
+#     "input_stage_max_size": 50,              (GB, default 20)
+#     "input_stage_prefetch": 2                (files ahead, default 2)
+# Hit ratio and staging throughput of a cache directory:
+#   python utils/input_stage.py stats $TMPDIR/llstau_stage
+# A local directory can stand in for the remote storage:
+#   python utils/input_stage.py prefetch /tmp/stage /data/nanoaod/*.root --max-size 5
+
+logger = logging.getLogger(__name__)
+
+INDEX_NAME = "index.sqlite"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    key TEXT PRIMARY KEY, local TEXT, size INTEGER, state TEXT,
+    owner INTEGER, last_used REAL);
+CREATE TABLE IF NOT EXISTS refs (key TEXT, pid INTEGER);
+CREATE INDEX IF NOT EXISTS refs_key ON refs (key);
+CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value REAL);
+"""
+
+STATS = ("hits", "misses", "hit_bytes", "staged_files", "staged_bytes",
+         "staging_seconds", "evicted_files", "evicted_bytes", "failed")
+
+
+def file_key(path):
+    """Same key for the /pnfs and the root://<domain>/ path of a file"""
+    return re.sub(r"^[a-z]+://[^/]+/", "", path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _copy(source, target):
+    if "://" in source:
+        subprocess.run(["xrdcp", "--silent", "--force", source, target], check=True)
+    else:
+        shutil.copyfile(source, target)
+
+
+class InputStage:
+
+    def __init__(self, directory, max_size=20 * 1024**3, n_threads=1):
+        self.directory = directory
+        self.max_size = max_size
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, INDEX_NAME)
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+        self._queue = queue.Queue()
+        self._queued = set()
+        self._lock = threading.Lock()
+        self._threads = []
+        for _ in range(n_threads):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _connect(self):
+        # one connection per call, the index is used from several threads
+        conn = sqlite3.connect(self.index_path, timeout=120, isolation_level=None)
+        return _Connection(conn)
+
+    def _count(self, conn, **values):
+        for name, value in values.items():
+            conn.execute(
+                "INSERT INTO stats VALUES (?, ?) "
+                "ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+                (name, value))
+
+    def local_path(self, key):
+        name = re.sub(r"[^A-Za-z0-9_.-]", "_", key.lstrip("/"))
+        return os.path.join(self.directory, name[-200:])
+
+    def open(self, path):
+        """Local copy of the file with a reference held by this process, None
+        if it is not staged"""
+        key = file_key(path)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT local, size FROM files WHERE key=? AND state='ready'", (key,)).fetchone()
+            if row is not None and os.path.exists(row[0]):
+                conn.execute("INSERT INTO refs VALUES (?, ?)", (key, os.getpid()))
+                conn.execute("UPDATE files SET last_used=? WHERE key=?", (time.time(), key))
+                self._count(conn, hits=1, hit_bytes=row[1])
+                conn.execute("COMMIT")
+                return row[0]
+            self._count(conn, misses=1)
+            conn.execute("COMMIT")
+        return None
+
+    def release(self, path):
+        key = file_key(path)
+        with self._connect() as conn:
+            conn.execute(
+                "DELETE FROM refs WHERE rowid = (SELECT rowid FROM refs WHERE key=? AND pid=? LIMIT 1)",
+                (key, os.getpid()))
+
+    def prefetch(self, paths):
+        """Stage the files in the background (in the given order)"""
+        with self._lock:
+            for path in paths:
+                if path in self._queued:
+                    continue
+                self._queued.add(path)
+                self._queue.put(path)
+
+    def _work(self):
+        while True:
+            path = self._queue.get()
+            try:
+                self.stage(path)
+            except Exception as e:
+                logger.warning(f"Staging {path} failed: {e}")
+            finally:
+                with self._lock:
+                    self._queued.discard(path)
+
+    def _claim(self, key, size):
+        """Reserve the space for a file, False if it is (being) staged or
+        does not fit"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT state, owner FROM files WHERE key=?", (key,)).fetchone()
+            if row is not None and (row[0] == "ready" or _alive(row[1])):
+                conn.execute("COMMIT")
+                return False
+            if size > self.max_size:
+                conn.execute("COMMIT")
+                return False
+            self._evict(conn, self.max_size - size, exclude=key)
+            used = conn.execute(
+                "SELECT COALESCE(SUM(size), 0) FROM files WHERE key != ?", (key,)).fetchone()[0]
+            if used + size > self.max_size:
+                conn.execute("COMMIT")
+                return False
+            conn.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, 'staging', ?, ?)",
+                (key, self.local_path(key), size, os.getpid(), time.time()))
+            conn.execute("COMMIT")
+        return True
+
+    def _evict(self, conn, target, exclude=None):
+        """Remove least recently used files without live references until at
+        most target bytes are used"""
+        used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM files").fetchone()[0]
+        if used <= target:
+            return
+        # references of processes that died are dropped
+        for key, pid in conn.execute("SELECT key, pid FROM refs").fetchall():
+            if not _alive(pid):
+                conn.execute("DELETE FROM refs WHERE key=? AND pid=?", (key, pid))
+        rows = conn.execute(
+            "SELECT key, local, size, state, owner FROM files WHERE key NOT IN "
+            "(SELECT key FROM refs) ORDER BY last_used").fetchall()
+        for key, local, size, state, owner in rows:
+            if used <= target:
+                break
+            if key == exclude or (state == "staging" and _alive(owner)):
+                continue
+            if os.path.exists(local):
+                os.remove(local)
+            conn.execute("DELETE FROM files WHERE key=?", (key,))
+            self._count(conn, evicted_files=1, evicted_bytes=size)
+            used -= size
+
+    def stage(self, path):
+        """Copy the file to the cache if it is not there yet"""
+        key = file_key(path)
+        size = os.path.getsize(key) if "://" not in path or os.path.exists(key) else 0
+        if not self._claim(key, size):
+            return False
+        local = self.local_path(key)
+        start = time.time()
+        try:
+            _copy(path, local + ".part")
+            os.replace(local + ".part", local)
+        except Exception:
+            with self._connect() as conn:
+                conn.execute("DELETE FROM files WHERE key=?", (key,))
+                self._count(conn, failed=1)
+            if os.path.exists(local + ".part"):
+                os.remove(local + ".part")
+            raise
+        size = os.path.getsize(local)
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            conn.execute(
+                "UPDATE files SET state='ready', size=?, last_used=? WHERE key=?",
+                (size, time.time(), key))
+            self._count(conn, staged_files=1, staged_bytes=size,
+                        staging_seconds=time.time() - start)
+            # the size of remote files is only known after the copy
+            self._evict(conn, self.max_size, exclude=key)
+            conn.execute("COMMIT")
+        return True
+
+    def wait(self):
+        """Wait until the queued files are staged"""
+        while True:
+            with self._lock:
+                if len(self._queued) == 0:
+                    return
+            time.sleep(0.1)
+
+    def stats(self):
+        with self._connect() as conn:
+            values = dict(conn.execute("SELECT name, value FROM stats").fetchall())
+            n_files, used = conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM files WHERE state='ready'").fetchone()
+        result = {name: values.get(name, 0.) for name in STATS}
+        requests = result["hits"] + result["misses"]
+        result["hit_ratio"] = result["hits"] / requests if requests > 0 else float("nan")
+        result["staging_MBps"] = (result["staged_bytes"] / 1024**2 / result["staging_seconds"]
+                                  if result["staging_seconds"] > 0 else float("nan"))
+        result["files"] = n_files
+        result["used_bytes"] = used
+        return result
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            self._evict(conn, 0)
+            conn.execute("DELETE FROM stats")
+            conn.execute("COMMIT")
+
+
+class _Connection:
+    # sqlite3 connection closed at the end of the with block
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, *exc):
+        if exc[0] is not None and self.conn.in_transaction:
+            self.conn.execute("ROLLBACK")
+        self.conn.close()
+
+
+# uproot sources, installed in the worker processes
+
+_active_stage = None
+_installed = False
+
+
+def _staged_source_classes():
+    import uproot
+
+    class LocalStagedSource(uproot.source.file.MemmapSource):
+        """Memory mapped local copy, releases the reference when closed"""
+
+        def __init__(self, local_path, stage, remote_path, **options):
+            super().__init__(local_path, **options)
+            self._release = weakref.finalize(self, stage.release, remote_path)
+
+        def __exit__(self, exception_type, exception_value, traceback):
+            super().__exit__(exception_type, exception_value, traceback)
+            self._release()
+
+    def staged(base):
+        # subclass of the original source so that uproot accepts it, returns
+        # the local source for staged files
+        def __new__(cls, file_path, **options):
+            if _active_stage is not None:
+                local = _active_stage.open(file_path)
+                if local is not None:
+                    return LocalStagedSource(local, _active_stage, file_path, **options)
+            return base.__new__(cls)
+        return type("Staged" + base.__name__, (base,), {"__new__": __new__})
+
+    return staged
+
+
+def install(stage):
+    """Read staged files through the stage (in this process)"""
+    global _active_stage, _installed
+    _active_stage = stage
+    if _installed:
+        return
+    import uproot
+    staged = _staged_source_classes()
+    replacements = {}
+    for name in ("MemmapSource", "MultithreadedFileSource",
+                 "XRootDSource", "MultithreadedXRootDSource"):
+        if hasattr(uproot, name):
+            replacements[name] = staged(getattr(uproot, name))
+            # coffea passes uproot.MemmapSource etc. as file_handler
+            setattr(uproot, name, replacements[name])
+    defaults = getattr(uproot.open, "defaults", {})
+    for option in ("file_handler", "xrootd_handler"):
+        name = getattr(defaults.get(option), "__name__", None)
+        if name in replacements:
+            defaults[option] = replacements[name]
+    _installed = True
+
+
+_stages = {}
+
+
+def get_stage(config):
+    """InputStage of the config, one per process"""
+    directory = os.path.expandvars(config["input_stage"])
+    if directory not in _stages:
+        max_size = config["input_stage_max_size"] if "input_stage_max_size" in config else 20
+        _stages[directory] = InputStage(directory, max_size * 1024**3)
+    return _stages[directory]
+
+
+class InputStageMixin:
+    """Processor mixin staging the input files to a node-local directory,
+    enabled by ``input_stage`` in the config"""
+
+    def _dataset_files(self, dsname):
+        if not hasattr(self, "_input_stage_files"):
+            self._input_stage_files = {}
+        if dsname not in self._input_stage_files:
+            files = []
+            for group in ("exp_datasets", "mc_datasets"):
+                if group in self.config and dsname in self.config[group]:
+                    for pattern in self.config[group][dsname]:
+                        files.extend(sorted(glob.glob(pattern)) or [pattern])
+            self._input_stage_files[dsname] = files
+        return self._input_stage_files[dsname]
+
+    def process(self, data):
+        if not ("input_stage" in self.config and self.config["input_stage"]):
+            return super().process(data)
+        stage = get_stage(self.config)
+        install(stage)
+        filename = data.metadata["filename"]
+        n_ahead = self.config["input_stage_prefetch"] if "input_stage_prefetch" in self.config else 2
+        files = self._dataset_files(data.metadata.get("dataset"))
+        keys = [file_key(path) for path in files]
+        following = []
+        if file_key(filename) in keys:
+            position = keys.index(file_key(filename))
+            prefix = filename[:len(filename) - len(file_key(filename))]
+            following = [prefix + key for key in keys[position + 1:position + 1 + n_ahead]]
+        stage.prefetch([filename] + following)
+        return super().process(data)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Node-local input staging cache")
+    parser.add_argument("command", choices=["stats", "prefetch", "clear"])
+    parser.add_argument("directory", help="Cache directory")
+    parser.add_argument("files", nargs="*", help="prefetch: files to stage")
+    parser.add_argument("--max-size", type=float, default=20., help="Cache size (GB)")
+    args = parser.parse_args()
+
+    stage = InputStage(args.directory, args.max_size * 1024**3)
+    if args.command == "prefetch":
+        stage.prefetch(args.files)
+        stage.wait()
+    elif args.command == "clear":
+        stage.clear()
+    stats = stage.stats()
+    print(f"{stats['files']} files, {stats['used_bytes'] / 1024**3:.2f} GB staged")
+    print(f"hit ratio {stats['hit_ratio']:.3f} ({stats['hits']:.0f} hits, {stats['misses']:.0f} misses), "
+          f"{stats['hit_bytes'] / 1024**3:.2f} GB read locally")
+    print(f"staging {stats['staged_files']:.0f} files, {stats['staged_bytes'] / 1024**3:.2f} GB "
+          f"at {stats['staging_MBps']:.1f} MB/s, {stats['failed']:.0f} failed")
+    print(f"evicted {stats['evicted_files']:.0f} files, {stats['evicted_bytes'] / 1024**3:.2f} GB")
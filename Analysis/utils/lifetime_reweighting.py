@@ -0,0 +1,83 @@
+import re
+
+import numpy as np
+import awkward as ak
+
+from .gen_ancestry import STAU_IDS, VERTEX_FIELDS
+
+# Lifetime reweighting of the stau signal samples.
+# The proper decay length of every generated stau is
+#     ct = L * m / p
+# with L the distance between the production vertex of its last copy
+# (statusFlags bit 13) and the production vertex of a non-stau daughter of
+# the last copy (decay vertex). An event generated with ctau_0 is reweighted
+# to ctau by the product over its staus of
+#     ctau_0 / ctau * exp(-ct * (1 / ctau - 1 / ctau_0))
+# Staus without such daughters in GenPart (not decayed by the generator) have no
+# decay vertex and do not contribute, so long-lived sources should be
+# reweighted only to targets for which such staus are negligible.
+# The signal processor adds the weights of all targets in "ctau_targets"
+# (mm) as weight variations named ctau_<value>, e.g. ctau_0p5mm, which are
+# filled as additional entries of the systematic axis of every histogram, so
+# a few source samples per mass give the histograms of the whole ctau grid.
+# The cross section of a target point is the one of the source sample (it
+# only depends on the mass).
+
+# statusFlags bit of isLastCopy
+LAST_COPY_FLAG = 1 << 13
+CTAU_PATTERN = re.compile(r"ctau-?(\d+(?:p\d+)?)mm")
+
+
+def parse_ctau(dsname):
+    """Generated ctau of a signal dataset in mm"""
+    match = CTAU_PATTERN.search(dsname)
+    if match is None:
+        raise ValueError(f"No ctau in dataset name {dsname}")
+    return float(match.group(1).replace("p", "."))
+
+
+def ctau_label(ctau):
+    """Label of a ctau in mm as in the dataset names (0.5 -> 0p5mm)"""
+    return f"{ctau:g}".replace(".", "p") + "mm"
+
+
+def stau_proper_lengths(genpart):
+    """Proper decay length (mm) of every decaying stau (last copy) as a flat
+    array, and the event of every stau"""
+    counts = np.asarray(ak.to_numpy(ak.num(genpart, axis=1)), dtype=np.int64)
+    event = np.repeat(np.arange(len(counts)), counts)
+    event_start = np.repeat(np.cumsum(counts) - counts, counts)
+
+    def flat(field):
+        return np.asarray(ak.to_numpy(ak.flatten(genpart[field])))
+
+    is_stau = np.isin(np.abs(flat("pdgId")), STAU_IDS)
+    last_copy = (flat("statusFlags").astype(np.int64) & LAST_COPY_FLAG) != 0
+    mother = flat("genPartIdxMother").astype(np.int64)
+    has_mother = mother >= 0
+    mother[has_mother] += event_start[has_mother]
+    # the decay vertex is the production vertex of the non-stau daughters
+    # (photons radiated by earlier copies are daughters of those copies)
+    decaying = is_stau & last_copy
+    daughter = has_mother & ~is_stau
+    daughter[daughter] = decaying[mother[daughter]]
+    vertex = np.stack([flat(field).astype(np.float64) for field in VERTEX_FIELDS], axis=1)
+    decay_vertex = np.full_like(vertex, np.nan)
+    decay_vertex[mother[daughter]] = vertex[daughter]
+    decaying &= ~np.isnan(decay_vertex[:, 0])
+
+    length = np.sqrt(((decay_vertex[decaying] - vertex[decaying])**2).sum(axis=1))
+    momentum = (flat("pt") * np.cosh(flat("eta")))[decaying]
+    # vertices are in cm
+    return 10 * length * flat("mass")[decaying] / momentum, event[decaying]
+
+
+def lifetime_weights(proper_lengths, event, n_events, source_ctau, target_ctaus):
+    """Weights (n_targets, n_events) from the source to the target ctau (mm)"""
+    targets = np.asarray(target_ctaus, dtype=np.float64)[:, None]
+    log_weights = (np.log(source_ctau / targets)
+                   - proper_lengths[None, :] * (1 / targets - 1 / source_ctau))
+    out = np.empty((len(targets), n_events))
+    for i, row in enumerate(log_weights):
+        out[i] = np.exp(np.bincount(event, weights=row, minlength=n_events))
+    return out
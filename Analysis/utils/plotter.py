@@ -6,8 +6,14 @@ import os
 import shutil
 
 from .utils import *
+from .histogram2d import Histogram2D
+from .stitching import stitching_group
+from .hist_store import open_hist_file
+from .cutflow_store import norm_factors
 
 def plot_predict_sys(dirname, config, xsec, cutflow, output_path):
+    # lumi * xsec / N of all datasets, read once
+    norm = norm_factors(cutflow, xsec, config["luminosity"])
     
     def read_hist(file, data_name, sys):
         hist = file.Get(data_name+"/"+sys+"/hist")
@@ -48,7 +54,7 @@ def plot_predict_sys(dirname, config, xsec, cutflow, output_path):
             # ----------------------------------------------
             path_predict = dirname+"/"+cut+"_"+hist+"_yield_"+prediction_bin+".root"
             print(path_predict)
-            file_predict = ROOT.TFile.Open(path_predict, 'read')
+            file_predict = open_hist_file(path_predict)
             hist_prediction = None
             hist_prediction_sys = {sys:None for sys in systematics}
             for data_group in config["Data"].keys():
@@ -120,8 +126,8 @@ def plot_predict_sys(dirname, config, xsec, cutflow, output_path):
             path_data = dirname+"/"+cut+"_"+hist+"_pass.root"
             # path_data = dirname+"/"+cut+"_"+hist+".root"
             print(path_data)
-            file_n_pass_sig = ROOT.TFile.Open(path_data, 'read')
-            file_n_pass = ROOT.TFile.Open(path_data, 'read')
+            file_n_pass_sig = open_hist_file(path_data)
+            file_n_pass = open_hist_file(path_data)
 
             if config["prediction_hist"]["plot_unblind"]:
                 hist_data = None
@@ -153,8 +159,7 @@ def plot_predict_sys(dirname, config, xsec, cutflow, output_path):
                     for _dataset_idx, _histogram_data in enumerate(config["Labels"][_group_name]):
                         print("Adding signal dataset:", _histogram_data)
                         _hist = read_hist(file_n_pass_sig, _histogram_data, "nominal/"+data_bin)
-                        N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                        scale =  xsec[_histogram_data] * config["luminosity"] / N
+                        scale = norm[_histogram_data]
                         for bin_i in range(0, _hist.GetNbinsX()+2):
                             _hist.SetBinContent(bin_i, _hist.GetBinContent(bin_i)*scale)
                             _hist.SetBinError(bin_i, _hist.GetBinError(bin_i)*scale)
@@ -223,6 +228,8 @@ def plot_predict_sys(dirname, config, xsec, cutflow, output_path):
             )
 
 def plot_predict(dirname, config, xsec, cutflow, output_path):
+    # lumi * xsec / N of all datasets, read once
+    norm = norm_factors(cutflow, xsec, config["luminosity"])
     
     for prediction_bin, data_bin in zip(config["prediction_hist"]["predictions"], config["prediction_hist"]["bin_data"]):
         for hist in config["prediction_hist"]["hists"]:
@@ -238,7 +245,7 @@ def plot_predict(dirname, config, xsec, cutflow, output_path):
             # ----------------------------------------------
             path_predict = dirname+"/"+cut+"_"+hist+"_yield_"+prediction_bin+".root"
             print(path_predict)
-            file_predict = ROOT.TFile.Open(path_predict, 'read')
+            file_predict = open_hist_file(path_predict)
             # print(file_predict.ls())
             hist_prediction = None
             isDATA = False
@@ -273,26 +280,13 @@ def plot_predict(dirname, config, xsec, cutflow, output_path):
                     else:
                         if isDATA: raise("Can not combine data and MC")
 
-                        if config["DY_stitching_applied"] and (
-                                "DYJetsToLL_M-50" in data_name or
-                                "DY1JetsToLL_M-50" in data_name or
-                                "DY2JetsToLL_M-50" in data_name or
-                                "DY3JetsToLL_M-50" in data_name or
-                                "DY4JetsToLL_M-50" in data_name ):
-                            # print("Stitching:", data_name)
-                            _hist_predict.Scale(config["luminosity"])
-                        elif config["W_stitching_applied"] and (
-                                ("WJetsToLNu" in data_name and (not "TTWJets" in data_name)) or
-                                "W1JetsToLNu" in data_name or
-                                "W2JetsToLNu" in data_name or
-                                "W3JetsToLNu" in data_name or
-                                "W4JetsToLNu" in data_name ):
+                        group = stitching_group(data_name)
+                        if group is not None and config[f"{group}_stitching_applied"]:
                             # print("Stitching:", data_name)
                             _hist_predict.Scale(config["luminosity"])
                         else:
                             # N = cutflow[_histogram_data]["all"]["NanDrop"] #After Nan dropper
-                            N = cutflow[data_name]["all"]["BeforeCuts"]
-                            _hist_predict.Scale( (xsec[data_name] * config["luminosity"]) / N)
+                            _hist_predict.Scale(norm[data_name])
 
                     if hist_prediction == None:
                         hist_prediction = _hist_predict
@@ -322,8 +316,8 @@ def plot_predict(dirname, config, xsec, cutflow, output_path):
             # -----------------------------------------------
             path_data = dirname+"/"+cut+"_"+hist+"_pass.root"
             print(path_data)
-            file_n_pass_sig = ROOT.TFile.Open(path_data, 'read')
-            file_n_pass = ROOT.TFile.Open(path_data, 'read')
+            file_n_pass_sig = open_hist_file(path_data)
+            file_n_pass = open_hist_file(path_data)
             # print(file_n_pass_sig.ls())
             # print(file_n_pass.ls())
             if config["prediction_hist"]["plot_unblind"]:
@@ -381,8 +375,7 @@ def plot_predict(dirname, config, xsec, cutflow, output_path):
                                 _hist_data.Scale(config["luminosity"])
                             else:
                                 # N = cutflow[_histogram_data]["all"]["NanDrop"] #After Nan dropper
-                                N = cutflow[data_name]["all"]["BeforeCuts"]
-                                _hist_data.Scale( (xsec[data_name] * config["luminosity"]) / N)
+                                _hist_data.Scale(norm[data_name])
 
                        
                         if hist_data == None:
@@ -423,8 +416,7 @@ def plot_predict(dirname, config, xsec, cutflow, output_path):
                             _hist = file_n_pass_sig.Get(_histogram_data)
                             _hist = _hist.ProjectionX(_histogram_data+"_proj", data_bin, data_bin)
                         _hist.SetDirectory(0)
-                        N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                        scale =  xsec[_histogram_data] * config["luminosity"] / N
+                        scale = norm[_histogram_data]
                         # _hist.Scale( (xsec[_histogram_data] * config["luminosity"]) / N)
                         for bin_i in range(0, _hist.GetNbinsX()+2):
                             _hist.SetBinContent(bin_i, _hist.GetBinContent(bin_i)*scale)
@@ -498,8 +490,8 @@ def plot_predict(dirname, config, xsec, cutflow, output_path):
             )
 
 def plot_predict2D(dirname, config, xsec, cutflow, output_path):
-    
-    ROOT.gInterpreter.Declare('#include "utils/histogram2d.cpp"')
+    # lumi * xsec / N of all datasets, read once
+    norm = norm_factors(cutflow, xsec, config["luminosity"])
     
     for prediction_bin, data_bin in zip(config["prediction_hist2D"]["predictions"], config["prediction_hist2D"]["bin_data"]):
         for hist in config["prediction_hist2D"]["hists"]:
@@ -512,7 +504,7 @@ def plot_predict2D(dirname, config, xsec, cutflow, output_path):
             cut = config["prediction_hist2D"]["cut"]
             path_predict = dirname+"/"+cut+"_"+hist+"_"+prediction_bin+".root"
             print(path_predict)
-            file_predict = ROOT.TFile.Open(path_predict, 'read')
+            file_predict = open_hist_file(path_predict)
             hist_prediction = None
             for data_group in config["Data"].keys():
                 for data_name in config["Labels"][data_group]:
@@ -526,13 +518,13 @@ def plot_predict2D(dirname, config, xsec, cutflow, output_path):
             y_axis =  np.array(axis_rebin["y_axis"], dtype=np.double)
             xmin, xmax = float(x_axis[0][0]), float(x_axis[0][-1])
     
-            hist_prediction_nonunif = ROOT.Histogram_2D("nonunif_pred", y_axis, xmin, xmax)
+            hist_prediction_nonunif = Histogram2D("nonunif_pred", y_axis, xmin, xmax)
             for i in range(len(x_axis)):
                 hist_prediction_nonunif.add_x_binning_by_index(i, np.array(x_axis[i], dtype=np.double))
             
             try:
                 hist_prediction_nonunif.th2d_add(hist_prediction)
-            except:
+            except ValueError:
                 print("Error is inside project nonunif histograms")
                 print("Error: can not add histogram because of the inconsistency")
                 del hist_prediction_nonunif
@@ -545,7 +537,7 @@ def plot_predict2D(dirname, config, xsec, cutflow, output_path):
             ## ~~~~~~~~~~~~~~~ Signal
             path_data = dirname+"/"+cut+"_"+hist+"_pass.root"
             print(path_data)
-            file_n_pass_sig = ROOT.TFile.Open(path_data, 'read')
+            file_n_pass_sig = open_hist_file(path_data)
             _signal_name = config["prediction_hist2D"]["signal_model"]
             signal_hists = None
             for _dataset_idx, _histogram_data in enumerate(config["Labels"][_signal_name]):
@@ -553,21 +545,20 @@ def plot_predict2D(dirname, config, xsec, cutflow, output_path):
                 print("reading:", _histogram_data+"/nominal/"+data_bin+"/hist")
                 _hist = file_n_pass_sig.Get(_histogram_data+"/nominal/"+data_bin+"/hist")
                 _hist.SetDirectory(0)
-                N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                scale =  xsec[_histogram_data] * config["luminosity"] / N
+                scale = norm[_histogram_data]
                 _hist.Scale(scale)
                 if signal_hists == None:
                     signal_hists = _hist
                 else:
                     signal_hists.Add(_hist)
                     
-            hist_sig_nonunif = ROOT.Histogram_2D("nonunif_sig", y_axis, xmin, xmax)
+            hist_sig_nonunif = Histogram2D("nonunif_sig", y_axis, xmin, xmax)
             for i in range(len(x_axis)):
                 hist_sig_nonunif.add_x_binning_by_index(i, np.array(x_axis[i], dtype=np.double))
             
             try:
                 hist_sig_nonunif.th2d_add(signal_hists)
-            except:
+            except ValueError:
                 print("Error is inside project nonunif histograms")
                 print("Error: can not add histogram because of the inconsistency")
                 del hist_sig_nonunif
@@ -631,6 +622,8 @@ def plot_predict2D(dirname, config, xsec, cutflow, output_path):
                 )
 
 def plot1D(histfiles, histnames, config, xsec, cutflow, output_path, isData):
+    # lumi * xsec / N of all datasets, read once
+    norm = norm_factors(cutflow, xsec, config["luminosity"])
 
     categories_list = list(itertools.product(*config["Categories"]))
     # categories_list = [f"{cat1}_{cat2}_{cat3}" for cat1,cat2,cat3 in categories_list]
@@ -651,7 +644,7 @@ def plot1D(histfiles, histnames, config, xsec, cutflow, output_path, isData):
                 continue
 
             # print("OPEN:", _histfile)
-            file = ROOT.TFile.Open(str(_histfile), 'read')
+            file = open_hist_file(str(_histfile))
 
             _histograms = {"background":[], "signal":[], "data":[]}
             for _group_idx, _group_name in enumerate(config["Labels"].keys()):
@@ -732,8 +725,7 @@ def plot1D(histfiles, histnames, config, xsec, cutflow, output_path, isData):
                             if not config["include_systematics"]:
                                 for i in range(0, hist.GetNbinsX() + 2):
                                     if hist.GetBinContent(i) == 0:
-                                        N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                                        alpha = (xsec[_histogram_data] * config["luminosity"]) / N
+                                        alpha = norm[_histogram_data]
                                         hist.SetBinError(i, -np.log((1 - 0.6827)/2) * alpha)
                             # for i in range(0, hist.GetNbinsX() + 2):
                             #     hist.SetBinError(i, 
@@ -755,8 +747,7 @@ def plot1D(histfiles, histnames, config, xsec, cutflow, output_path, isData):
                                     hist.SetBinError(i, 0.1 * hist.GetBinContent(i))
                         else:
                             # N = cutflow[_histogram_data]["all"]["NanDrop"] #After Nan dropper
-                            N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                            hist.Scale( (xsec[_histogram_data] * config["luminosity"]) / N)
+                            hist.Scale(norm[_histogram_data])
                             print(_histogram_data, hist.Integral())
                             
                     # because QCD-pred is already rebinned,
@@ -934,6 +925,8 @@ def plot1D(histfiles, histnames, config, xsec, cutflow, output_path, isData):
                 )
 
 def doQCDprediction(histfiles, histnames, config, xsec, cutflow, output_path, isData,  histfile_json):
+    # lumi * xsec / N of all datasets, read once
+    norm = norm_factors(cutflow, xsec, config["luminosity"])
 
     # categories_list = list(itertools.product(*config["Categories"]))
     # categories_list = [f"{cat1}_{cat2}_{cat3}" for cat1,cat2,cat3 in categories_list]
@@ -976,7 +969,7 @@ def doQCDprediction(histfiles, histnames, config, xsec, cutflow, output_path, is
                 output = output_path + "/" + _categ
 
             # print("OPEN:", _histfile)
-            file = ROOT.TFile.Open(str(_histfile), 'read')
+            file = open_hist_file(str(_histfile))
 
             _histograms = {"background":[], "data":[]}
             for _group_idx, _group_name in enumerate(config["Labels"].keys()):
@@ -1025,8 +1018,7 @@ def doQCDprediction(histfiles, histnames, config, xsec, cutflow, output_path, is
                             hist.Scale(config["luminosity"])
                         else:
                             # N = cutflow[_histogram_data]["all"]["NanDrop"] #After Nan dropper
-                            N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                            hist.Scale( (xsec[_histogram_data] * config["luminosity"]) / N)
+                            hist.Scale(norm[_histogram_data])
 
                     if _histname in config["SetupBins"]:
                         rebin_setup = config["SetupBins"][_histname][2]
@@ -1122,6 +1114,8 @@ def doQCDprediction(histfiles, histnames, config, xsec, cutflow, output_path, is
             print(nom, den, nom/den)
             
 def plotBrMC(hist_path, config, xsec, cutflow, output_path, is_per_flavour=False):
+    # lumi * xsec / N of all datasets, read once
+    norm = norm_factors(cutflow, xsec, config["luminosity"])
     
     '''
     This code is used to plot the MC branching ratio reading 2D histogram
@@ -1133,12 +1127,12 @@ def plotBrMC(hist_path, config, xsec, cutflow, output_path, is_per_flavour=False
     _histograms = {}
     if is_per_flavour:
         flavours = config["mixing_hists"]["flavours"]
-        file = ROOT.TFile.Open(hist_path+"_0.root", 'read') 
-        file2 = ROOT.TFile.Open(hist_path+"_1.root", 'read')
+        file = open_hist_file(hist_path+"_0.root") 
+        file2 = open_hist_file(hist_path+"_1.root")
         # print(file.ls())
         # print(file2.ls())
     else:
-        file = ROOT.TFile.Open(hist_path+".root", 'read') 
+        file = open_hist_file(hist_path+".root") 
         flavours = [None]
 
     for flav in flavours:
@@ -1188,8 +1182,7 @@ def plotBrMC(hist_path, config, xsec, cutflow, output_path, is_per_flavour=False
                     hist.Scale(config["luminosity"])
                 else:
                     # N = cutflow[_histogram_data]["all"]["NanDrop"] #After Nan dropper
-                    N = cutflow[_histogram_data]["all"]["BeforeCuts"]
-                    hist.Scale( (xsec[_histogram_data] * config["luminosity"]) / N)
+                    hist.Scale(norm[_histogram_data])
 
                 if is_per_flavour:
                     _group_name = flav
@@ -1296,6 +1289,8 @@ def plotBrMC(hist_path, config, xsec, cutflow, output_path, is_per_flavour=False
             )
 
 def plot2D(histfiles, histnames, config, xsec, cutflow, output_path):
+    # lumi * xsec / N of all datasets, read once
+    norm = norm_factors(cutflow, xsec, config["luminosity"], key=("all", "Before cuts"))
 
     categories_list = list(itertools.product(*config["Categories"]))
     categories_list = [f"{cat1}_{cat2}" for cat1,cat2 in categories_list]
@@ -1310,7 +1305,7 @@ def plot2D(histfiles, histnames, config, xsec, cutflow, output_path):
             if not any([cut in str(_histfile) for cut in config["cuts"]]):
                 continue
 
-            file = ROOT.TFile.Open(str(_histfile), 'read')
+            file = open_hist_file(str(_histfile))
 
             _histograms = {"background":[], "signal":[]}
             for _group_idx, _group_name in enumerate(config["Labels"].keys()):
@@ -1323,8 +1318,7 @@ def plot2D(histfiles, histnames, config, xsec, cutflow, output_path):
                     # Rescaling according to cross-section and luminosity
                     # print("Reading hist:", _histogram_data + "_" + _categ)
                     hist = file.Get(_histogram_data + "_" + _categ)
-                    N = cutflow[_histogram_data]["all"]["Before cuts"] #After Nan dropper
-                    hist.Scale( (xsec[_histogram_data] * config["luminosity"]) / N)
+                    hist.Scale(norm[_histogram_data])
 
                     if _histname in config["SetupBins"]:
                         hist.Rebin2D(config["SetupBins"][_histname][4], config["SetupBins"][_histname][5])
@@ -0,0 +1,175 @@
+import numpy as np
+import awkward as ak
+
+# Batched evaluation of the binned corrections (pepper ScaleFactors) of a
+# processor.
+# Every correction is turned once into a dense table with the nominal value
+# and all requested variations, shape (n_variations, n_1 + 2, n_2 + 2, ...)
+# including under- and overflow, by evaluating the ScaleFactors at one point
+# per bin, so flow handling and clipping stay the ones of pepper.
+# Per chunk the bin index of every input is computed once (and shared by all
+# corrections with the same bin edges) and nominal plus variations are read
+# with one gather, e.g.
+#   engine = ScaleFactorEngine(config)
+#   sfs = engine.evaluate("MET_trigger_sfs", ("central", "up", "down"), pt=met_pt)
+#   up, down = variation_ratios(sfs, inflate=np.where(met_pt > 250, 1, 2))
+# Jagged inputs (one value per object) give one value per object, use
+# per_event_product to combine them per event.
+
+CENTRAL = "central"
+
+
+def _flatten(values):
+    """Flat numpy values and the counts if the input is jagged"""
+    if isinstance(values, ak.Array) and values.ndim > 1:
+        counts = ak.to_numpy(ak.num(values, axis=1))
+        values = ak.flatten(values, axis=1)
+    else:
+        counts = None
+    values = ak.to_numpy(ak.fill_none(values, np.nan)) if isinstance(values, ak.Array) else values
+    return np.asarray(values, dtype=np.float64), counts
+
+
+def _flow_points(edges):
+    """One value per bin including under- and overflow"""
+    width = edges[-1] - edges[0]
+    return np.concatenate(([edges[0] - width], 0.5 * (edges[1:] + edges[:-1]), [edges[-1] + width]))
+
+
+def bin_index(edges, values):
+    """Bin with underflow 0 and overflow len(edges), a value on an edge belongs
+    to the bin above (as np.digitize), NaN to the overflow"""
+    return np.searchsorted(edges, values, side="right")
+
+
+class BinnedScaleFactor:
+
+    def __init__(self, sf, variations=(CENTRAL,)):
+        self.variations = list(variations)
+        self.dimlabels = list(sf.dimlabels)
+        bins = getattr(sf, "_bins", None)
+        if bins is None:
+            # no access to the binning, evaluated variation by variation
+            self.sf = sf
+            self.edges = None
+            self.table = None
+            return
+        self.sf = None
+        self.edges = [np.asarray(bins[label], dtype=np.float64) for label in self.dimlabels]
+        grid = np.meshgrid(*[_flow_points(edges) for edges in self.edges], indexing="ij")
+        points = {label: point.ravel() for label, point in zip(self.dimlabels, grid)}
+        shape = grid[0].shape
+        self.table = np.stack([
+            np.asarray(ak.to_numpy(sf(variation=variation, **points))).reshape(shape)
+            for variation in self.variations])
+
+    def indices(self, inputs, cache=None):
+        """Bin index per dimension, cached by input name and bin edges (share
+        a cache only between calls with the same inputs)"""
+        indices = []
+        for label, edges in zip(self.dimlabels, self.edges):
+            key = (label, edges.tobytes())
+            if cache is not None and key in cache:
+                indices.append(cache[key])
+                continue
+            index = bin_index(edges, inputs[label])
+            if cache is not None:
+                cache[key] = index
+            indices.append(index)
+        return tuple(indices)
+
+    def __call__(self, inputs, cache=None):
+        """Values of shape (n_variations, n) for the flat inputs"""
+        if self.table is None:
+            return np.stack([np.asarray(ak.to_numpy(self.sf(variation=variation, **inputs)))
+                             for variation in self.variations])
+        return self.table[(slice(None),) + self.indices(inputs, cache)]
+
+
+class ScaleFactorEngine:
+    """Tables of the binned corrections in the config, built on first use"""
+
+    def __init__(self, config):
+        self.config = config
+        self.tables = {}
+
+    def table(self, name, variations=(CENTRAL,), index=None):
+        key = (name, index, tuple(variations))
+        if key not in self.tables:
+            sf = self.config[name]
+            if index is not None:
+                sf = sf[index]
+            self.tables[key] = BinnedScaleFactor(sf, variations)
+        return self.tables[key]
+
+    def evaluate(self, name, variations=(CENTRAL,), index=None, cache=None,
+                 return_counts=False, **inputs):
+        """Nominal and variations of the correction self.config[name] (or its
+        index-th entry for a list) as one array (n_variations, n); jagged
+        inputs give (n_variations, n_objects), with return_counts the counts
+        of the objects are returned as well"""
+        flat = {}
+        counts = None
+        for label, values in inputs.items():
+            flat[label], counts = _flatten(values)
+        values = self.table(name, variations, index)(flat, cache)
+        if return_counts:
+            return values, counts
+        return values
+
+    def object_sfs(self, name, objects, unctypes=None, key=None):
+        """Per event product over the objects of every correction in the list
+        self.config[name], as the muon_sfs of the processors. With unctypes
+        (e.g. ("",) or ("stat ", "syst ")) the systematics
+        {f"{key}{i}{unctype}": (up / central, down / central)} are returned as
+        well, all variations of a correction are read with one gather"""
+        key = name if key is None else key
+        variations = [CENTRAL]
+        for unctype in unctypes or ():
+            variations += [f"{unctype}up", f"{unctype}down"]
+        weight = np.ones(len(objects))
+        systematics = {}
+        # the corrections usually share (part of) their binning
+        cache = {}
+        for i, sffunc in enumerate(self.config[name]):
+            params = {}
+            for dimlabel in sffunc.dimlabels:
+                if dimlabel == "abseta":
+                    params["abseta"] = abs(objects.eta)
+                else:
+                    params[dimlabel] = getattr(objects, dimlabel)
+            values, counts = self.evaluate(name, variations, index=i, cache=cache,
+                                           return_counts=True, **params)
+            values = per_event_product(values, counts)
+            ratios = variation_ratios(values)
+            for j, unctype in enumerate(unctypes or ()):
+                systematics[f"{key}{i}" + unctype.replace(" ", "")] = (ratios[2 * j], ratios[2 * j + 1])
+            weight = weight * values[0]
+        return weight, systematics
+
+
+def per_event_product(values, counts):
+    """Product over the objects of every event, for every variation"""
+    n_events = len(counts)
+    event = np.repeat(np.arange(n_events), counts)
+    out = np.ones(values.shape[:-1] + (n_events,), dtype=values.dtype)
+    for row, row_values in zip(out.reshape(-1, n_events), values.reshape(-1, values.shape[-1])):
+        np.multiply.at(row, event, row_values)
+    return out
+
+
+def per_event_any(values, counts):
+    """True for events with at least one object with a non-zero value"""
+    event = np.repeat(np.arange(len(counts)), counts)
+    return np.bincount(event, weights=values != 0, minlength=len(counts)) > 0
+
+
+def variation_ratios(values, inflate=None):
+    """Ratios of the variations (rows 1, 2, ...) to the nominal (row 0), the
+    uncertainty is scaled by inflate (scalar or per entry) if given"""
+    central = values[0]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ratios = np.where(central != 0, values[1:] / np.where(central != 0, central, 1), 1.)
+    if inflate is not None:
+        ratios = 1 + np.asarray(inflate) * (ratios - 1)
+    return tuple(ratios)
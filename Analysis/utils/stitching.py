@@ -0,0 +1,250 @@
+import os
+import json
+import logging
+from functools import lru_cache
+from argparse import ArgumentParser
+
+import numpy as np
+import awkward as ak
+
+try:
+    from .cutflow_store import load_cutflow
+except ImportError:
+    # run as a script
+    from cutflow_store import load_cutflow
+
+# Stitching of the jet-binned DY and W samples.
+# Every group has one inclusive sample and exclusive samples covering one
+# bin each of the stitching variable (LHE.Njets, the HT binning of the table
+# is optional). The weight of an event in bin b is
+#     w_b = xsec_incl / N_incl                               (no exclusive sample)
+#     w_b = xsec_b / (N_incl * xsec_b / xsec_incl + N_b)     (exclusive sample b)
+# for all samples of the group, so stitched histograms only need to be scaled
+# by the luminosity (DY_stitching_applied / W_stitching_applied in the plot
+# configs). The tables are stored in the processor config as
+#     "DY_jet_reweight": [[w_0, ..., w_4]]    (one row per HT bin)
+# with the HT bin edges in "DY_jet_reweight_ht_edges" if there is more than
+# one row, and applied with one gather per chunk.
+# The tables are derived from the cutflow of a processor run (N = entry
+# "key" of the group, W samples are counted after resetting the weight to 1,
+# which is done also if there is no W table in the config yet; use a
+# processor applying the stitching before any cut, e.g. the wjets one)
+# and the cross sections, and cached per era in stitching.json next to the
+# cutflow:
+#   python utils/stitching.py ${DIR}/cutflows.json --xsec ./configs/crosssections.json --era 2018
+# prints the config entries of all groups found in the cutflow.
+
+STITCHING_GROUPS = {
+    "DY": {
+        "inclusive": "DYJetsToLL_M-50_TuneCP5_13TeV-madgraphMLM-pythia8",
+        "exclusive": {
+            1: "DY1JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8",
+            2: "DY2JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8",
+            3: "DY3JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8",
+            4: "DY4JetsToLL_M-50_MatchEWPDG20_TuneCP5_13TeV-madgraphMLM-pythia8",
+        },
+        "n_bins": 5,
+        "config_key": "DY_jet_reweight",
+        "cut": "DY jet reweighting",
+        "reset_weight": False,
+        "key": ("all", "BeforeCuts"),
+    },
+    "W": {
+        "inclusive": "WJetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8",
+        "exclusive": {
+            1: "W1JetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8",
+            2: "W2JetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8",
+            3: "W3JetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8",
+            4: "W4JetsToLNu_TuneCP5_13TeV-madgraphMLM-pythia8",
+        },
+        "n_bins": 5,
+        "config_key": "W_jet_reweight",
+        "cut": "W jet reweighting",
+        "reset_weight": True,
+        "key": ("all", "reset_weight"),
+    },
+}
+
+CACHE_NAME = "stitching.json"
+
+logger = logging.getLogger(__name__)
+
+
+@lru_cache(maxsize=None)
+def _dataset_index(dsname):
+    for group, definition in STITCHING_GROUPS.items():
+        if dsname.startswith(definition["inclusive"]):
+            return group, None
+        for index, prefix in definition["exclusive"].items():
+            if dsname.startswith(prefix):
+                return group, index
+    return None, None
+
+
+def stitching_group(dsname):
+    """Stitching group ("DY", "W") of the dataset, None if it is not stitched"""
+    return _dataset_index(dsname)[0]
+
+
+def stitching_bin(dsname):
+    """Bin covered by an exclusive sample, None for inclusive samples"""
+    return _dataset_index(dsname)[1]
+
+
+def _sum_by_sample(values, group):
+    # datasets are matched by prefix, extensions are added up
+    sums = {}
+    for dataset, value in values.items():
+        if stitching_group(dataset) != group:
+            continue
+        index = stitching_bin(dataset)
+        sums[index] = sums.get(index, 0.) + value
+    return sums
+
+
+def derive_weights(group, event_counts, xsecs):
+    """Weights per bin of the group from {dataset: N} and {dataset: xsec}"""
+    definition = STITCHING_GROUPS[group]
+    counts = _sum_by_sample(event_counts, group)
+    xsec = {}
+    for dataset, value in xsecs.items():
+        if stitching_group(dataset) == group:
+            xsec.setdefault(stitching_bin(dataset), value)
+    if None not in counts or None not in xsec:
+        raise KeyError(f"Inclusive sample of {group} missing: {definition['inclusive']}")
+    n_incl, xsec_incl = counts[None], xsec[None]
+    weights = np.full(definition["n_bins"], xsec_incl / n_incl)
+    for index in definition["exclusive"]:
+        if index not in counts or index not in xsec:
+            continue
+        weights[index] = xsec[index] / (n_incl * xsec[index] / xsec_incl + counts[index])
+    return weights
+
+
+def _cutflow_value(cutflow, dataset, key):
+    node = cutflow[dataset]
+    for part in key:
+        node = node[part]
+    return node
+
+
+def _fingerprint(paths):
+    return {os.path.abspath(path): [os.stat(path).st_size, os.stat(path).st_mtime_ns]
+            for path in paths}
+
+
+def stitching_weights(cutflow_path, xsec_path, era, cache_path=None, force=False):
+    """{group: weights} for all groups with their inclusive sample in the
+    cutflow, cached per era until the cutflow or cross sections change"""
+    if cache_path is None:
+        cache_path = os.path.join(os.path.dirname(os.path.abspath(cutflow_path)), CACHE_NAME)
+    cache = {}
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            cache = json.load(f)
+    sources = _fingerprint([cutflow_path, xsec_path])
+    if not force and era in cache and cache[era]["sources"] == sources:
+        return {group: np.asarray(weights) for group, weights in cache[era]["weights"].items()}
+
+    cutflow = load_cutflow(cutflow_path, era)
+    with open(xsec_path) as f:
+        xsecs = json.load(f)
+    result = {}
+    for group, definition in STITCHING_GROUPS.items():
+        counts = {}
+        for dataset in cutflow.keys():
+            if stitching_group(dataset) != group:
+                continue
+            try:
+                counts[dataset] = _cutflow_value(cutflow, dataset, definition["key"])
+            except KeyError:
+                logger.warning(f"No {'/'.join(definition['key'])} in the cutflow of "
+                               f"{dataset}, not used for the {group} stitching")
+                continue
+        if not any(stitching_bin(dataset) is None for dataset in counts):
+            continue
+        result[group] = derive_weights(group, counts, xsecs)
+
+    cache[era] = {"sources": sources,
+                  "weights": {group: weights.tolist() for group, weights in result.items()}}
+    with open(cache_path + ".tmp", "w") as f:
+        json.dump(cache, f, indent=4)
+    os.replace(cache_path + ".tmp", cache_path)
+    return result
+
+
+class StitchingTable:
+    """Stitching weights of a group as given in the processor config"""
+
+    def __init__(self, config, group):
+        definition = STITCHING_GROUPS[group]
+        self.table = np.atleast_2d(np.asarray(config[definition["config_key"]], dtype=np.float64))
+        ht_key = definition["config_key"] + "_ht_edges"
+        if ht_key in config and config[ht_key]:
+            self.ht_edges = np.asarray(config[ht_key], dtype=np.float64)
+            if len(self.ht_edges) != len(self.table) - 1:
+                raise ValueError(f"{ht_key} needs {len(self.table) - 1} edges")
+        else:
+            if len(self.table) != 1:
+                raise ValueError(f"{definition['config_key']} has HT rows but no {ht_key}")
+            self.ht_edges = None
+
+    def __call__(self, lhe):
+        """Weight of every event from the LHE record"""
+        njets = np.asarray(ak.to_numpy(lhe["Njets"]), dtype=np.int64)
+        njets = np.clip(njets, 0, self.table.shape[1] - 1)
+        if self.ht_edges is None:
+            return self.table[0, njets]
+        ht = np.asarray(ak.to_numpy(lhe["HT"]), dtype=np.float64)
+        return self.table[np.searchsorted(self.ht_edges, ht, side="right"), njets]
+
+
+def stitching_tables(config, groups=tuple(STITCHING_GROUPS)):
+    """{group: StitchingTable} for the groups with a table in the config"""
+    tables = {}
+    for group in groups:
+        key = STITCHING_GROUPS[group]["config_key"]
+        if key in config and len(config[key]) > 0:
+            tables[group] = StitchingTable(config, group)
+    return tables
+
+
+def add_stitching_cuts(selector, dsname, tables, groups=tuple(STITCHING_GROUPS)):
+    """Add the stitching weight as a cut if the dataset belongs to one of the
+    groups in tables, returns the group (None if not stitched). The weight of
+    the groups counted with reset_weight is reset to 1 also without a table,
+    so the cutflow can be used to derive it."""
+    group = stitching_group(dsname)
+    if group is None or group not in groups:
+        return None
+    definition = STITCHING_GROUPS[group]
+    if definition["reset_weight"]:
+        selector.systematics["weight"] = \
+            ak.full_like(selector.systematics["weight"], 1.0)
+        selector.add_cut("reset_weight", lambda data: np.ones(len(data)))
+    if group not in tables:
+        return None
+    table = tables[group]
+    selector.add_cut(definition["cut"], lambda data: table(data["LHE"]))
+    return group
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Derive the stitching weights of the jet-binned samples")
+    parser.add_argument("cutflow", help="cutflows.json (or cutflows.sqlite) of the processor run")
+    parser.add_argument("--xsec", required=True, help="Cross section json")
+    parser.add_argument("--era", required=True)
+    parser.add_argument("--cache", default=None,
+                        help=f"Cache file, default: {CACHE_NAME} next to the cutflow")
+    parser.add_argument("--force", action="store_true", help="Ignore the cache")
+    args = parser.parse_args()
+
+    weights = stitching_weights(args.cutflow, args.xsec, args.era, args.cache, args.force)
+    if len(weights) == 0:
+        print("No inclusive sample of a stitching group in the cutflow")
+    for group, values in weights.items():
+        definition = STITCHING_GROUPS[group]
+        print(f'"{definition["config_key"]}": [')
+        print(f'    // Njets: {list(range(definition["n_bins"]))}')
+        print("    [" + ", ".join(f"{value:.15g}" for value in values) + "]")
+        print("],")
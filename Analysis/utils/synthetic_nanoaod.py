@@ -0,0 +1,324 @@
+import json
+import os
+
+import awkward as ak
+import numpy as np
+import uproot
+
+# Generator of synthetic NanoAOD files following the custom LLStau schema
+# (Jet with disTauTag_score1, PFCandidate with track details, GenVisTau etc).
+# The files are meant for benchmarking the processors locally, the physics
+# content only roughly follows the real samples.
+
+# Mean multiplicities per event, all of them can be overwritten from outside.
+# "background" roughly corresponds to the MET/QCD samples with many
+# PFCandidates, "signal" to the small SMS-TStauStau files.
+PROFILES = {
+    "signal": {
+        "Jet": 6, "PFCandidate": 600, "LostTrack": 20, "GenPart": 60,
+        "GenJet": 6, "Muon": 0.3, "Electron": 0.3, "Tau": 1.5,
+        "TrigObj": 8, "ctau_cm": 10.0, "met_scale": 150.0, "lhe_njets_max": 4,
+    },
+    "background": {
+        "Jet": 9, "PFCandidate": 1500, "LostTrack": 40, "GenPart": 120,
+        "GenJet": 9, "Muon": 1.0, "Electron": 0.5, "Tau": 2.0,
+        "TrigObj": 15, "ctau_cm": 0.0, "met_scale": 80.0, "lhe_njets_max": 4,
+    },
+}
+
+HLT_PATHS = [
+    "HLT_PFMET120_PFMHT120_IDTight",
+    "HLT_PFMET130_PFMHT130_IDTight",
+    "HLT_PFMET140_PFMHT140_IDTight",
+    "HLT_PFMETNoMu120_PFMHTNoMu120_IDTight",
+    "HLT_IsoMu24",
+    "HLT_IsoMu27",
+]
+
+MET_FILTERS = [
+    "Flag_goodVertices",
+    "Flag_globalSuperTightHalo2016Filter",
+    "Flag_HBHENoiseFilter",
+    "Flag_HBHENoiseIsoFilter",
+    "Flag_EcalDeadCellTriggerPrimitiveFilter",
+    "Flag_BadPFMuonFilter",
+    "Flag_BadPFMuonDzFilter",
+    "Flag_eeBadScFilter",
+    "Flag_ecalBadCalibFilter",
+]
+
+# Bits of GenPart_statusFlags used by the processors
+FLAG_PROMPT = 1 << 0
+FLAG_DIRECT_TAU_DECAY = 1 << 4
+FLAG_DIRECT_PROMPT_TAU_DECAY = 1 << 5
+FLAG_HARD_PROCESS = 1 << 7
+FLAG_FROM_HARD_PROCESS = 1 << 8
+FLAG_FIRST_COPY = 1 << 12
+FLAG_LAST_COPY = 1 << 13
+
+# Fixed stau -> tau (-> pi nu) LSP chain at the beginning of every GenPart
+# collection, the rest of the collection is filled with random particles.
+_CHAIN_PDGID = np.array([1000015, -1000015, 15, 1000022, -15, 1000022, 211, -211, 16, -16])
+_CHAIN_MOTHER = np.array([-1, -1, 0, 0, 1, 1, 2, 4, 2, 4])
+_CHAIN_FLAGS = np.array(
+    [FLAG_HARD_PROCESS | FLAG_FROM_HARD_PROCESS | FLAG_FIRST_COPY | FLAG_LAST_COPY] * 6
+    + [FLAG_DIRECT_TAU_DECAY | FLAG_DIRECT_PROMPT_TAU_DECAY | FLAG_LAST_COPY] * 4)
+N_CHAIN = len(_CHAIN_PDGID)
+
+
+def _counts(rng, mean, n_events, minimum=0):
+    return np.maximum(rng.poisson(mean, n_events), minimum)
+
+
+def _kinematics(rng, counts, pt_scale, pt_min=0.0, eta_max=2.5, mass=0.0):
+    n = int(counts.sum())
+    return {
+        "pt": (pt_min + rng.exponential(pt_scale, n)).astype(np.float32),
+        "eta": rng.uniform(-eta_max, eta_max, n).astype(np.float32),
+        "phi": rng.uniform(-np.pi, np.pi, n).astype(np.float32),
+        "mass": np.full(n, mass, dtype=np.float32),
+    }
+
+
+def _collection(fields, counts):
+    return ak.zip({name: ak.unflatten(values, counts)
+                   for name, values in fields.items()})
+
+
+def _jets(rng, n_events, mean):
+    counts = _counts(rng, mean, n_events, minimum=2)
+    n = int(counts.sum())
+    fields = _kinematics(rng, counts, 60.0, pt_min=15.0, eta_max=4.7)
+    fields["mass"] = rng.uniform(2.0, 20.0, n).astype(np.float32)
+    # The tagger score is strongly peaked at zero with a small tail at one
+    fields["disTauTag_score1"] = np.where(
+        rng.uniform(size=n) < 0.95,
+        rng.beta(0.3, 8.0, n), rng.beta(8.0, 0.3, n)).astype(np.float32)
+    fields["jetId"] = rng.choice([0, 2, 6], n, p=[0.05, 0.15, 0.8]).astype(np.int32)
+    fields["puId"] = rng.integers(0, 8, n).astype(np.int32)
+    fields["btagDeepFlavB"] = rng.uniform(0.0, 1.0, n).astype(np.float32)
+    fields["partonFlavour"] = rng.choice([0, 1, 2, 3, 4, 5, 21], n).astype(np.int32)
+    fields["hadronFlavour"] = rng.choice([0, 4, 5], n).astype(np.int32)
+    fields["rawFactor"] = rng.uniform(0.0, 0.2, n).astype(np.float32)
+    fields["area"] = rng.normal(0.5, 0.02, n).astype(np.float32)
+    fields["muonSubtrFactor"] = rng.uniform(0.0, 0.05, n).astype(np.float32)
+    fields["chEmEF"] = rng.uniform(0.0, 0.3, n).astype(np.float32)
+    fields["neEmEF"] = rng.uniform(0.0, 0.3, n).astype(np.float32)
+    fields["genJetIdx"] = np.full(n, -1, dtype=np.int32)
+    return _collection(fields, counts), counts
+
+
+def _pfcandidates(rng, n_events, mean, ctau_cm):
+    counts = _counts(rng, mean, n_events)
+    n = int(counts.sum())
+    fields = _kinematics(rng, counts, 3.0, pt_min=0.2)
+    fields["mass"] = np.where(rng.uniform(size=n) < 0.7, 0.1396, 0.0).astype(np.float32)
+    # Most of the tracks are prompt, a fraction is displaced by ctau
+    displaced = rng.uniform(size=n) < (0.05 if ctau_cm > 0 else 0.0)
+    vxy = np.where(displaced, rng.exponential(max(ctau_cm, 1e-3), n),
+                   np.abs(rng.normal(0.0, 0.002, n)))
+    vphi = rng.uniform(-np.pi, np.pi, n)
+    fields["vx"] = (vxy * np.cos(vphi)).astype(np.float32)
+    fields["vy"] = (vxy * np.sin(vphi)).astype(np.float32)
+    fields["vz"] = rng.normal(0.0, 3.5, n).astype(np.float32)
+    fields["dxy"] = (vxy * rng.choice([-1.0, 1.0], n)).astype(np.float32)
+    fields["dxyError"] = rng.uniform(0.001, 0.05, n).astype(np.float32)
+    fields["dz"] = rng.normal(0.0, 0.05, n).astype(np.float32)
+    fields["dzError"] = rng.uniform(0.001, 0.05, n).astype(np.float32)
+    fields["charge"] = rng.choice([-1, 0, 1], n).astype(np.int32)
+    fields["pdgId"] = (rng.choice([211, 22, 130, 11, 13], n, p=[0.6, 0.25, 0.1, 0.03, 0.02])
+                       * np.where(fields["charge"] < 0, -1, 1)).astype(np.int32)
+    fields["fromPV"] = rng.integers(0, 4, n).astype(np.int32)
+    fields["lostInnerHits"] = rng.integers(-1, 3, n).astype(np.int32)
+    fields["hasTrackDetails"] = fields["charge"] != 0
+    fields["trkChi2"] = rng.exponential(1.0, n).astype(np.float32)
+    return _collection(fields, counts), counts
+
+
+def _genparts(rng, n_events, mean, ctau_cm, stau_mass=300.0):
+    n_fill = _counts(rng, mean, n_events)
+    counts = n_fill + N_CHAIN
+    n = int(counts.sum())
+    offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    local = np.arange(n) - np.repeat(offsets, counts)
+    in_chain = local < N_CHAIN
+    chain_idx = np.where(in_chain, local, 0)
+
+    fields = _kinematics(rng, counts, 40.0)
+    fields["mass"] = np.where(in_chain & (np.abs(_CHAIN_PDGID[chain_idx]) == 1000015),
+                              stau_mass, 0.0).astype(np.float32)
+    # Random mother with a smaller index than the particle itself
+    random_mother = np.floor(rng.uniform(size=n) * np.maximum(local, 1)).astype(np.int32)
+    random_mother[local == 0] = -1
+    fields["genPartIdxMother"] = np.where(
+        in_chain, _CHAIN_MOTHER[chain_idx], random_mother).astype(np.int32)
+    fields["pdgId"] = np.where(
+        in_chain, _CHAIN_PDGID[chain_idx],
+        rng.choice([1, 2, 21, 22, 111, 211, -211], n)).astype(np.int32)
+    fields["status"] = np.where(in_chain, 2, 1).astype(np.int32)
+    fields["statusFlags"] = np.where(
+        in_chain, _CHAIN_FLAGS[chain_idx], FLAG_PROMPT | FLAG_LAST_COPY).astype(np.int32)
+
+    # Production vertices: stau daughters are displaced by the stau decay
+    # length, the prompt particles are produced at the beam spot
+    decay_length = rng.exponential(ctau_cm, n) if ctau_cm > 0 else np.zeros(n)
+    dphi = rng.uniform(-np.pi, np.pi, n)
+    displaced = in_chain & (local >= 2)
+    # all daughters of the same stau share its decay vertex
+    first = np.repeat(offsets, counts)
+    stau_of = np.where(np.isin(chain_idx, [2, 3, 6, 8]), 0, 1)
+    shared = first + stau_of
+    dl = np.where(displaced, decay_length[shared], 0.0)
+    ph = dphi[shared]
+    fields["vertexX"] = (dl * np.cos(ph)).astype(np.float32)
+    fields["vertexY"] = (dl * np.sin(ph)).astype(np.float32)
+    fields["vertexZ"] = np.where(displaced, rng.normal(0.0, 1.0, n) * dl, 0.0).astype(np.float32)
+    fields["vertexR"] = np.hypot(fields["vertexX"], fields["vertexY"]).astype(np.float32)
+    fields["vertexRho"] = fields["vertexR"]
+    return _collection(fields, counts), counts
+
+
+def _genvistaus(rng, n_events):
+    counts = np.full(n_events, 2)
+    fields = _kinematics(rng, counts, 50.0, pt_min=10.0)
+    fields["charge"] = np.tile([-1, 1], n_events).astype(np.int32)
+    fields["status"] = rng.choice([0, 1, 2, 10, 11], 2 * n_events).astype(np.int32)
+    # the two taus of the fixed GenPart chain
+    fields["genPartIdxMother"] = np.tile([2, 4], n_events).astype(np.int32)
+    return _collection(fields, counts), counts
+
+
+def _leptons(rng, n_events, mean, flavour):
+    counts = _counts(rng, mean, n_events)
+    n = int(counts.sum())
+    fields = _kinematics(rng, counts, 30.0, pt_min=5.0)
+    fields["charge"] = rng.choice([-1, 1], n).astype(np.int32)
+    fields["dxy"] = rng.normal(0.0, 0.01, n).astype(np.float32)
+    fields["dz"] = rng.normal(0.0, 0.02, n).astype(np.float32)
+    fields["pfRelIso04_all" if flavour == "Muon" else "pfRelIso03_all"] = \
+        rng.exponential(0.1, n).astype(np.float32)
+    if flavour == "Muon":
+        fields["mass"] = np.full(n, 0.1057, dtype=np.float32)
+        for name in ("looseId", "mediumId", "tightId"):
+            fields[name] = rng.uniform(size=n) < 0.8
+        fields["pfIsoId"] = rng.integers(0, 7, n).astype(np.uint8)
+    else:
+        fields["mass"] = np.full(n, 0.000511, dtype=np.float32)
+        for name in ("convVeto", "mvaIso_WPL", "mvaIso_WP90", "mvaFall17V2Iso_WPL"):
+            fields[name] = rng.uniform(size=n) < 0.8
+        fields["deltaEtaSC"] = rng.normal(0.0, 0.01, n).astype(np.float32)
+        fields["cutBased"] = rng.integers(0, 5, n).astype(np.int32)
+    return _collection(fields, counts), counts
+
+
+def _taus(rng, n_events, mean):
+    counts = _counts(rng, mean, n_events)
+    n = int(counts.sum())
+    fields = _kinematics(rng, counts, 30.0, pt_min=18.0, mass=1.2)
+    fields["charge"] = rng.choice([-1, 1], n).astype(np.int32)
+    fields["decayMode"] = rng.choice([0, 1, 10, 11], n).astype(np.int32)
+    for name in ("idDeepTau2018v2p5VSe", "idDeepTau2018v2p5VSmu", "idDeepTau2018v2p5VSjet"):
+        fields[name] = rng.integers(0, 9, n).astype(np.uint8)
+    return _collection(fields, counts), counts
+
+
+def generate_events(n_events, profile="signal", seed=0, **overrides):
+    """Return a dict of branches/records that can be written with uproot."""
+    params = dict(PROFILES[profile])
+    params.update(overrides)
+    rng = np.random.default_rng(seed)
+    ctau = params["ctau_cm"]
+
+    events = {}
+    events["run"] = np.full(n_events, 1, dtype=np.uint32)
+    events["luminosityBlock"] = (np.arange(n_events) // 1000 + 1).astype(np.uint32)
+    events["event"] = (np.arange(n_events) + 1 + seed * n_events).astype(np.uint64)
+    events["genWeight"] = np.ones(n_events, dtype=np.float32)
+    events["fixedGridRhoFastjetAll"] = rng.uniform(5.0, 40.0, n_events).astype(np.float32)
+    for path in HLT_PATHS:
+        events[path] = rng.uniform(size=n_events) < 0.7
+    for flag in MET_FILTERS:
+        events[flag] = rng.uniform(size=n_events) < 0.99
+
+    events["PV"] = ak.zip({
+        "npvsGood": rng.poisson(30, n_events).astype(np.int32),
+        "npvs": rng.poisson(33, n_events).astype(np.int32),
+        "x": rng.normal(0.0, 0.001, n_events).astype(np.float32),
+        "y": rng.normal(0.0, 0.001, n_events).astype(np.float32),
+        "z": rng.normal(0.0, 3.5, n_events).astype(np.float32),
+    })
+    events["Pileup"] = ak.zip({
+        "nTrueInt": rng.uniform(0.0, 80.0, n_events).astype(np.float32),
+        "nPU": rng.poisson(30, n_events).astype(np.int32),
+    })
+    events["LHE"] = ak.zip({
+        "Njets": rng.integers(0, int(params["lhe_njets_max"]) + 1, n_events).astype(np.uint8),
+        "HT": rng.exponential(200.0, n_events).astype(np.float32),
+    })
+    events["L1PreFiringWeight"] = ak.zip({
+        "Nom": np.ones(n_events, dtype=np.float32),
+        "Up": np.ones(n_events, dtype=np.float32),
+        "Dn": np.ones(n_events, dtype=np.float32),
+    })
+    for met in ("MET", "RawMET", "PuppiMET"):
+        events[met] = ak.zip({
+            "pt": rng.exponential(params["met_scale"], n_events).astype(np.float32),
+            "phi": rng.uniform(-np.pi, np.pi, n_events).astype(np.float32),
+            "sumEt": rng.exponential(1000.0, n_events).astype(np.float32),
+        })
+    events["MET"]["MetUnclustEnUpDeltaX"] = rng.normal(0.0, 1.0, n_events).astype(np.float32)
+    events["MET"]["MetUnclustEnUpDeltaY"] = rng.normal(0.0, 1.0, n_events).astype(np.float32)
+
+    events["Jet"], _ = _jets(rng, n_events, params["Jet"])
+    events["PFCandidate"], _ = _pfcandidates(rng, n_events, params["PFCandidate"], ctau)
+    events["LostTrack"], _ = _pfcandidates(rng, n_events, params["LostTrack"], ctau)
+    events["GenPart"], _ = _genparts(rng, n_events, params["GenPart"], ctau)
+    events["GenVisTau"], _ = _genvistaus(rng, n_events)
+    counts = _counts(rng, params["GenJet"], n_events)
+    events["GenJet"] = _collection(_kinematics(rng, counts, 50.0, pt_min=10.0, eta_max=4.7), counts)
+    events["Muon"], _ = _leptons(rng, n_events, params["Muon"], "Muon")
+    events["Electron"], _ = _leptons(rng, n_events, params["Electron"], "Electron")
+    events["Tau"], _ = _taus(rng, n_events, params["Tau"])
+    counts = _counts(rng, params["TrigObj"], n_events)
+    trigobj = _kinematics(rng, counts, 30.0)
+    n = int(counts.sum())
+    trigobj["id"] = rng.choice([1, 11, 13, 15], n).astype(np.int32)
+    trigobj["filterBits"] = rng.integers(0, 64, n).astype(np.int32)
+    del trigobj["mass"]
+    events["TrigObj"] = _collection(trigobj, counts)
+    return events
+
+
+def write_synthetic_nanoaod(path, n_events, profile="signal", seed=0, **overrides):
+    events = generate_events(n_events, profile=profile, seed=seed, **overrides)
+    with uproot.recreate(path) as f:
+        # an explicit TTree, assigning the dict lets newer uproot write an RNTuple
+        tree = f.mktree("Events", {name: array.type if isinstance(array, ak.Array) else array.dtype
+                                   for name, array in events.items()})
+        tree.extend(events)
+    return path
+
+
+def generate_dataset(outdir, n_files, n_events, profile="signal", seed=0, **overrides):
+    """Write `n_files` files into `outdir` and a manifest describing them.
+    Returns the list of written file paths."""
+    os.makedirs(outdir, exist_ok=True)
+    files = []
+    for ifile in range(n_files):
+        path = os.path.join(outdir, f"nanoaod_synthetic_{profile}_{ifile}.root")
+        write_synthetic_nanoaod(path, n_events, profile=profile,
+                                seed=seed + ifile, **overrides)
+        files.append(os.path.abspath(path))
+    params = dict(PROFILES[profile])
+    params.update(overrides)
+    manifest = {
+        "profile": profile,
+        "n_files": n_files,
+        "n_events_per_file": n_events,
+        "seed": seed,
+        "multiplicities": params,
+        "files": files,
+    }
+    with open(os.path.join(outdir, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    return files
@@ -0,0 +1,247 @@
+import os
+import json
+import itertools
+
+import numpy as np
+import awkward as ak
+from coffea.processor import AccumulatorABC
+
+from .hist_store import write_store, find_store, STORE_NAME
+
+# Histograms with the systematic variations as an axis.
+# With "systematics_axis": true in the processor config every histogram is
+# filled once per cut and chunk for all weight variations: the nominal weight
+# and the variations of the selector form a weight matrix (n_events, n_sys)
+# and one bincount over (variation, bin) fills all of them, instead of one
+# pepper fill (and one histogram object with its own axes) per variation.
+# The histograms are kept as SystHist in the output and written to
+# hists/hists.h5 (see utils/hist_store.py) with the variations as second
+# dimension, values (n_paths, n_sys, *bins); hists.json lists them like the
+# ROOT files, so the readers using open_hist_file get
+# <dataset>/<sys>/<category>/hist from the slice of the variation.
+# Only weight variations are filled this way, shape variations (separate
+# runs with a systematic in the config) are written as before.
+
+def weight_matrix(systematics, n_events):
+    """Names and weights (n_events, n_sys) of the nominal weight and its
+    variations, the first column is the nominal one"""
+    if systematics is None:
+        return ["nominal"], np.ones((n_events, 1))
+    fields = [field for field in ak.fields(systematics) if field != "weight"]
+    weights = np.empty((n_events, len(fields) + 1))
+    weights[:, 0] = np.asarray(ak.to_numpy(systematics["weight"]), dtype=np.float64)
+    for i, field in enumerate(fields):
+        weights[:, i + 1] = weights[:, 0] * np.asarray(
+            ak.to_numpy(systematics[field]), dtype=np.float64)
+    return ["nominal"] + fields, weights
+
+
+def _axis_edges(axis):
+    """Bin edges of a coffea Bin axis"""
+    if hasattr(axis, "edges"):
+        return np.asarray(axis.edges(), dtype=np.float64)
+    return np.asarray(axis._bins, dtype=np.float64)
+
+
+def _entries(event, arrays):
+    """Flat arrays of the per event or per object arrays (None filled with
+    their fill value) and the event of every entry"""
+    arrays = [ak.fill_none(array, fill) if isinstance(array, ak.Array) else array
+              for array, fill in arrays]
+    if any(isinstance(array, ak.Array) and array.ndim > 1 for array in arrays):
+        event, *arrays = ak.broadcast_arrays(event, *arrays)
+        event = np.asarray(ak.to_numpy(ak.flatten(event, axis=None)))
+        arrays = [ak.flatten(array, axis=None) for array in arrays]
+    return event, [np.asarray(ak.to_numpy(array) if isinstance(array, ak.Array) else array)
+                   for array in arrays]
+
+
+class SystHist(AccumulatorABC):
+    """Histogram with a systematic axis for every (dataset, categories)
+    key, values and variances have the shape (n_sys, *bins with flow)"""
+
+    def __init__(self, edges, axis_titles, cat_axes, title=""):
+        self.edges = [np.asarray(e, dtype=np.float64) for e in edges]
+        self.axis_titles = list(axis_titles)
+        self.cat_axes = list(cat_axes)
+        self.title = title
+        self.content = {}
+
+    @property
+    def shape(self):
+        return tuple(len(edges) + 1 for edges in self.edges)
+
+    def identity(self):
+        return SystHist(self.edges, self.axis_titles, self.cat_axes, self.title)
+
+    def add(self, other):
+        for key, (sysnames, values, variances, entries) in other.content.items():
+            if key not in self.content:
+                self.content[key] = [list(sysnames), values.copy(), variances.copy(), entries]
+                continue
+            mine = self.content[key]
+            if mine[0] != list(sysnames):
+                new = [name for name in sysnames if name not in mine[0]]
+                pad = np.zeros((len(new),) + self.shape)
+                mine[0] = mine[0] + new
+                mine[1] = np.concatenate([mine[1], pad])
+                mine[2] = np.concatenate([mine[2], pad])
+                order = [mine[0].index(name) for name in sysnames]
+                mine[1][order] += values
+                mine[2][order] += variances
+            else:
+                mine[1] += values
+                mine[2] += variances
+            mine[3] += entries
+
+    def fill(self, key, sysnames, coordinates, weights):
+        """Fill the entries with the bin coordinates (one array per axis) and
+        weights (n_entries, n_sys)"""
+        shape = self.shape
+        index = np.ravel_multi_index(
+            [np.searchsorted(edges, x, side="right") for edges, x in zip(self.edges, coordinates)],
+            shape)
+        n_cells = int(np.prod(shape))
+        n_sys = weights.shape[1]
+        # one bincount over (variation, bin) for all variations
+        flat_index = (np.arange(n_sys)[None, :] * n_cells + index[:, None]).ravel()
+        values = np.bincount(flat_index, weights.ravel(), minlength=n_sys * n_cells)
+        variances = np.bincount(flat_index, (weights**2).ravel(), minlength=n_sys * n_cells)
+        values, variances = values.astype(np.float64), variances.astype(np.float64)
+        hist = SystHist(self.edges, self.axis_titles, self.cat_axes, self.title)
+        hist.content[key] = [list(sysnames), values.reshape((n_sys,) + shape),
+                             variances.reshape((n_sys,) + shape), float(len(index))]
+        self.add(hist)
+
+    def records(self):
+        """{path: record} in the format of utils/hist_store.py, the path is
+        <dataset>/<categories>/hist"""
+        classname = f"TH{len(self.edges)}D"
+        records = {}
+        for key, (sysnames, values, variances, entries) in self.content.items():
+            records["/".join(key) + "/hist"] = {
+                "classname": classname,
+                "title": self.title,
+                "values": values,
+                "variances": variances,
+                "entries": entries,
+                "edges": self.edges,
+                "labels": [None] * len(self.edges),
+                "axis_titles": self.axis_titles,
+                "sys": list(sysnames),
+            }
+        return records
+
+
+class SystHistDefinition:
+    """Fill of a pepper histogram definition with systematic axis, uses its
+    axes, categories, fill methods and pick_data"""
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.definition = definition
+        try:
+            self.axes = list(definition.axes)
+            self.fill_methods = definition.fill_methods
+        except AttributeError:
+            raise ValueError(f"Histogram {name} can not be filled with a systematic axis")
+        self.cat_axes = list(getattr(definition, "cat_axes", []))
+        self.step_requirement = getattr(definition, "step_requirement", None)
+
+    def __call__(self, data, categorizations, dsname, sysnames, weights):
+        pick = self.definition.pick_data
+        arrays = [(pick(self.fill_methods[axis.name], data), np.nan) for axis in self.axes]
+        # categories of the histogram config are {value: path} on the entries
+        cat_values = []
+        for axis in self.cat_axes:
+            cat_values.append(list(self.fill_methods[axis.name]))
+            arrays += [(pick(method, data), False)
+                       for method in self.fill_methods[axis.name].values()]
+        event, arrays = _entries(np.arange(len(data)), arrays)
+        coordinates, arrays = arrays[:len(self.axes)], arrays[len(self.axes):]
+        cat_masks = []
+        # categories of the selector are event masks
+        for names in (categorizations or {}).values():
+            cat_masks.append({name: np.asarray(ak.to_numpy(data[name]), dtype=bool)[event]
+                              for name in names})
+        for values in cat_values:
+            cat_masks.append({value: arrays.pop(0).astype(bool) for value in values})
+        valid = np.all([np.isfinite(x) for x in coordinates], axis=0)
+        hist = SystHist([_axis_edges(axis) for axis in self.axes],
+                        [getattr(axis, "label", axis.name) for axis in self.axes],
+                        list(categorizations or {}) + [axis.name for axis in self.cat_axes],
+                        self.name)
+        entry_weights = weights[event]
+        for combination in itertools.product(*(masks.items() for masks in cat_masks)):
+            mask = valid.copy()
+            for _, cat_mask in combination:
+                mask &= cat_mask
+            key = (dsname,) + tuple(value for value, _ in combination)
+            hist.fill(key, sysnames, [x[mask] for x in coordinates], entry_weights[mask])
+        return hist
+
+
+class SystAxisMixin:
+    """Processor mixin filling the histograms with a systematic axis, enabled
+    by "systematics_axis" in the config"""
+
+    def setup_outputfiller(self, dsname, is_mc):
+        filler = super().setup_outputfiller(dsname, is_mc)
+        if not ("systematics_axis" in self.config and self.config["systematics_axis"]):
+            return filler
+        definitions = {}
+
+        def fill_hists(data, systematics, cut, done_steps, cats):
+            accumulator = filler.output["hists"]
+            sysnames, weights = weight_matrix(systematics, len(data))
+            for histname, definition in filler.hist_dict.items():
+                if histname not in definitions:
+                    definitions[histname] = SystHistDefinition(histname, definition)
+                fill = definitions[histname]
+                if fill.step_requirement is not None and fill.step_requirement not in done_steps:
+                    continue
+                hist = fill(data, cats, dsname, sysnames, weights)
+                key = (cut, histname)
+                if key in accumulator:
+                    accumulator[key].add(hist)
+                else:
+                    accumulator[key] = hist
+
+        filler.fill_hists = fill_hists
+        return filler
+
+    def save_output(self, output, dest):
+        hists = output["hists"]
+        syst_hists = {key: hist for key, hist in hists.items() if isinstance(hist, SystHist)}
+        for key in syst_hists:
+            del hists[key]
+        super().save_output(output, dest)
+        if len(syst_hists) > 0:
+            save_syst_hists(syst_hists, os.path.join(dest, "hists"))
+
+
+def save_syst_hists(hists, hist_dir, compression="gzip"):
+    """Write {(cut, histname): SystHist} into the store of hist_dir and add
+    them to its hists.json"""
+    os.makedirs(hist_dir, exist_ok=True)
+    index_path = os.path.join(hist_dir, "hists.json")
+    index = {"content": [[], []]}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    histfiles = dict(zip(map(tuple, index["content"][0]), index["content"][1]))
+    # files already in the store are kept
+    store = find_store(index_path)
+    sources = {histfile: [os.path.join(hist_dir, histfile)] for histfile in histfiles.values()
+               if store is not None and histfile in store
+               and not os.path.exists(os.path.join(hist_dir, histfile))}
+    for (cut, histname), hist in hists.items():
+        histfile = histfiles.get((cut, histname), f"{cut}_{histname}.root")
+        if (cut, histname) not in histfiles:
+            histfiles[(cut, histname)] = histfile
+            index["content"][0].append([cut, histname])
+            index["content"][1].append(histfile)
+        sources[histfile] = [hist.records()]
+    write_store(os.path.join(hist_dir, STORE_NAME), index, sources, compression)
+    with open(index_path, "w") as f:
+        json.dump(index, f, indent=4)
@@ -0,0 +1,166 @@
+import numpy as np
+import awkward as ak
+
+from .abcd import read_arrays
+
+# Working point scan of the tagger score and dxy in one processing pass.
+# With "threshold_scan": true in the signal / wjets processor config the
+# events with two loose jets get the columns scan_score_min, scan_score_max,
+# scan_dxy_min and scan_dxysig_min, filled into the fine 3D histograms of
+# configs/hists_configs/stau2018_threshold_scan_hist.json
+#     (score_min, score_max, dxy_min)  and  (score_min, score_max, dxysig_min)
+# For a working point (loose, tight, dxy) the event yields are sums over
+# all bins above the thresholds, which are read from the reverse cumulative
+# sums over the three axes (flow bins included)
+#     N_loose = C[loose, -, dxy]       both jets loose and above the dxy cut
+#     N_>=1   = C[loose, tight, dxy]   the larger score tight
+#     N_2     = C[max(loose, tight), -, dxy]
+#     N_0 = N_loose - N_>=1,  N_1 = N_>=1 - N_2
+# so the whole grid of working points is one cumsum per axis and an index
+# lookup. The inclusive jet fake rate of the region is
+#     f = (N_1 + 2 N_2) / (2 N_loose)
+# and the yields with one or two tight jets are predicted as in
+# macros/py_predict_real.py
+#     0->1: N_0 2f / (1 - f),  0->2: N_0 f^2 / (1 - f)^2,  1->2: N_1 f / (2 (1 - f))
+# The thresholds have to be bin edges. The processing cuts (loose_thr,
+# jet_dxy_min, exactly two loose jets) are the lower ends of the scan: a
+# tighter loose or dxy cut drops the events in which a jet fails it, events
+# with more than two jets at the processing cuts are not recovered.
+# stau_threshold_scan.py evaluates the scan for a grid of working points.
+
+
+def scan_columns(data, jets="Jet_select"):
+    """Per event values of the two jets for the scan, set with
+    selector.set_multiple_columns: both jets pass a (loose, dxy) working
+    point if the smaller score and dxy pass, one or two jets are tight if
+    the larger or smaller score passes"""
+    if len(data) == 0:
+        return ak.Array([])
+    jets = data[jets]
+    return {
+        "scan_score_min": ak.min(jets.disTauTag_score1, axis=1),
+        "scan_score_max": ak.max(jets.disTauTag_score1, axis=1),
+        "scan_dxy_min": ak.min(jets.dxy, axis=1),
+        "scan_dxysig_min": ak.min(jets.dxysig, axis=1),
+    }
+
+
+def reverse_cumsum(values, n_axes=3):
+    """Sums over all bins from every bin on over the last n_axes axes,
+    values (..., *bins with flow)"""
+    for axis in range(values.ndim - n_axes, values.ndim):
+        values = np.flip(np.cumsum(np.flip(values, axis), axis), axis)
+    return values
+
+
+def edge_index(edges, thresholds):
+    """Flow bin index of the bins starting at the thresholds"""
+    thresholds = np.atleast_1d(np.asarray(thresholds, dtype=np.float64))
+    index = np.clip(np.searchsorted(edges, thresholds), 0, len(edges) - 1)
+    if not np.allclose(edges[index], thresholds, rtol=0, atol=1e-9):
+        bad = thresholds[~np.isclose(edges[index], thresholds, rtol=0, atol=1e-9)]
+        raise ValueError(f"Thresholds {bad.tolist()} are not bin edges of the scan "
+                         f"histogram, available: {edges.tolist()}")
+    return index + 1
+
+
+def read_scan(histfile, datasets, scales=None, sys=None):
+    """values, variances (*bins with flow) summed over the datasets, scaled
+    by {dataset: factor}, and the edges of a scan histogram file"""
+    scales = scales or {}
+    names = [f"{dataset}/{sys}/hist" if sys else f"{dataset}/hist" for dataset in datasets]
+    values, variances, edges = read_arrays(histfile, names)
+    scale = np.array([scales.get(dataset, 1.0) for dataset in datasets])
+    scale = scale.reshape((-1,) + (1,) * (values.ndim - 1))
+    if not np.allclose(edges[0], edges[1]):
+        raise ValueError(f"Score axes of {histfile} have different binning")
+    return (values * scale).sum(0), (variances * scale**2).sum(0), edges
+
+
+class ThresholdScan:
+    """Event yields with 0, 1 and 2 tight jets for a grid of working
+    points, arrays (n_loose, n_tight, n_dxy)"""
+
+    def __init__(self, values, variances, edges):
+        self.edges = [np.asarray(e, dtype=np.float64) for e in edges]
+        self.cumulative = reverse_cumsum(np.asarray(values, dtype=np.float64))
+        self.cumulative_var = reverse_cumsum(np.asarray(variances, dtype=np.float64))
+
+    @classmethod
+    def load(cls, histfile, datasets, scales=None, sys=None):
+        return cls(*read_scan(histfile, datasets, scales, sys))
+
+    def grid(self, loose=None, tight=None, dxy=None):
+        """Thresholds of the grid, all edges if not given"""
+        score = self.edges[0]
+        return (np.atleast_1d(loose if loose is not None else score[:1]),
+                np.atleast_1d(tight if tight is not None else score),
+                np.atleast_1d(dxy if dxy is not None else self.edges[2]))
+
+    def yields(self, loose=None, tight=None, dxy=None):
+        """{N_loose, N_0, N_1, N_2: (values, variances)}"""
+        loose, tight, dxy = self.grid(loose, tight, dxy)
+        i_loose = edge_index(self.edges[0], loose)[:, None, None]
+        i_tight = edge_index(self.edges[1], tight)[None, :, None]
+        i_dxy = edge_index(self.edges[2], dxy)[None, None, :]
+        result = {}
+        for cumulative, part in [(self.cumulative, 0), (self.cumulative_var, 1)]:
+            n_loose = np.broadcast_to(cumulative[i_loose, 0, i_dxy],
+                                      (len(loose), len(tight), len(dxy)))
+            n_ge1 = cumulative[i_loose, i_tight, i_dxy]
+            n_2 = cumulative[np.maximum(i_loose, i_tight), 0, i_dxy]
+            for name, value in [("N_loose", n_loose), ("N_0", n_loose - n_ge1),
+                                ("N_1", n_ge1 - n_2), ("N_2", n_2)]:
+                result.setdefault(name, [None, None])[part] = value
+        return {name: tuple(value) for name, value in result.items()}
+
+    def fake_rate(self, loose=None, tight=None, dxy=None):
+        """Inclusive jet fake rate and its variance (the correlation of the
+        tight and loose jets of events with one tight jet is neglected)"""
+        n = self.yields(loose, tight, dxy)
+        passed = n["N_1"][0] + 2 * n["N_2"][0]
+        failed = 2 * n["N_0"][0] + n["N_1"][0]
+        var_passed = n["N_1"][1] + 4 * n["N_2"][1]
+        var_failed = 4 * n["N_0"][1] + n["N_1"][1]
+        total = passed + failed
+        rate = np.divide(passed, total, out=np.zeros_like(total), where=total > 0)
+        var = np.divide(failed**2 * var_passed + passed**2 * var_failed, total**4,
+                        out=np.zeros_like(total), where=total > 0)
+        return rate, var
+
+
+def predict(yields, rate, var_rate):
+    """Predicted yields with one and two tight jets from the yields of a
+    region and a fake rate on the same grid, {name: (values, variances)}"""
+    n_0, var_0 = yields["N_0"]
+    n_1, var_1 = yields["N_1"]
+    valid = rate < 1
+    fail = np.where(valid, 1 - rate, 1)
+    result = {}
+    # (factor, derivative in f) applied to the yield
+    for name, (n, var_n, factor, derivative) in {
+            "from0to1": (n_0, var_0, 2 * rate / fail, 2 / fail**2),
+            "from0to2": (n_0, var_0, rate**2 / fail**2, 2 * rate / fail**3),
+            "from1to2": (n_1, var_1, rate / (2 * fail), 1 / (2 * fail**2))}.items():
+        value = np.where(valid, n * factor, np.nan)
+        var = np.where(valid, var_n * factor**2 + (n * derivative)**2 * var_rate, np.nan)
+        result[name] = (value, var)
+    return result
+
+
+def significance(signal, background, var_background):
+    """s / sqrt(b + var(b)) on the grid"""
+    denominator = background + var_background
+    return np.divide(signal, np.sqrt(denominator), out=np.zeros_like(signal),
+                     where=denominator > 0)
+
+
+def to_json(grid, arrays):
+    """{"grid": {...}, name: {"value": nested lists, "unc": ...}}"""
+    out = {"grid": {axis: [float(x) for x in values]
+                    for axis, values in zip(["loose", "tight", "dxy"], grid)}}
+    for name, (value, var) in arrays.items():
+        out[name] = {"value": np.asarray(value).tolist(),
+                     "unc": np.sqrt(np.asarray(var)).tolist()}
+    return out
+
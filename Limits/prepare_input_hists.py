@@ -4,8 +4,6 @@ import argparse
 import json
 import os
 import yaml
-import functools
-import operator
 
 import ROOT
 
@@ -35,11 +33,6 @@ def main() :
     d_xsec = cmut.load_config(d_config["xsecfile_bkg"])
     #print(d_xsec)
     
-    d_cutflows = cmut.load_config(d_config["cutflowsfile"])
-    #print(d_cutflows)
-    
-    d_neventtot = {}
-    
     samples = []
     
     for proctype in ["procs_sig", "procs_bkg"] :
@@ -57,9 +50,12 @@ def main() :
     
     print(samples)
     
-    for sample in samples :
-        
-        d_neventtot[sample] = functools.reduce(operator.getitem, [sample]+d_config["neventkey"].split("."), d_cutflows)
+    d_neventtot = cmut.get_cutflow_values(
+        d_config["cutflowsfile"],
+        samples,
+        d_config["neventkey"],
+        era = d_config["era"] if "era" in d_config else None,
+    )
     
     print(d_neventtot)
     
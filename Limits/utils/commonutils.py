@@ -1,9 +1,12 @@
 #!/usr/bin/env python3
 
+import functools
 import json
 import logging
 import numpy
+import operator
 import re
+import sqlite3
 import yaml
 
 
@@ -87,4 +90,60 @@ def get_stau_xsec_dict(l_samplestr, xsecfile) :
         
         d_xsec[samplestr] = get_stau_xsec(samplestr, xsecfile)
     
-    return d_xsec
\ No newline at end of file
+    return d_xsec
+
+
+def get_cutflow_values(cutflowsfile, l_samplestr, key, era = None) :
+    
+    """
+    Cutflow entry (nested keys separated by ".") of each sample
+    From a pepper cutflows json, or from the sqlite store written by Analysis/utils/cutflow_store.py
+    For a store, only the entries of the era are used (era None: the store must have one era per sample)
+    """
+    
+    l_key = key.split(".")
+    d_values = {}
+    
+    if (cutflowsfile.endswith(".sqlite")) :
+        
+        query = "SELECT dataset, era, yield FROM cutflow WHERE category = ? AND cut = ?"
+        params = ("/".join(l_key[:-1]), l_key[-1])
+        
+        if (era is not None) :
+            
+            query += " AND era = ?"
+            params += (str(era),)
+        
+        conn = sqlite3.connect(cutflowsfile)
+        rows = conn.execute(query, params).fetchall()
+        conn.close()
+        
+        d_rows = {}
+        
+        for dataset, row_era, value in rows :
+            
+            d_rows.setdefault(dataset, {})[row_era] = value
+        
+        for samplestr in l_samplestr :
+            
+            if (samplestr not in d_rows) :
+                
+                logger.error(f"{samplestr} {key} (era {era}) not found in {cutflowsfile}")
+                exit(1)
+            
+            if (len(d_rows[samplestr]) > 1) :
+                
+                logger.error(f"{samplestr} {key} found for several eras {sorted(d_rows[samplestr])} in {cutflowsfile}, set the era")
+                exit(1)
+            
+            d_values[samplestr] = list(d_rows[samplestr].values())[0]
+    
+    else :
+        
+        d_cutflows = load_config(cutflowsfile)
+        
+        for samplestr in l_samplestr :
+            
+            d_values[samplestr] = functools.reduce(operator.getitem, [samplestr]+l_key, d_cutflows)
+    
+    return d_values